@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import re
+import io
+import json
+import time
+import datetime
+import argparse
+import resource
+import shutil
+import tempfile
+import functools
+import subprocess
+import gc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'telegraf'))
+import solarEdgeCloudScraper as scraper
+
+# Feeds sample and synthetic responses through the parsing and emit paths of the cloud scraper,
+# no SolarEdge account needed. fixtures/ holds one day of every response in the format returned by
+# SolarEdge (3 phase inverter, 5 meters, 24 panels); longer periods repeat that day, more sites
+# repeat the single site. api_get() and ensure_logged_in() are replaced, everything else is the
+# code that runs on the Pi. Output goes to a sink which only counts the lines and bytes.
+#
+# Every scenario runs in its own process so the peak RSS is its own. Points/s excludes the time
+# spent generating the responses. Blocks/point is the most memory blocks (sys.getallocatedblocks())
+# held at any emit over those held before the run, per point: the parsed lines and the state kept.
+# The response a batch was parsed from is freed by the time it is emitted, so neither the bodies
+# nor their generation are counted.
+#
+# Usage: bench_cloud_scraper.py [--paths PATH ...] [--sites N ...] [--days N ...] [--repeat N]
+#   e.g. bench_cloud_scraper.py --sites 1 10 100 --days 1 30 365
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PATHS = ('power', 'energy', 'data', 'playback', 'history')
+TIMEZONE = 'Europe/Brussels'
+SERIALS_PER_SITE = 2
+END_TIME = datetime.datetime(2022, 7, 1)
+GENERATE_SECONDS = 0.0  # Time spent generating responses, excluded from the results
+PEAK_BLOCKS = 0  # Most blocks held at an emit, see run_scenario()
+
+# -------------------------- Synthetic responses ------------------------------
+
+
+@functools.lru_cache(maxsize=None)
+def load_fixture(name: str):
+    with open(os.path.join(FIXTURES_DIR, name), 'r') as f:
+        return f.read()
+
+
+def days_between(startTime: datetime.datetime, endTime: datetime.datetime):
+    day = startTime.date()
+    while day <= endTime.date():
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+# The fixture's values repeated for every day in the range, dates are 'YYYY-MM-DD HH:MM:SS'
+def repeat_values(values: list, startTime: datetime.datetime,
+                  endTime: datetime.datetime):
+    start = scraper.format_datetime_url(startTime)
+    end = scraper.format_datetime_url(endTime)
+    repeated = []
+    for day in days_between(startTime, endTime):
+        for value in values:
+            date = day.isoformat() + value['date'][10:]
+            if start <= date <= end:
+                repeated.append(dict(value, date=date))
+    return repeated
+
+
+def details_response(fixture: str, key: str, params: dict):
+    response = json.loads(load_fixture(fixture))
+    startTime = datetime.datetime.fromisoformat(params['startTime'])
+    endTime = datetime.datetime.fromisoformat(params['endTime'])
+    for meter in response[key]['meters']:
+        meter['values'] = repeat_values(meter['values'], startTime, endTime)
+    return json.dumps(response)
+
+
+def data_response(params: dict):
+    response = json.loads(load_fixture('equipmentData.json'))
+    telemetries = repeat_values(
+        response['data']['telemetries'],
+        datetime.datetime.fromisoformat(params['startTime']),
+        datetime.datetime.fromisoformat(params['endTime']))
+    response['data'] = {'count': len(telemetries), 'telemetries': telemetries}
+    return json.dumps(response)
+
+
+def data_period_response(sites: list, days: int):
+    period = {
+        'startDate': (END_TIME - datetime.timedelta(days=days)).date().isoformat(),
+        # The last day with data
+        'endDate': (END_TIME - datetime.timedelta(days=1)).date().isoformat()
+    }
+    return json.dumps({
+        'datePeriodList': {
+            'count': len(sites),
+            'siteEnergyList': [{
+                'siteId': int(site),
+                'dataPeriod': period
+            } for site in sites]
+        }
+    })
+
+
+PLAYBACK_DATE = re.compile(r"'\w{3} \w{3} \d\d (\d\d:\d\d:\d\d) GMT \d{4}'")
+
+
+# The weekly playback data is the fixture's day repeated for every day
+def playback_response(days: int):
+    fixture = load_fixture('playbackData.txt')
+    start = fixture.index('{', fixture.index('reportersData')) + 1
+    end = fixture.rindex('},fieldData')
+    dates = []
+    for day in days_between(END_TIME - datetime.timedelta(days=days),
+                            END_TIME - datetime.timedelta(days=1)):
+        prefix = day.strftime('%a %b %d')
+        suffix = day.strftime('%Y')
+        dates.append(
+            PLAYBACK_DATE.sub(lambda m: f"'{prefix} {m.group(1)} GMT {suffix}'",
+                              fixture[start:end]))
+    return fixture[:start] + ','.join(dates) + fixture[end:]
+
+
+class FakeResponse:
+
+    def __init__(self, text: str, url: str):
+        self.status_code = 200
+        self.url = url
+        self.headers = {}
+        self.text = text
+        self.content = text.encode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def fake_api_get(sites: list, days: int, path: str, params: dict = {}):
+    global GENERATE_SECONDS
+
+    started = time.perf_counter()
+    if path.endswith('/powerDetails.json'):
+        text = details_response('powerDetails.json', 'powerDetails', params)
+    elif path.endswith('/energyDetails.json'):
+        text = details_response('energyDetails.json', 'energyDetails', params)
+    elif path.startswith('/equipment/'):
+        text = data_response(params)
+    elif path.endswith('/dataPeriod.json'):
+        text = data_period_response(sites, days)
+    else:
+        raise ValueError(f'no synthetic response for {path}')
+    GENERATE_SECONDS += time.perf_counter() - started
+    return FakeResponse(text, f'{scraper.BASE_API_URL}{path}')
+
+
+def fake_ensure_logged_in(days: int, function, endpoint: str):
+    global GENERATE_SECONDS
+
+    started = time.perf_counter()
+    # The website serves at most a week
+    response = FakeResponse(playback_response(min(days, 7)),
+                            scraper.BASE_SITE_PANELS_URL)
+    GENERATE_SECONDS += time.perf_counter() - started
+    return response
+
+
+# ------------------------------ Scenarios ------------------------------------
+
+
+class CountingSink(io.TextIOBase):
+
+    def __init__(self):
+        self.bytes = 0
+        self.lines = 0
+
+    def write(self, s):
+        self.bytes += len(s)
+        self.lines += s.count('\n')
+        return len(s)
+
+
+def setup_scraper(sites: int, days: int, home: str):
+    siteIds = [str(1000000 + i) for i in range(sites)]
+    scraper.HOME_DIR = home
+    scraper.SITE_IDS = siteIds
+    scraper.SITES = ','.join(siteIds)
+    scraper.SERIALS = {
+        site: [f'{site[-4:]}{i:04}-{i:02X}' for i in range(SERIALS_PER_SITE)]
+        for site in siteIds
+    }
+    scraper.SITE_TIMEZONES = {site: TIMEZONE for site in siteIds}
+    scraper.HAS_OPTIMIZERS = {site: True for site in siteIds}
+    scraper.HAS_METERS = {site: True for site in siteIds}
+    scraper.LAST_UPDATES = {
+        endpoint: {site: END_TIME
+                   for site in siteIds}
+        for endpoint in ('power', 'energy', 'data', 'playback')
+    }
+    scraper.api_get = functools.partial(fake_api_get, siteIds, days)
+    scraper.ensure_logged_in = functools.partial(fake_ensure_logged_in, days)
+    # Only count the data points, as written by the output filter
+    scraper.EMIT_SCRAPER_STATS = False
+    scraper.solarEdgeOutputFilter.configure(scraper.OUTPUT_FILTER_RULES)
+    # The history scraper pauses between the chunks
+    scraper.time.sleep = lambda seconds: None
+
+
+def run_path(path: str, days: int):
+    startTime = END_TIME - datetime.timedelta(days=days)
+    if path == 'history':
+        scraper.scrape_full_history()
+        return
+    for site in scraper.SITE_IDS:
+        lines = []
+        if path == 'playback':
+            scraper.get_playback_data_site(list(range(-min(days, 7), 0)), site,
+                                           lines)
+        else:
+            function, maxDays = {
+                'power': (scraper.get_power_api, 28),
+                'energy': (scraper.get_energy_api, 28),
+                'data': (scraper.get_data_api, 7)
+            }[path]
+            for interval in scraper.get_date_intervals(startTime, END_TIME,
+                                                       maxDays):
+                function(site, interval[0], interval[1], lines)
+        scraper.write_lines(lines)
+
+
+# Runs one scenario in this process, returns its results
+def run_scenario(path: str, sites: int, days: int, repeat: int):
+    global GENERATE_SECONDS, PEAK_BLOCKS
+
+    write_lines = scraper.write_lines
+
+    def counting_write_lines(lines: list):
+        global PEAK_BLOCKS
+
+        PEAK_BLOCKS = max(PEAK_BLOCKS, sys.getallocatedblocks() - baseline)
+        write_lines(lines)
+
+    stdout, stderr = sys.stdout, sys.stderr
+    best = None
+    points = 0
+    with tempfile.TemporaryDirectory() as home:
+        setup_scraper(sites, days, home)
+        for attempt in range(repeat + 1):
+            for function in (scraper.line_series, scraper.local_hour_to_unix,
+                             scraper.playback_to_unix_timestamp):
+                function.cache_clear()
+            # Start from scratch: no journal, dedup index, rollups, archive or filter state
+            if scraper.STATE_DB is not None:
+                scraper.STATE_DB.close()
+            shutil.rmtree(home)
+            os.mkdir(home)
+            scraper.DEDUP_INDEX.clear()
+            scraper.solarEdgeOutputFilter.STATE.clear()
+            scraper.ROLLUP_STORE = None
+            scraper.initialize_state_store()
+            sink = CountingSink()
+            sys.stdout, sys.stderr = sink, CountingSink()
+            counting = attempt == repeat
+            if counting:
+                # Linux reports kB, the counted run is excluded as counting has overhead
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                scraper.write_lines = counting_write_lines
+                gc.collect()
+                PEAK_BLOCKS = 0
+                baseline = sys.getallocatedblocks()
+            GENERATE_SECONDS = 0.0
+            started = time.perf_counter()
+            try:
+                run_path(path, days)
+            finally:
+                elapsed = time.perf_counter() - started - GENERATE_SECONDS
+                sys.stdout, sys.stderr = stdout, stderr
+                scraper.write_lines = write_lines
+            if not counting:
+                best = elapsed if best is None else min(best, elapsed)
+            points, size = sink.lines, sink.bytes
+    return {
+        'path': path,
+        'sites': sites,
+        'days': days,
+        'points': points,
+        'bytes': size,
+        'points_per_s': points / best if best else 0.0,
+        'seconds': best,
+        'peak_rss_mb': rss,
+        'blocks_per_point': PEAK_BLOCKS / max(1, points)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paths', nargs='+', choices=PATHS, default=PATHS)
+    parser.add_argument('--sites', nargs='+', type=int, default=[1, 10])
+    parser.add_argument('--days', nargs='+', type=int, default=[1, 7])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='one JSON result per line')
+    # Internal: run a single scenario in this process
+    parser.add_argument('--scenario', nargs=3, metavar=('PATH', 'SITES', 'DAYS'))
+    args = parser.parse_args()
+
+    if args.scenario:
+        path, sites, days = args.scenario
+        print(json.dumps(run_scenario(path, int(sites), int(days), args.repeat)))
+        return
+
+    if not args.json:
+        print(f"{'path':10} {'sites':>5} {'days':>4} {'points':>10} {'points/s':>10}"
+              f" {'MB out':>8} {'peak RSS MB':>11} {'blocks/point':>12}")
+    for path in args.paths:
+        for sites in args.sites:
+            for days in args.days:
+                r = subprocess.run([
+                    sys.executable,
+                    os.path.abspath(__file__), '--scenario', path,
+                    str(sites),
+                    str(days), '--repeat',
+                    str(args.repeat)
+                ],
+                                   stdout=subprocess.PIPE,
+                                   check=True,
+                                   text=True)
+                if args.json:
+                    print(r.stdout, end='', flush=True)
+                    continue
+                result = json.loads(r.stdout)
+                print(f"{path:10} {sites:5} {days:4} {result['points']:10}"
+                      f" {result['points_per_s']:10,.0f} {result['bytes'] / 1e6:8.1f}"
+                      f" {result['peak_rss_mb']:11.1f}"
+                      f" {result['blocks_per_point']:12.2f}",
+                      flush=True)
+
+
+if __name__ == '__main__':
+    main()
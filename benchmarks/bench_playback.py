@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import json
+import time
+import datetime
+import argparse
+import tracemalloc
+# 3rd party dependencies:
+import pytz
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'telegraf'))
+import solarEdgeCloudScraper as scraper
+
+# Compares the single pass playback parser with the former approach: ~8 str.replace() passes over
+# the whole payload, json.loads() and a pytz.timezone()/strptime() for every date.
+#
+# Usage: bench_playback.py [--panels N] [--days N] [--repeat N]
+
+TIMEZONE = 'Europe/Brussels'
+
+
+# Synthetic playback payload in the format of the SolarEdge website
+def playback_payload(panels: int, days: int):
+    start = datetime.datetime(2022, 6, 1)
+    dates = []
+    for i in range(days * 96):
+        date = (start + datetime.timedelta(minutes=15 * i)).strftime(
+            '%a %b %d %H:%M:%S GMT %Y')
+        readings = ','.join(
+            f"{{key:'{100000 + panel}',value:'{(panel * 7 + i) % 400},{i % 10}'}}"
+            for panel in range(panels))
+        dates.append(f"'{date}':{{'-1000000':[{readings}]}}")
+    return ("{reportersData:{" + ','.join(dates) +
+            "},fieldData:{'-1000000':{}},timeUnit:'5'}")
+
+
+def legacy_readings(content: str, timezone: str):
+    response = content.replace('\'', '"').replace('Array', '').replace(
+        'key', '"key"').replace('value', '"value"')
+    response = response.replace('timeUnit', '"timeUnit"').replace(
+        'fieldData', '"fieldData"').replace('reportersData', '"reportersData"')
+    response = json.loads(response)
+    for date, sids in response["reportersData"].items():
+        timestamp = str(int((pytz.timezone(timezone).localize(
+            datetime.datetime.strptime(date, '%a %b %d %H:%M:%S GMT %Y')).astimezone(
+                pytz.utc)).timestamp())) + "000000000"
+        for values in sids.values():
+            for panel in values:
+                yield timestamp, panel['key'], panel['value']
+
+
+def single_pass_readings(content: str, timezone: str):
+    for date, readings in scraper.iter_playback_readings(content):
+        timestamp = scraper.playback_to_unix_timestamp(date, timezone)
+        for key, value in readings:
+            yield timestamp, key, value
+
+
+def measure(function, content: str, repeat: int):
+    best = None
+    for _ in range(repeat):
+        scraper.playback_to_unix_timestamp.cache_clear()
+        started = time.perf_counter()
+        count = sum(1 for _ in function(content, TIMEZONE))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    sum(1 for _ in function(content, TIMEZONE))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--panels', type=int, default=300)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    content = playback_payload(args.panels, args.days)
+    if list(legacy_readings(content, TIMEZONE)) != list(
+            single_pass_readings(content, TIMEZONE)):
+        print('Parsers disagree', file=sys.stderr)
+        exit(1)
+
+    print(f'payload: {len(content) / 1e6:.1f} MB, {args.panels} panels, {args.days} days')
+    results = {}
+    for name, function in (('legacy', legacy_readings), ('single pass',
+                                                          single_pass_readings)):
+        count, elapsed, peak = measure(function, content, args.repeat)
+        results[name] = elapsed
+        print(f'{name:12} {count / elapsed:12,.0f} readings/s'
+              f'  {elapsed:7.3f} s  peak {peak / 1e6:7.1f} MB')
+    print(f'speedup: {results["legacy"] / results["single pass"]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+
+import sys
+import re
+import json
+import math
+import time
+import random
+import signal
+import datetime
+import argparse
+import threading
+import http.server
+import urllib.parse
+
+# Local stand-in for the SolarEdge monitoring API and website, serves synthetic data for the
+# endpoints used by the cloud scraper: the API (sites/list.json, site/{id}/inventory,
+# powerDetails.json, energyDetails.json, the bulk power.json/energy.json, equipment/{site}/{sn}/data,
+# dataPeriod.json) and the website (login, playbackData, logical layout).
+#
+# Like the real cloud it enforces the per API key daily quota, the 3 concurrent API calls per
+# source IP and the maximum time range per call. Latency, throttling (429) and server errors (5xx)
+# can be injected. GET /simulator/stats returns the counters as JSON, they are printed on exit.
+#
+# Usage: cloud_simulator.py [--port N] [--sites N] [--inverters N] [--panels N] [--meterless N]
+#                           [--latency MS] [--throttle-rate P] [--error-rate P] [--quota N]
+#   then point the scraper at it:
+#   SOLAREDGE_BASE_API_URL=http://localhost:8080 SOLAREDGE_BASE_SITE_URL=http://localhost:8080 \
+#       ../telegraf/solarEdgeCloudScraper.py debug
+
+ARGS = None
+FIRST_SITE_ID = 1000000
+HISTORY_START = datetime.date(2020, 1, 1)
+METER_TYPES = ('Production', 'Consumption', 'SelfConsumption', 'FeedIn', 'Purchased')
+SITE_LIST_MAX = 100  # Sites per sites/list.json call
+MAX_DAYS = {'powerDetails': 31, 'energyDetails': 31, 'power': 31, 'energy': 31, 'data': 7}
+ERROR_STATUS = (500, 502, 503, 504)
+
+STATS_LOCK = threading.Lock()
+STATS = {
+    'requests': {},  # Endpoint: {status: count}
+    'quota_used': {},  # API key: calls today
+    'quota_exceeded': 0,
+    'concurrency_exceeded': 0,
+    'max_concurrent': 0,
+    'range_exceeded': 0
+}
+QUOTA_DAY = None
+IN_FLIGHT = 0
+WEB_SESSIONS = set()
+
+# ------------------------------ Synthetic data --------------------------------
+
+
+def site_ids():
+    return [str(FIRST_SITE_ID + i) for i in range(ARGS.sites)]
+
+
+def has_meters(site: str):
+    return int(site) - FIRST_SITE_ID < ARGS.sites - ARGS.meterless
+
+
+def serials(site: str):
+    return [f'{site[-4:]}{i:04}-{i:02X}' for i in range(ARGS.inverters)]
+
+
+# Production (W) of a site at a local time: a sine from 06:00 to 20:00, peaks differ per site
+def production_w(site: str, date: datetime.datetime):
+    hour = date.hour + date.minute / 60
+    if not 6 <= hour <= 20:
+        return 0.0
+    peak = 4000 + 100 * (int(site) % 20)
+    return round(peak * math.sin(math.pi * (hour - 6) / 14), 3)
+
+
+def consumption_w(date: datetime.datetime):
+    return round(300 + 200 * math.sin(math.pi * date.hour / 12)**2, 3)
+
+
+def meter_values(site: str, date: datetime.datetime):
+    production = production_w(site, date)
+    consumption = consumption_w(date)
+    selfConsumption = min(production, consumption)
+    return {
+        'Production': production,
+        'Consumption': consumption,
+        'SelfConsumption': selfConsumption,
+        'FeedIn': production - selfConsumption,
+        'Purchased': consumption - selfConsumption
+    }
+
+
+def parse_time(value: str):
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+def format_time(date: datetime.datetime):
+    return date.strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Local times from start to end (not in the future) at every step
+def times_between(start: datetime.datetime, end: datetime.datetime, step: datetime.timedelta):
+    date = datetime.datetime.min + -(-(start - datetime.datetime.min) // step) * step
+    end = min(end, datetime.datetime.now())
+    while date <= end:
+        yield date
+        date += step
+
+
+QUARTER = datetime.timedelta(minutes=15)
+
+
+def details_response(site: str, key: str, unit: str, factor: float, start, end):
+    values = {meter: [] for meter in METER_TYPES}
+    for date in times_between(start, end, QUARTER):
+        for meter, value in meter_values(site, date).items():
+            values[meter].append({'date': format_time(date), 'value': value * factor})
+    meters = METER_TYPES if has_meters(site) else ('Production', )
+    return {
+        key: {
+            'timeUnit': 'QUARTER_OF_AN_HOUR',
+            'unit': unit,
+            'meters': [{
+                'type': meter,
+                'values': values[meter]
+            } for meter in meters]
+        }
+    }
+
+
+def bulk_power_response(sites: list, start, end):
+    return {
+        'powerDateValuesList': {
+            'timeUnit': 'QUARTER_OF_AN_HOUR',
+            'unit': 'W',
+            'siteEnergyList': [{
+                'siteId': int(site),
+                'powerDataValueSeries': {
+                    'measuredBy': 'INVERTER',
+                    'values': [{
+                        'date': format_time(date),
+                        'value': production_w(site, date)
+                    } for date in times_between(start, end, QUARTER)]
+                }
+            } for site in sites]
+        }
+    }
+
+
+# Whole days, like the real endpoint
+def bulk_energy_response(sites: list, startDate: str, endDate: str):
+    start = datetime.datetime.fromisoformat(startDate)
+    end = datetime.datetime.fromisoformat(endDate) + datetime.timedelta(days=1) - QUARTER
+    return {
+        'sitesEnergy': {
+            'timeUnit': 'QUARTER_OF_AN_HOUR',
+            'unit': 'Wh',
+            'count': len(sites),
+            'siteEnergyList': [{
+                'siteId': int(site),
+                'energyValues': {
+                    'measuredBy': 'INVERTER',
+                    'values': [{
+                        'date': format_time(date),
+                        'value': production_w(site, date) / 4
+                    } for date in times_between(start, end, QUARTER)]
+                }
+            } for site in sites]
+        }
+    }
+
+
+def phase_data(power: float):
+    return {
+        'acCurrent': round(power / 3 / 230, 4),
+        'acVoltage': 230.5,
+        'acFrequency': 50.01,
+        'apparentPower': round(power / 3, 3),
+        'activePower': round(power / 3, 3),
+        'reactivePower': 0.0,
+        'cosPhi': 1.0
+    }
+
+
+# A telemetry every 5 minutes of a three phase inverter
+def data_response(site: str, start, end):
+    telemetries = []
+    for date in times_between(start, end, datetime.timedelta(minutes=5)):
+        power = production_w(site, date) / ARGS.inverters
+        telemetries.append({
+            'date': format_time(date),
+            'totalActivePower': power,
+            'dcVoltage': 750.2 if power else None,
+            'groundFaultResistance': None,
+            'powerLimit': 100.0,
+            'totalEnergy': 1000000.0 + (date - datetime.datetime(2020, 1, 1)).days * 20000.0,
+            'temperature': round(25 + power / 500, 4),
+            'inverterMode': 'MPPT' if power else 'SLEEPING',
+            'operationMode': 0,
+            'vL1To2': 399.1,
+            'vL2To3': 400.3,
+            'vL3To1': 401.2,
+            'L1Data': phase_data(power),
+            'L2Data': phase_data(power),
+            'L3Data': phase_data(power)
+        })
+    return {'data': {'count': len(telemetries), 'telemetries': telemetries}}
+
+
+def data_period_response(sites: list):
+    return {
+        'datePeriodList': {
+            'count': len(sites),
+            'siteEnergyList': [{
+                'siteId': int(site),
+                'dataPeriod': {
+                    'startDate': HISTORY_START.isoformat(),
+                    'endDate': datetime.date.today().isoformat()
+                }
+            } for site in sites]
+        }
+    }
+
+
+def site_list_response(size: int, startIndex: int):
+    sites = site_ids()
+    return {
+        'sites': {
+            'count': len(sites),
+            'site': [{
+                'id': int(site),
+                'name': f'Site {site}',
+                'type': 'Optimizers & Inverters',
+                'location': {
+                    'timeZone': ARGS.timezone
+                }
+            } for site in sites[startIndex:startIndex + min(size, SITE_LIST_MAX)]]
+        }
+    }
+
+
+def inventory_response(site: str):
+    return {
+        'Inventory': {
+            'meters': [{
+                'name': 'Feed In Meter',
+                'type': 'FeedIn'
+            }] if has_meters(site) else [],
+            'sensors': [],
+            'gateways': [],
+            'batteries': [],
+            'inverters': [{
+                'name': f'Inverter {i + 1}',
+                'manufacturer': 'SolarEdge',
+                'model': 'SE10K',
+                'SN': serial
+            } for i, serial in enumerate(serials(site))]
+        }
+    }
+
+
+def panel_ids(site: str):
+    return [f'{site[-3:]}{panel:05}' for panel in range(ARGS.panels)]
+
+
+# The website uses the locale of the account, '0' when there is no reading
+def decimal_comma(value: float):
+    return str(round(value, 2)).replace('.', ',') if value else '0'
+
+
+# Panels differ a few % from each other
+def panel_factor(panel: int):
+    return 0.95 + (panel * 37 % 10) / 100
+
+
+# timeUnit 4: today, 5: the last week
+def playback_response(site: str, timeUnit: str):
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    start = today - datetime.timedelta(days=6 if timeUnit == '5' else 0)
+    dates = []
+    for date in times_between(start, today + datetime.timedelta(days=1) - QUARTER, QUARTER):
+        w = production_w(site, date) / ARGS.panels
+        readings = ','.join(f"{{key:'{panel}',value:'{decimal_comma(w * panel_factor(i))}'}}"
+                            for i, panel in enumerate(panel_ids(site)))
+        dates.append(
+            f"'{date.strftime('%a %b %d %H:%M:%S GMT %Y')}':{{'-1000000':[{readings}]}}")
+    return ("{reportersData:{" + ','.join(dates) +
+            "},fieldData:{'-1000000':{}},timeUnit:'" + timeUnit + "'}")
+
+
+def layout_response(site: str):
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    measured = now - datetime.timedelta(minutes=now.minute % 15)
+    w = production_w(site, measured) / ARGS.panels
+    return {
+        'reportersInfo': {
+            panel: {
+                'lastMeasurementDate': measured.strftime('%a %b %d %H:%M:%S GMT %Y'),
+                'localizedMeasurements': {
+                    'Optimizer Voltage [V]': '40,1',
+                    'Voltage [V]': '33,5' if w else '1,0',
+                    'Current [A]': decimal_comma(w * panel_factor(i) / 33.5),
+                    'Power [W]': decimal_comma(w * panel_factor(i))
+                }
+            }
+            for i, panel in enumerate(panel_ids(site))
+        }
+    }
+
+
+# ------------------------------ Server ----------------------------------------
+
+
+def count_request(endpoint: str, status: int):
+    with STATS_LOCK:
+        statuses = STATS['requests'].setdefault(endpoint, {})
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+
+# Draws a call from the daily quota of the key (UTC), returns False once it is used up
+def use_quota(key: str):
+    global QUOTA_DAY
+
+    with STATS_LOCK:
+        today = datetime.datetime.utcnow().date()
+        if today != QUOTA_DAY:
+            QUOTA_DAY = today
+            STATS['quota_used'] = {}
+        used = STATS['quota_used'].get(key, 0) + 1
+        STATS['quota_used'][key] = used
+        if used > ARGS.quota:
+            STATS['quota_exceeded'] += 1
+            return False
+        return True
+
+
+def range_days(query: dict, start: str, end: str):
+    return (datetime.datetime.fromisoformat(query[end][:10]) -
+            datetime.datetime.fromisoformat(query[start][:10])).days
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if ARGS.verbose:
+            super().log_message(format, *args)
+
+    def send(self, status: int, body, contentType='application/json', cookies=[]):
+        if not isinstance(body, (str, bytes)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for cookie in cookies:
+            self.send_header('Set-Cookie', cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Latency and injected failures, returns the injected status or None
+    def inject(self):
+        if ARGS.latency:
+            time.sleep(ARGS.latency / 1000 * random.uniform(0.5, 1.5))
+        draw = random.random()
+        if draw < ARGS.throttle_rate:
+            return 429
+        if draw < ARGS.throttle_rate + ARGS.error_rate:
+            return random.choice(ERROR_STATUS)
+        return None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/simulator/stats':
+            with STATS_LOCK:
+                self.send(200, STATS)
+            return
+        if url.path.startswith('/solaredge-apigw/api/sites/'):
+            self.handle_web(url.path, {})
+            return
+        self.handle_api(url.path, query)
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode('utf-8')))
+        self.handle_web(url.path, form)
+
+    def handle_api(self, path: str, query: dict):
+        global IN_FLIGHT
+
+        # e.g. '/site/123/powerDetails.json' -> 'powerDetails'
+        endpoint = path.rsplit('/', 1)[-1].split('.')[0]
+        with STATS_LOCK:
+            IN_FLIGHT += 1
+            STATS['max_concurrent'] = max(STATS['max_concurrent'], IN_FLIGHT)
+            concurrent = IN_FLIGHT
+        try:
+            if concurrent > ARGS.max_concurrent:
+                with STATS_LOCK:
+                    STATS['concurrency_exceeded'] += 1
+                status, body = 429, {'String': 'Too many concurrent requests'}
+            elif not use_quota(query.get('api_key', '')):
+                status, body = 429, {'String': 'Daily quota exceeded'}
+            else:
+                status, body = self.inject() or 200, None
+                if status == 200:
+                    status, body = self.api_response(path, endpoint, query)
+            if body is None:
+                body = {'String': http.server.BaseHTTPRequestHandler.responses[status][0]}
+            count_request(endpoint, status)
+            self.send(status, body)
+        finally:
+            with STATS_LOCK:
+                IN_FLIGHT -= 1
+
+    def api_response(self, path: str, endpoint: str, query: dict):
+        parts = path.strip('/').split('/')
+        if endpoint in MAX_DAYS and {'startTime', 'endTime'} <= query.keys():
+            if range_days(query, 'startTime', 'endTime') > MAX_DAYS[endpoint]:
+                with STATS_LOCK:
+                    STATS['range_exceeded'] += 1
+                return 403, {'String': f'{endpoint}: time range too long'}
+        if endpoint == 'energy' and range_days(query, 'startDate', 'endDate') > MAX_DAYS['energy']:
+            with STATS_LOCK:
+                STATS['range_exceeded'] += 1
+            return 403, {'String': 'energy: time range too long'}
+
+        if parts == ['sites', 'list.json']:
+            return 200, site_list_response(int(query.get('size', SITE_LIST_MAX)),
+                                           int(query.get('startIndex', 0)))
+        sites = parts[1].split(',') if len(parts) > 1 else []
+        if any(site not in site_ids() for site in sites):
+            return 403, {'String': 'Invalid site'}
+        if len(parts) == 3 and parts[0] == 'site':
+            site = sites[0]
+            if parts[2] == 'inventory':
+                return 200, inventory_response(site)
+            if parts[2] == 'powerDetails.json':
+                return 200, details_response(site, 'powerDetails', 'W', 1.0,
+                                             parse_time(query['startTime']),
+                                             parse_time(query['endTime']))
+            if parts[2] == 'energyDetails.json':
+                return 200, details_response(site, 'energyDetails', 'Wh', 0.25,
+                                             parse_time(query['startTime']),
+                                             parse_time(query['endTime']))
+        if len(parts) == 3 and parts[0] == 'sites':
+            if parts[2] == 'power.json':
+                return 200, bulk_power_response(sites, parse_time(query['startTime']),
+                                                parse_time(query['endTime']))
+            if parts[2] == 'energy.json':
+                return 200, bulk_energy_response(sites, query['startDate'], query['endDate'])
+            if parts[2] == 'dataPeriod.json':
+                return 200, data_period_response(sites)
+        if len(parts) == 4 and parts[0] == 'equipment' and parts[3] == 'data':
+            if parts[2] not in serials(sites[0]):
+                return 403, {'String': 'Invalid serial number'}
+            return 200, data_response(sites[0], parse_time(query['startTime']),
+                                      parse_time(query['endTime']))
+        return 404, None
+
+    # The website is not rate limited, a session cookie is needed for everything but the login
+    def handle_web(self, path: str, form: dict):
+        endpoint = path.rsplit('/', 1)[-1]
+        session = re.search(r'SPRING_SECURITY_REMEMBER_ME_COOKIE=(\w+)',
+                            self.headers.get('Cookie', ''))
+        status = self.inject()
+        body, contentType, cookies = '', 'text/html', []
+        if status is not None:
+            pass
+        elif endpoint == 'login':
+            token = f'{random.getrandbits(64):016x}'
+            with STATS_LOCK:
+                WEB_SESSIONS.add(token)
+            status = 200
+            cookies = [f'SPRING_SECURITY_REMEMBER_ME_COOKIE={token}; Path=/',
+                       'CSRF-TOKEN=simulated; Path=/']
+        elif session is None or session.group(1) not in WEB_SESSIONS:
+            status = 401
+        elif endpoint == 'playbackData' and form.get('fieldId') in site_ids():
+            status, contentType = 200, 'text/javascript'
+            body = playback_response(form['fieldId'], form.get('timeUnit', '4'))
+        elif endpoint == 'logical' and path.split('/')[-3] in site_ids():
+            status, contentType = 200, 'application/json'
+            body = layout_response(path.split('/')[-3])
+        else:
+            status = 404
+        count_request(endpoint, status)
+        self.send(status, body, contentType, cookies)
+
+
+def print_stats():
+    with STATS_LOCK:
+        print(json.dumps(STATS, indent=2, sort_keys=True), flush=True)
+
+
+def main():
+    global ARGS
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--sites', type=int, default=10)
+    parser.add_argument('--inverters', type=int, default=2, help='per site')
+    parser.add_argument('--panels', type=int, default=24, help='per site')
+    parser.add_argument('--meterless', type=int, default=0,
+                        help='sites without meters (served by the bulk endpoints)')
+    parser.add_argument('--timezone', default='Europe/Brussels')
+    parser.add_argument('--latency', type=float, default=0.0, help='ms, per request +-50%%')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of 429s')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 5xx')
+    parser.add_argument('--quota', type=int, default=300, help='API calls per key per day')
+    parser.add_argument('--max-concurrent', type=int, default=3, help='concurrent API calls')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    ARGS = parser.parse_args()
+    random.seed(ARGS.seed)
+
+    server = http.server.ThreadingHTTPServer((ARGS.host, ARGS.port), Handler)
+    server.daemon_threads = True
+    # Also when started in the background, which ignores SIGINT
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: sys.exit(0))
+    print(f'SolarEdge cloud simulator on http://{ARGS.host}:{server.server_port}'
+          f' ({ARGS.sites} sites)', file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        print_stats()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,40 @@
 
 import json
 import datetime
+import asyncio
 import codecs
 import sys
 import os
 import time
 import ast
 import getpass
+import concurrent.futures
+import threading
+import random
+import fcntl
+import contextlib
+import functools
+import gzip
+import queue
+import re
+import sqlite3
+import collections
+import subprocess
+import signal
+import array
+import bisect
+import operator
+import statistics
+import cProfile
+import pstats
+import tracemalloc
+import io
 # 3rd party dependencies:
 import requests
 import pytz
 
+import solarEdgeOutputFilter
+
 # Stand-alone daemon managed by Telegraf.
 # Up to date with: Monitoring server API version January 2019
 # Note: document does not correspond to reality
@@ -22,10 +46,26 @@ import pytz
 SETTING_API_KEY = ''
 SETTING_SITE_USERNAME = ''
 SETTING_SITE_PW = ''
+# Several accounts instead of the settings above, eg:
+# {'name': 'owner1', 'api_key': '...', 'username': '...', 'password': '...'}
+# Every account runs in its own worker process with its own quota, state and sessions, the output
+# of all workers is merged. Names are used as directory names. At most ACCOUNT_WORKERS accounts
+# are busy at once, see supervise_accounts().
+ACCOUNTS = []
 # Args:
 # - 'history' to scrape the past history from the cloud
+#   (written to INFLUXDB_WRITE_URL instead of stdout if set), 'history full' to import it all again
+# - 'replay' to write the archived responses again, without network access
 # - 'debug' to run the update loop once
+# - 'profile' to run the update loop once and report where the time went, see profile_cycle()
+# - 'poll' to poll every POLL_INTERVAL_MIN (or slower if the quota requires) instead of once a day
 # - No args to run the daily loop
+# With ACCOUNTS the args are passed on to the worker of every account.
+# Env:
+# - SOLAREDGE_BASE_API_URL, SOLAREDGE_BASE_SITE_URL to use another cloud than SolarEdge's,
+#   eg, benchmarks/cloud_simulator.py
+# - SOLAREDGE_PROFILE to profile every job of the daemon (history: every chunk), eg, 'spans' or
+#   'cprofile,tracemalloc', see PROFILE_OPTIONS
 
 # -----------------------------------------------------------------------
 
@@ -33,24 +73,154 @@ SETTING_SITE_PW = ''
 # hence some of it has to be scraped from their website. As a bonus
 # their API is rate limited but their website is not (or a much higher limit?).
 
-BASE_SITE_PANELS_URL = 'https://monitoring.solaredge.com/solaredge-web/p/playbackData'
-SITE_LOGIN_URL = 'https://monitoring.solaredge.com/solaredge-apigw/api/login'
-BASE_API_URL = 'https://monitoringapi.solaredge.com'
+BASE_SITE_URL = os.environ.get('SOLAREDGE_BASE_SITE_URL', 'https://monitoring.solaredge.com')
+BASE_SITE_PANELS_URL = f'{BASE_SITE_URL}/solaredge-web/p/playbackData'
+BASE_SITE_LAYOUT_URL = f'{BASE_SITE_URL}/solaredge-apigw/api/sites'
+SITE_LOGIN_URL = f'{BASE_SITE_URL}/solaredge-apigw/api/login'
+BASE_API_URL = os.environ.get('SOLAREDGE_BASE_API_URL', 'https://monitoringapi.solaredge.com')
+SITE_LIST_PAGE_SIZE = 100  # Max sites per call
 REQUEST_TIMEOUT = 60
+# Transient failures (connection errors, timeouts, 429 and 5xx) are retried with
+# exponential backoff and full jitter: sleep random(0, min(MAX, BASE * 2^attempt)).
+REQUEST_RETRIES = 5
+REQUEST_RETRY_STATUS = (429, 500, 502, 503, 504)
+REQUEST_BACKOFF_BASE = 2.0
+REQUEST_BACKOFF_MAX = 300.0
 SITE_COOKIE_FILE = 'solaredge.com.cookies'
+# Watermarks, inventory, site metadata, the API quota ledger and the history journal, see
+# initialize_state_store()
+STATE_DB_FILE = 'state.db'
+STATE_SCHEMA_VERSION = 6
+STATE_DB = None
+STATE_LOCK = threading.Lock()  # The history scraper also writes from the InfluxDB writer thread
+INVENTORY_REFRESH_DAYS = 7
+# Files of older versions, migrated into STATE_DB_FILE
 LAST_SUCCESSFUL_UPDATE_FILE = 'lastupdated'
 INSTALLATION_INFO_FILE = 'installinfo'
+QUOTA_LEDGER_FILE = 'apiquota'
+HISTORY_JOURNAL_FILE = 'historyjournal'
+ROLLUP_STORE_FILE = 'rollups'
 SITE_IDS = []
 SITES = ''  # Same as SITE_IDS but as string
 SERIALS = {}
 SITE_TIMEZONES = {}
 HAS_OPTIMIZERS = {}
+HAS_METERS = {}  # Sites without meters only report production, see get_power_bulk_api()
 LAST_UPDATES = {}
 HOME_DIR = ''
-HISTORY_SCRAPER_MAX_API_CALLS = 280  # Limit is 300/day, take some margin
+# Shared keep-alive sessions, one per host (see initialize_sessions()).
+API_SESSION = None
+WEB_SESSION = None
+WEB_LOGIN_LOCK = threading.Lock()
+WEB_LOGIN_GENERATION = 0  # 0: not logged in, increases with every login
+# Every API call (including retries) is drawn from a ledger shared by all processes
+# using the same HOME_DIR. Backfill calls can never use the calls the daily loop needs.
+API_DAILY_QUOTA = 295  # Limit is 300/day, take some margin
+# SolarEdge does not document the timezone of its daily reset.
+API_QUOTA_TIMEZONE = 'UTC'
+PRIORITY_DAILY = 0
+PRIORITY_BACKFILL = 1
+QUOTA_CONTEXT = threading.local()  # .priority of the calls made by this thread
+# SolarEdge allows at most 3 concurrent API calls from the same source IP.
+FETCH_WORKERS = 3
+# The worker of an account has it set to its name, its HOME_DIR is a subdirectory of ACCOUNTS_DIR.
+ACCOUNT_ENV = 'SOLAREDGE_ACCOUNT'
+ACCOUNTS_DIR = 'accounts'
+ACCOUNT_RESTART_DELAY = 60  # s
+ACCOUNT_WORKERS = os.cpu_count() or 1
+API_SLOTS_DIR = None  # Shared by the workers of all accounts, see api_call_slot()
+OUTPUT_LOCK = threading.Lock()
+# Max number of sites in one call to the bulk (multi-site) endpoints.
+API_BULK_MAX_SITES = 100
 # Data is updated once a day at this interval. Assumed to be at the ~end of the day.
 UPDATE_INTERVAL_HOUR = 23
 UPDATE_INTERVAL_MIN = 50
+# Poll mode: the cloud updates every 15 minutes. Data younger than POLL_DELAY_MIN is not fetched
+# yet as not all of it has been uploaded. POLL_QUOTA_SHARE of the daily quota is used for polling,
+# the rest is left for the history scraper.
+POLL_INTERVAL_MIN = 15
+POLL_DELAY_MIN = 30
+POLL_QUOTA_SHARE = 0.8
+POLL_MODE = False
+# The daily cloud job runs this many times a day (every 24 h / CLOUD_SLOTS from its first run), the
+# sites are spread over the runs so their API calls are too. See cloud_slot_sites().
+CLOUD_SLOTS = 4
+# Job: (minutes between runs, first run of the day in local time, quota priority), see run_job().
+# In poll mode the cloud job runs every poll_interval(). Runs missed while the scraper was down are
+# caught up once at start. Every run starts up to SCHEDULE_JITTER_MIN later than scheduled.
+SCHEDULE = {
+    'cloud': (24 * 60 // CLOUD_SLOTS, f'{UPDATE_INTERVAL_HOUR:02}:{UPDATE_INTERVAL_MIN:02}',
+              PRIORITY_DAILY),
+    'playback': (24 * 60, '23:40', PRIORITY_DAILY),  # Website, not part of the API quota
+    'inventory': (24 * 60, '12:00', PRIORITY_DAILY),
+    'backfill': (24 * 60, '02:00', PRIORITY_BACKFILL),  # Only with SCHEDULE_BACKFILL
+}
+SCHEDULE_JITTER_MIN = 5
+# Imports the history (see scrape_full_history()) in the background, as far as the quota left
+# by the other jobs allows every day. Written to INFLUXDB_WRITE_URL if set: a night's backfill
+# can be more than Telegraf buffers (metric_buffer_limit).
+SCHEDULE_BACKFILL = False
+# Max number of lines written to stdout in one go.
+EMIT_BATCH_LINES = 4096
+# History mode and the backfill job can write straight to InfluxDB instead of through Telegraf,
+# e.g.:
+# 'http://influxdb:8086/write?db=solaredge_cloud&precision=ns'
+INFLUXDB_WRITE_URL = ''
+INFLUXDB_BATCH_BYTES = 1024 * 1024  # Uncompressed
+INFLUXDB_MAX_PENDING_BATCHES = 4  # Producers block when this many batches are waiting
+INFLUXDB_SESSION = None
+INFLUXDB_QUEUE = None  # Batches (bytes) and checkpoints (functions), see start_influxdb_writer()
+INFLUXDB_WRITER = None
+INFLUXDB_FAILED = False
+INFLUXDB_PENDING = []  # Lines not yet in a batch
+INFLUXDB_PENDING_BYTES = 0
+# Emit the 'scraper_stats' measurement (requests, parsing, quota and watermark lag) after every run
+EMIT_SCRAPER_STATS = True
+STATS_LOCK = threading.Lock()
+STATS_CONTEXT = threading.local()  # .endpoint last requested and .request_seconds of this thread
+ENDPOINT_STATS = {}  # Endpoint: {field: value}, since the last stats_lines()
+# Emit daily and monthly rollups of the energy, power and panel measurements, see rollup_lines()
+EMIT_ROLLUPS = True
+ROLLUP_OPEN_DAYS = 8  # Days that can still receive data (playback covers a week), their points are kept
+ROLLUP_KEEP_DAYS = 430  # Daily results are kept to recompute the months, > the 400 days retention
+ROLLUP_STORE = None  # See load_rollup_store()
+PANEL_READING_INTERVAL = 900  # s, used when a day has a single panel reading
+
+EMIT_PANEL_STATS = True
+PANEL_STATS_MIN_PANELS = 3  # Sites with fewer producing panels on a day are not compared
+UNDERPERFORMER_DEVIATION = -10.0  # %, panels yielding less than this below the site median
+PANEL_IDS = {}  # Site: the optimizers in its last playback data, also those that never report
+# Deadband, precision and night filter of the written measurements, see solarEdgeOutputFilter.py.
+# Measurement: {'keyframe': s, 'sleep': (field, value)}, {} writes every point as is. Energy and
+# power are never filtered, their points are summed.
+OUTPUT_FILTER_RULES = {'data': {'keyframe': 3600, 'sleep': ('I_AC_Power', 0.0)}}
+# Lines of a series at or before the last timestamp delivered for it are not written again,
+# per namespace as the history scraper goes back in time. See deduplicate().
+DEDUP_DAILY = 'daily'
+DEDUP_HISTORY = 'history'
+DEDUP_MAX_SERIES = 50000  # Per namespace, the least recently delivered series are forgotten
+DEDUP_INDEX = {}  # Namespace: OrderedDict of series: last delivered timestamp (ns)
+DEDUP_SUPPRESSED = {}  # Namespace: lines suppressed since the last stats_lines()
+DEDUP_LOCK = threading.Lock()
+# Every response is kept in the archive directory, see archive_response() and the 'replay' mode
+ARCHIVE_RESPONSES = True
+ARCHIVE_DIR = 'archive'
+ARCHIVE_SEGMENT_BYTES = 8 * 1024 * 1024  # Compressed, segments are replayed in parallel
+# Segments of responses older than this many days are removed daily. 0 (the default) keeps
+# everything: a replay can then rebuild all data, pruned days are beyond its reach.
+ARCHIVE_KEEP_DAYS = 0
+ARCHIVE_LOCK = threading.Lock()
+REPLAY_WORKERS = min(4, os.cpu_count() or 1)
+# Profiled cycles report the wall-clock time per phase (fetch, parse, format, emit) to stderr and to
+# the profile directory. Options: 'spans' only the phases, 'cprofile' adds the time per function
+# (a .prof file for pstats/snakeviz), 'tracemalloc' the allocations (a .tracemalloc snapshot).
+PROFILE_ENV = 'SOLAREDGE_PROFILE'
+PROFILE_MODE_OPTIONS = {'spans', 'cprofile'}  # 'profile' mode without SOLAREDGE_PROFILE
+PROFILE_OPTIONS = set()  # Of the daemon, from SOLAREDGE_PROFILE
+PROFILE_DIR = 'profile'
+PROFILE_KEEP_FILES = 100  # The oldest reports are removed
+PROFILE_TOP_FUNCTIONS = 30
+PROFILE = None  # Of the running cycle, see profile_cycle()
 
 # ------------------------------ Utils -----------------------------------------
 
@@ -89,11 +259,6 @@ def print_err(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-# In ns
-def to_unix_timestamp(date: str):
-    return f"{int(datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S').timestamp())}000000000"
-
-
 def safe_str_to_float(num: str):
     # A better way is to know the used locale and convert, alas it is not exposed by SolarEdge cloud.
     if num.find(",") != -1 and num.find(
@@ -102,22 +267,16 @@ def safe_str_to_float(num: str):
     return float(num.replace(",", "."))
 
 
+# Consecutive intervals share their boundary, no day may fall in between two intervals.
 def get_date_intervals(start: datetime.datetime, end: datetime.datetime,
                        maxDays: int):
     intervals = []
 
-    days = (end - start).days
     prev = start
-    while True:
-        if days <= (maxDays + 1):
-            intervals.append((prev, prev + datetime.timedelta(days=days)))
-            break
-
-        days -= maxDays + 1  # +1 because we want no overlaps between the intervals
-
-        next = prev + datetime.timedelta(days=maxDays)
+    while prev < end:
+        next = min(prev + datetime.timedelta(days=maxDays), end)
         intervals.append((prev, next))
-        prev = next + datetime.timedelta(days=1)
+        prev = next
 
     return intervals
 
@@ -147,13 +306,1310 @@ def parse_datetime_dict(astr, debug=False):
     return eval(astr)
 
 
-def format_L_data(data, label: str):
-    if 'cosPhi' in data:
-        return f",I_{label}_AC_Voltage={data['acVoltage']},I_{label}_AC_Current={data['acCurrent']},I_{label}_AC_PF={data['cosPhi']},I_{label}_AC_Freq={data['acFrequency']},I_{label}_AC_VAR={data['reactivePower']},I_{label}_AC_VA={data['apparentPower']},I_{label}_AC_Power={data['activePower']}"
+# ------------------------------ Profiling -------------------------------------
+
+
+def add_span(phase: str, seconds: float):
+    with STATS_LOCK:
+        PROFILE['seconds'][phase] += seconds
+        PROFILE['calls'][phase] += 1
+
+
+# Decorator adding the wall-clock time of every call to the phase, while a cycle is profiled
+def profiled(phase: str):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if PROFILE is None:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_span(phase, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+# cProfile only follows the thread that enabled it before Python 3.12, the fetch workers get their
+# own profiler which is merged into the report. Python 3.12+ refuses (one profiler follows all).
+def start_thread_profiler():
+    if (PROFILE is None or PROFILE['profiler'] is None
+            or threading.get_ident() == PROFILE['thread']):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+    return profiler
+
+
+def stop_thread_profiler(profiler):
+    if profiler is not None:
+        profiler.disable()
+        with STATS_LOCK:
+            PROFILE['profilers'].append(profiler)
+
+
+def prune_profile_reports(directory: str):
+    names = sorted(os.listdir(directory),
+                   key=lambda name: os.path.getmtime(os.path.join(directory, name)))
+    for name in names[:-PROFILE_KEEP_FILES]:
+        os.remove(os.path.join(directory, name))
+
+
+# Writes <name>-<time>.txt (the phases, the top functions and allocations) and the raw .prof and
+# .tracemalloc files, returns the summary of the phases
+def write_profile_report(name: str, wall: float, profile: dict, snapshot):
+    directory = os.path.join(HOME_DIR, PROFILE_DIR)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory,
+                        f"{name}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}")
+
+    # Fetch and parse run in FETCH_WORKERS threads, their sum can exceed the wall-clock time
+    summary = [f'{name}: {wall:.3f} s wall-clock']
+    for phase in ('fetch', 'parse', 'format', 'emit'):
+        seconds = profile['seconds'][phase]
+        summary.append(
+            f'  {phase:6} {seconds:9.3f} s {100 * seconds / max(wall, 1e-9):6.1f} %'
+            f' {profile["calls"][phase]:7} calls')
+    report = summary[:]
+
+    if profile['profiler'] is not None:
+        text = io.StringIO()
+        stats = pstats.Stats(profile['profiler'], stream=text)
+        for profiler in profile['profilers']:
+            stats.add(profiler)
+        stats.dump_stats(path + '.prof')
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        stats.sort_stats('tottime').print_stats(PROFILE_TOP_FUNCTIONS)
+        report.append(text.getvalue())
+
+    if snapshot is not None:
+        snapshot.dump(path + '.tracemalloc')
+        report.append(f"Peak traced memory: {profile['traced_peak'] / 1024 / 1024:.1f} MiB")
+        report += [str(stat) for stat in snapshot.statistics('lineno')[:PROFILE_TOP_FUNCTIONS]]
+
+    with open(path + '.txt', 'w') as f:
+        f.write('\n'.join(report) + '\n')
+    prune_profile_reports(directory)
+    return summary
+
+
+# Profiles everything run in the block as one cycle named name, see PROFILE_OPTIONS. Cycles started
+# within a profiled cycle are part of it.
+@contextlib.contextmanager
+def profile_cycle(name: str, options: set):
+    global PROFILE
+
+    if not options or PROFILE is not None:
+        yield
+        return
+    PROFILE = {
+        'seconds': collections.Counter(),
+        'calls': collections.Counter(),
+        'thread': threading.get_ident(),
+        'profiler': cProfile.Profile() if 'cprofile' in options else None,
+        'profilers': [],  # Of the fetch workers
+        'traced_peak': 0
+    }
+    tracing = 'tracemalloc' in options and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    started = time.perf_counter()
+    if PROFILE['profiler'] is not None:
+        PROFILE['profiler'].enable()
+    try:
+        yield
+    finally:
+        if PROFILE['profiler'] is not None:
+            PROFILE['profiler'].disable()
+        wall = time.perf_counter() - started
+        snapshot = None
+        if tracing:
+            PROFILE['traced_peak'] = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        profile, PROFILE = PROFILE, None
+        try:
+            for line in write_profile_report(name, wall, profile, snapshot):
+                print_err(f'SolarEdge Cloud: Profile: {line}')
+        except OSError as e:
+            print_err(f'SolarEdge Cloud: Profile: failed to write the report: {e}')
+
+
+# --------------------------- Line protocol ------------------------------------
+
+# Field templates: (JSON key, escaped 'field=' prefix), in output order.
+DATA_FIELDS = (('temperature', 'I_Temp='), ('totalEnergy', 'I_AC_Energy_WH='),
+               ('totalActivePower', 'I_AC_Power='), ('dcVoltage',
+                                                      'I_DC_Voltage='))
+# Note: not all data is logged; see Json/API for all available options
+L_DATA_FIELDS = {
+    label: tuple((key, f'I_{label}_{field}=')
+                 for key, field in (('acVoltage', 'AC_Voltage'),
+                                    ('acCurrent', 'AC_Current'),
+                                    ('cosPhi', 'AC_PF'),
+                                    ('acFrequency', 'AC_Freq'),
+                                    ('reactivePower', 'AC_VAR'),
+                                    ('apparentPower', 'AC_VA'),
+                                    ('activePower', 'AC_Power')))
+    for label in ('L1', 'L2', 'L3')
+}
+
+
+@functools.lru_cache(maxsize=None)
+def escape_key(key: str):
+    return key.replace('\\', '\\\\').replace(',', '\\,').replace(
+        '=', '\\=').replace(' ', '\\ ')
+
+
+# Measurement and escaped tags, tags is a tuple of (key, value) pairs
+@functools.lru_cache(maxsize=4096)
+def line_series(measurement: str, tags: tuple):
+    return measurement.replace(',', '\\,').replace(' ', '\\ ') + ''.join(
+        f',{escape_key(k)}={escape_key(str(v))}' for k, v in tags)
+
+
+def format_field_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, str):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return str(value)
+
+
+# Appends 'field=value' for every template whose key is present and not None
+def format_fields(fields: list, data: dict, template: tuple):
+    for key, prefix in template:
+        value = data.get(key)
+        if value is None:
+            continue
+        if type(value) is float:  # Fast path, nearly all values are floats
+            fields.append(f'{prefix}{value}')
+        else:
+            fields.append(prefix + format_field_value(value))
+
+
+# Compiles the fields, [(path, prefix)] with path a tuple of keys into the data, into a single
+# f-string: lambda d: f"prefix1{d[k1]},prefix2{d[k2][k3]},...". Values must be present and numeric.
+def compile_fields_template(fields: list):
+    expr = ','.join(prefix.replace('{', '{{').replace('}', '}}') + '{d' +
+                    ''.join(f'[{key!r}]' for key in path) + '}'
+                    for path, prefix in fields)
+    return eval(f'lambda d: f{expr!r}')
+
+
+# The data fields present in a telemetry differ per inverter type, shape describes them:
+# (has dcVoltage, for L1..L3: None if absent else whether it has cosPhi)
+@functools.lru_cache(maxsize=256)
+def data_fields_template(shape: tuple):
+    fields = [((key, ), prefix) for key, prefix in DATA_FIELDS
+              if key != 'dcVoltage' or shape[0]]
+    for (label, template), present in zip(L_DATA_FIELDS.items(), shape[1:]):
+        if present is not None:
+            fields += [((label + 'Data', key), prefix)
+                       for key, prefix in template
+                       if key != 'cosPhi' or present]
+    return compile_fields_template(fields)
+
+
+def format_data_fields(value: dict):
+    shape = (value.get('dcVoltage') is not None, ) + tuple(
+        None if label + 'Data' not in value else 'cosPhi' in value[label + 'Data']
+        for label in L_DATA_FIELDS)
+    try:
+        formatted = data_fields_template(shape)(value)
+        if 'None' not in formatted:
+            return formatted
+    except KeyError:
+        pass
+    # Missing or null values, only format what is there
+    fields = []
+    format_fields(fields, value, DATA_FIELDS)
+    for label, template in L_DATA_FIELDS.items():
+        if label + 'Data' in value:
+            format_fields(fields, value[label + 'Data'], template)
+    return ','.join(fields)
+
+
+# The data fields of a telemetry as {name: value}, for the output filter. Null values are left out.
+def data_field_values(value: dict):
+    fields = {
+        prefix[:-1]: value[key]
+        for key, prefix in DATA_FIELDS if value.get(key) is not None
+    }
+    for label, template in L_DATA_FIELDS.items():
+        data = value.get(label + 'Data')
+        if data is not None:
+            fields.update((prefix[:-1], data[key]) for key, prefix in template
+                          if data.get(key) is not None)
+    return fields
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name: str):
+    return pytz.timezone(name)
+
+
+# Unix time of the start of the local hour 'YYYY-MM-DD HH'. DST changes happen on the hour.
+@functools.lru_cache(maxsize=65536)
+def local_hour_to_unix(hour: str, timezone: str):
+    local = datetime.datetime(int(hour[0:4]), int(hour[5:7]), int(hour[8:10]),
+                              int(hour[11:13]))
+    return int(get_timezone(timezone).localize(local).timestamp())
+
+
+# Dates are in '%Y-%m-%d %H:%M:%S', local time of the site. Result in ns.
+def local_to_unix_timestamp(date: str, timezone: str):
+    return f"{local_hour_to_unix(date[:13], timezone) + int(date[14:16]) * 60 + int(date[17:19])}000000000"
+
+
+def to_unix_timestamp(date: str, site: str):
+    return local_to_unix_timestamp(date, SITE_TIMEZONES[site])
+
+
+# Write to Telegraf in batches, every line ends up in one write() call with its neighbours
+@profiled('emit')
+def write_lines(lines: list):
+    if INFLUXDB_QUEUE is not None:
+        queue_influxdb_lines(lines)
+        return
+    for i in range(0, len(lines), EMIT_BATCH_LINES):
+        sys.stdout.write('\n'.join(lines[i:i + EMIT_BATCH_LINES]))
+        sys.stdout.write('\n')
+
+
+# ------------------------------ HTTP ------------------------------------------
+
+
+def backoff_delay(attempt: int):
+    return random.uniform(
+        0, min(REQUEST_BACKOFF_MAX, REQUEST_BACKOFF_BASE * 2**attempt))
+
+
+def new_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=FETCH_WORKERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Sends a request (a function returning a Response) and retries transient failures.
+# The last response is returned as is, the last exception is re-raised.
+# Endpoint is the name under which the request shows up in 'scraper_stats'.
+def send_with_retry(send, endpoint: str):
+    attempt = 0
+    started = time.perf_counter()
+    STATS_CONTEXT.endpoint = endpoint
+    try:
+        while True:
+            sent = time.perf_counter()
+            try:
+                r = send()
+                record_attempt_stats(endpoint, time.perf_counter() - sent, r)
+                if r.status_code not in REQUEST_RETRY_STATUS or attempt == REQUEST_RETRIES:
+                    record_request_stats(endpoint, attempt, r.status_code)
+                    return r
+                reason = f"HTTP {r.status_code}"
+                delay = backoff_delay(attempt)
+                retry_after = r.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, min(float(retry_after), REQUEST_BACKOFF_MAX))
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                record_attempt_stats(endpoint, time.perf_counter() - sent, None)
+                if attempt == REQUEST_RETRIES:
+                    record_request_stats(endpoint, attempt, None)
+                    raise
+                reason = str(e)
+                delay = backoff_delay(attempt)
+            attempt += 1
+            print_err(
+                f"SolarEdge Cloud: {reason}, retry {attempt}/{REQUEST_RETRIES} in {delay:.1f}s"
+            )
+            time.sleep(delay)
+    finally:
+        # Time spent waiting for the cloud, see run_instrumented()
+        STATS_CONTEXT.request_seconds = getattr(
+            STATS_CONTEXT, 'request_seconds', 0.0) + time.perf_counter() - started
+
+
+# The workers of all accounts together make at most FETCH_WORKERS API calls at once, each call
+# holds a lock on one of the slot files.
+def api_call_slot():
+    return account_slot('apislot', FETCH_WORKERS)
+
+
+# Holds a lock on one of count slot files shared by the workers of all accounts, waits for a free
+# one. Does nothing without ACCOUNTS.
+@contextlib.contextmanager
+def account_slot(prefix: str, count: int):
+    if API_SLOTS_DIR is None:
+        yield
+        return
+    while True:
+        for slot in range(count):
+            with open(os.path.join(API_SLOTS_DIR, f'{prefix}{slot}'), 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                yield
+                return
+        time.sleep(0.05)
+
+
+def api_get(path: str, params: dict = {}):
+    params = dict(params, api_key=SETTING_API_KEY)
+
+    def send():
+        acquire_api_call()
+        with api_call_slot():
+            return API_SESSION.get(f"{BASE_API_URL}{path}",
+                                   params=params,
+                                   timeout=REQUEST_TIMEOUT)
+
+    # e.g. '/site/123/powerDetails.json' -> 'powerDetails'
+    return send_with_retry(send, path.rsplit('/', 1)[-1].split('.')[0])
+
+
+# ----------------------------- API quota -----------------------------------
+
+
+def quota_day():
+    return datetime.datetime.now(pytz.timezone(API_QUOTA_TIMEZONE)).date()
+
+
+def seconds_until_quota_refill():
+    tz = pytz.timezone(API_QUOTA_TIMEZONE)
+    now = datetime.datetime.now(tz)
+    refill = tz.localize(
+        datetime.datetime.combine(now.date() + datetime.timedelta(days=1),
+                                  datetime.time()))
+    return (refill - now).total_seconds()
+
+
+# Number of API calls update_all_data() makes, these are reserved for the daily loop
+def daily_api_calls():
+    bulk_sites = len(bulk_site_ids())
+    single_sites = len(SITE_IDS) - bulk_sites
+    bulk_calls = -(-bulk_sites // API_BULK_MAX_SITES)
+    return 2 * (single_sites + bulk_calls) + sum(
+        len(s) for s in SERIALS.values())
+
+
+# The daily loop can reserve more calls than a single run needs through the ledger (poll mode)
+def quota_limit(priority: int, ledger: dict):
+    if priority == PRIORITY_DAILY:
+        return API_DAILY_QUOTA
+    return max(0,
+               API_DAILY_QUOTA - ledger.get('reserve', daily_api_calls()))
+
+
+# Locks the ledger for this thread and process (an immediate transaction on STATE_DB, shared with
+# a history run) and yields it as {'day': str, 'used': int, optional 'reserve': int}.
+# Changes made to the ledger are committed when the context exits.
+@contextlib.contextmanager
+def quota_ledger():
+    with STATE_LOCK:
+        STATE_DB.execute('BEGIN IMMEDIATE')
+        try:
+            row = STATE_DB.execute('SELECT day, used, reserve FROM quota').fetchone()
+            today = quota_day().isoformat()
+            ledger = {'day': today, 'used': 0}
+            if row is not None and row[0] == today:
+                ledger['used'] = row[1]
+                if row[2] is not None:
+                    ledger['reserve'] = row[2]
+            stored = dict(ledger)
+            yield ledger
+            if ledger != stored or row is None or row[0] != today:
+                store_quota_ledger(ledger)
+            STATE_DB.commit()
+        except BaseException:
+            STATE_DB.rollback()
+            raise
+
+
+def store_quota_ledger(ledger: dict):
+    STATE_DB.execute('DELETE FROM quota')
+    STATE_DB.execute('INSERT INTO quota VALUES (?, ?, ?)',
+                     (ledger['day'], ledger['used'], ledger.get('reserve')))
+
+
+def remaining_api_calls(priority: int = PRIORITY_DAILY):
+    with quota_ledger() as ledger:
+        return max(0, quota_limit(priority, ledger) - ledger['used'])
+
+
+def backfill_api_calls_per_day():
+    with quota_ledger() as ledger:
+        return quota_limit(PRIORITY_BACKFILL, ledger)
+
+
+# Reserves calls for the daily loop until the refill, on top of the calls already used
+def reserve_api_calls(calls: int):
+    with quota_ledger() as ledger:
+        ledger['reserve'] = ledger['used'] + calls
+
+
+# Blocks until an API call is available for the priority of the calling thread.
+def acquire_api_call():
+    priority = getattr(QUOTA_CONTEXT, 'priority', PRIORITY_DAILY)
+    while True:
+        with quota_ledger() as ledger:
+            if ledger['used'] < quota_limit(priority, ledger):
+                ledger['used'] += 1
+                return
+        delay = seconds_until_quota_refill() + 1.0
+        print_err(
+            f"SolarEdge Cloud: API quota exhausted, waiting {delay:.0f}s for the refill"
+        )
+        flush()
+        time.sleep(delay)
+
+
+# ---------------------------- Scraper stats -----------------------------------
+
+
+def endpoint_stats(endpoint: str):
+    return ENDPOINT_STATS.setdefault(
+        endpoint, {
+            'requests': 0,
+            'errors': 0,
+            'retries': 0,
+            'attempts': 0,
+            'latency': 0.0,
+            'latency_max': 0.0,
+            'bytes': 0,
+            'status': 0,
+            'points': 0,
+            'parse_time': 0.0
+        })
+
+
+# A single round trip, response is None if it failed without one
+def record_attempt_stats(endpoint: str, latency: float, response):
+    with STATS_LOCK:
+        stats = endpoint_stats(endpoint)
+        stats['attempts'] += 1
+        stats['latency'] += latency
+        stats['latency_max'] = max(stats['latency_max'], latency)
+        if response is not None:
+            stats['bytes'] += len(response.content)
+            stats['status'] = response.status_code
+
+
+# A request including its retries, status is None if it failed without a response
+def record_request_stats(endpoint: str, retries: int, status):
+    with STATS_LOCK:
+        stats = endpoint_stats(endpoint)
+        stats['requests'] += 1
+        stats['retries'] += retries
+        if status is None or status >= 400:
+            stats['errors'] += 1
+
+
+# Runs a fetch function, the time it did not spend waiting on the cloud is its parse time.
+# Its points and parse time are accounted to the last endpoint it requested.
+def run_instrumented(function, args, lines: list):
+    STATS_CONTEXT.endpoint = None
+    STATS_CONTEXT.request_seconds = 0.0
+    profiler = start_thread_profiler()
+    started = time.perf_counter()
+    try:
+        return function(*args, lines)
+    finally:
+        parse_time = time.perf_counter() - started - STATS_CONTEXT.request_seconds
+        stop_thread_profiler(profiler)
+        if PROFILE is not None:
+            add_span('fetch', STATS_CONTEXT.request_seconds)
+            add_span('parse', parse_time)
+        if STATS_CONTEXT.endpoint is not None:
+            with STATS_LOCK:
+                stats = endpoint_stats(STATS_CONTEXT.endpoint)
+                stats['points'] += len(lines)
+                stats['parse_time'] += parse_time
+
+
+# Measurement and tags of a 'scraper_stats' line. The workers of ACCOUNTS add an account tag, their
+# output is merged.
+def stats_series(tags: tuple = ()):
+    account = os.environ.get(ACCOUNT_ENV)
+    if account is not None:
+        tags = (('account', account), ) + tags
+    return line_series('scraper_stats', tags)
+
+
+# The 'scraper_stats' lines of everything since the previous call:
+# - per endpoint: requests, errors, retries, mean and max latency (s), bytes, last HTTP status,
+#   points and parse time (s)
+# - per site: the lag (s) of every watermark
+# - per dedup namespace: the duplicate lines suppressed and the series in the index
+# - of the output filter: the lines, points and bytes in and out and the points and bytes saved
+# - the duration (s) of the run, the API calls used today and the calls remaining for priority
+@profiled('format')
+def stats_lines(duration: float,
+                priority: int = PRIORITY_DAILY,
+                watermarks: bool = True):
+    with STATS_LOCK:
+        endpoints = ENDPOINT_STATS.copy()
+        ENDPOINT_STATS.clear()
+        suppressed = DEDUP_SUPPRESSED.copy()
+        DEDUP_SUPPRESSED.clear()
+    timestamp = time.time_ns()
+
+    lines = []
+    for endpoint, stats in sorted(endpoints.items()):
+        lines.append(
+            f"{stats_series((('endpoint', endpoint), ))}"
+            f" requests={stats['requests']}i,errors={stats['errors']}i,retries={stats['retries']}i"
+            f",latency={stats['latency'] / max(1, stats['attempts'])},latency_max={stats['latency_max']}"
+            f",bytes={stats['bytes']}i,status={stats['status']}i,points={stats['points']}i"
+            f",parse_time={stats['parse_time']} {timestamp}")
+
+    now = datetime.datetime.now()
+    for site in SITE_IDS if watermarks else []:
+        fields = [
+            f'{endpoint}_lag={(now - LAST_UPDATES[endpoint][site]).total_seconds()}'
+            for endpoint in ('power', 'energy', 'data', 'playback')
+            if site in LAST_UPDATES.get(endpoint, {})
+        ]
+        panels = LAST_UPDATES.get('optimizer', {}).get(site)
+        if panels:
+            fields.append(
+                f'optimizer_lag={float(int(time.time()) - max(panels.values()))}')
+        if fields:
+            lines.append(
+                f"{stats_series((('site', site), ))} {','.join(fields)} {timestamp}"
+            )
+
+    for namespace, duplicates in sorted(suppressed.items()):
+        lines.append(
+            f"{stats_series((('dedup', namespace), ))}"
+            f" duplicates={duplicates}i,series={len(DEDUP_INDEX.get(namespace, ()))}i {timestamp}"
+        )
+
+    if OUTPUT_FILTER_RULES:
+        lines.append(
+            f"{stats_series((('filter', 'output'), ))} {solarEdgeOutputFilter.stats_fields()}"
+            f" {timestamp}")
+
+    with quota_ledger() as ledger:
+        used = ledger['used']
+        remaining = max(0, quota_limit(priority, ledger) - used)
+    lines.append(
+        f'{stats_series()} duration={duration},quota_used={used}i,quota_remaining={remaining}i'
+        f' {timestamp}')
+    return lines
+
+
+# ---------------------------- InfluxDB writer ---------------------------------
+
+
+def post_influxdb_batch(batch: bytes):
+    r = send_with_retry(lambda: INFLUXDB_SESSION.post(
+        INFLUXDB_WRITE_URL,
+        data=batch,
+        headers={
+            'Content-Encoding': 'gzip',
+            'Content-Type': 'text/plain; charset=utf-8'
+        },
+        timeout=REQUEST_TIMEOUT), 'influxdb')
+    if r.status_code != 204:
+        print_err(f"InfluxDB: write: HTTP {r.status_code} : {r.text.strip()}")
+        return False
+    return True
+
+
+# Writes the queued batches in order. A checkpoint is only run once all batches queued before it
+# are written, after a failed write no checkpoint is run anymore.
+def influxdb_writer():
+    global INFLUXDB_FAILED
+
+    while True:
+        item = INFLUXDB_QUEUE.get()
+        try:
+            if item is None:
+                return
+            if INFLUXDB_FAILED:
+                continue
+            if callable(item):
+                item()
+            else:
+                try:
+                    INFLUXDB_FAILED = not post_influxdb_batch(item)
+                except requests.exceptions.RequestException as e:
+                    print_err(f"InfluxDB: write failed: {e}")
+                    INFLUXDB_FAILED = True
+        finally:
+            INFLUXDB_QUEUE.task_done()
+
+
+def start_influxdb_writer():
+    global INFLUXDB_SESSION, INFLUXDB_QUEUE, INFLUXDB_WRITER, INFLUXDB_FAILED
+
+    INFLUXDB_FAILED = False
+    INFLUXDB_SESSION = new_session()
+    INFLUXDB_QUEUE = queue.Queue(maxsize=INFLUXDB_MAX_PENDING_BATCHES)
+    INFLUXDB_WRITER = threading.Thread(target=influxdb_writer, daemon=True)
+    INFLUXDB_WRITER.start()
+
+
+def queue_influxdb_batch():
+    global INFLUXDB_PENDING, INFLUXDB_PENDING_BYTES
+
+    if INFLUXDB_PENDING:
+        INFLUXDB_QUEUE.put(
+            gzip.compress('\n'.join(INFLUXDB_PENDING).encode('utf-8'),
+                          compresslevel=5))
+        INFLUXDB_PENDING = []
+        INFLUXDB_PENDING_BYTES = 0
+
+
+# Blocks while INFLUXDB_MAX_PENDING_BATCHES batches are waiting to be written
+def queue_influxdb_lines(lines: list):
+    global INFLUXDB_PENDING_BYTES
+
+    for line in lines:
+        INFLUXDB_PENDING.append(line)
+        INFLUXDB_PENDING_BYTES += len(line) + 1
+        if INFLUXDB_PENDING_BYTES >= INFLUXDB_BATCH_BYTES:
+            queue_influxdb_batch()
+
+
+# Waits for all queued batches, returns whether all of them were written
+def stop_influxdb_writer():
+    global INFLUXDB_QUEUE
+
+    queue_influxdb_batch()
+    INFLUXDB_QUEUE.put(None)
+    INFLUXDB_WRITER.join()
+    INFLUXDB_QUEUE = None
+    return not INFLUXDB_FAILED
+
+
+# Runs function once everything written so far has been delivered
+def checkpoint(function):
+    if INFLUXDB_QUEUE is not None:
+        queue_influxdb_batch()
+        INFLUXDB_QUEUE.put(function)
     else:
-        return f",I_{label}_AC_Voltage={data['acVoltage']},I_{label}_AC_Current={data['acCurrent']},I_{label}_AC_Freq={data['acFrequency']},I_{label}_AC_VAR={data['reactivePower']},I_{label}_AC_VA={data['apparentPower']},I_{label}_AC_Power={data['activePower']}"
+        flush()
+        function()
+
+
+# ------------------------------ Rollups ---------------------------------------
+
+
+# Daily results of a day of {unix time: value}
+def energy_day(points: dict):
+    return {'wh': sum(points.values())}
+
+
+def power_day(points: dict):
+    return {'w_max': max(points.values())}
+
+
+# Every reading counts until the next one, at most the reading interval (readings of 0 are not
+# emitted, so the longer gaps are without production)
+def panel_day(points: dict):
+    times = sorted(points)
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    interval = min(gaps) if gaps else PANEL_READING_INTERVAL
+    wh = 0.0
+    for i, t in enumerate(times):
+        wh += points[t] * min(gaps[i] if i < len(gaps) else interval,
+                              interval) / 3600
+    return {'wh': wh, 'w_max': max(points.values())}
+
+
+ROLLUPS = {'energy': energy_day, 'power': power_day, 'panel': panel_day}
+# How the daily results add up to a month
+MONTHLY_FIELDS = {'wh': sum, 'w_max': max}
+
+
+# Local date of the quarter of an hour since the epoch, all UTC offsets are a multiple of it
+@functools.lru_cache(maxsize=65536)
+def quarter_hour_to_local_date(quarter: int, timezone: str):
+    return datetime.datetime.fromtimestamp(quarter * 900,
+                                           get_timezone(timezone)).date().isoformat()
+
+
+@functools.lru_cache(maxsize=4096)
+def local_midnight_to_unix(day: str, timezone: str):
+    return int(get_timezone(timezone).localize(
+        datetime.datetime.fromisoformat(day)).timestamp())
+
+
+# {'open': {series: {day: {unix time: value}}}, 'daily': {series: {day: {field: value}}}}, loaded
+# once from the rollups table of the state store
+def load_rollup_store():
+    global ROLLUP_STORE
+
+    if ROLLUP_STORE is None:
+        ROLLUP_STORE = {'open': {}, 'daily': {}}
+        for series, day, points, fields in STATE_DB.execute(
+                'SELECT series, day, points, fields FROM rollups'):
+            if points is not None:
+                ROLLUP_STORE['open'].setdefault(series, {})[day] = {
+                    int(t): value
+                    for t, value in json.loads(points).items()
+                }
+            ROLLUP_STORE['daily'].setdefault(series, {})[day] = json.loads(fields)
+    return ROLLUP_STORE
+
+
+# Upserts the changed (series, day), the points of days before openFrom and the days before
+# keepFrom are dropped
+def save_rollup_days(changed: set, openFrom: str, keepFrom: str):
+    rows = []
+    for series, day in changed:
+        fields = ROLLUP_STORE['daily'].get(series, {}).get(day)
+        if fields is None:
+            continue  # Past the retention
+        points = ROLLUP_STORE['open'].get(series, {}).get(day)
+        rows.append((series, day,
+                     None if points is None else json.dumps(points, separators=(',', ':')),
+                     json.dumps(fields, separators=(',', ':'))))
+    with STATE_LOCK, STATE_DB:
+        STATE_DB.executemany('INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?)', rows)
+        STATE_DB.execute(
+            'UPDATE rollups SET points = NULL WHERE points IS NOT NULL AND day < ?',
+            (openFrom, ))
+        STATE_DB.execute('DELETE FROM rollups WHERE day < ?', (keepFrom, ))
+
+
+def rollup_line(series: str, suffix: str, fields: dict, timestamp: int):
+    measurement = series[:series.index(',')]
+    return (f"{measurement}{suffix}{series[len(measurement):]} "
+            f"{','.join(f'{name}={value}' for name, value in fields.items())} {timestamp}000000000")
+
+
+# Returns the rollup lines of the days (local time of the site) and months the lines touch:
+# energy_daily/_monthly (wh), power_daily/_monthly (w_max) and panel_daily/_monthly (wh, w_max).
+# The points of the last ROLLUP_OPEN_DAYS are kept so late data is merged; older days are only
+# fetched by the history scraper, in whole days, so their points replace the day.
+@profiled('format')
+def rollup_lines(lines: list):
+    store = load_rollup_store()
+    touched = {}  # (series, day): {unix time: value}
+    for line in lines:
+        if line[:line.find(',')] not in ROLLUPS:
+            continue
+        series, field, timestamp = line.rsplit(' ', 2)
+        site = series.split(',site=', 1)[1].split(',', 1)[0]
+        unix = int(timestamp) // 1000000000
+        day = quarter_hour_to_local_date(unix // 900, SITE_TIMEZONES[site])
+        touched.setdefault((series, day), {})[unix] = float(field[field.index('=') + 1:])
+    if not touched:
+        return []
+
+    today = datetime.date.today()
+    openFrom = (today - datetime.timedelta(days=ROLLUP_OPEN_DAYS)).isoformat()
+    result = []
+    months = set()
+    for (series, day), points in sorted(touched.items()):
+        if day >= openFrom:
+            points = store['open'].setdefault(series, {}).setdefault(day, {})
+            points.update(touched[(series, day)])
+        fields = ROLLUPS[series[:series.index(',')]](points)
+        store['daily'].setdefault(series, {})[day] = fields
+        site = series.split(',site=', 1)[1].split(',', 1)[0]
+        result.append(
+            rollup_line(series, '_daily', fields,
+                        local_midnight_to_unix(day, SITE_TIMEZONES[site])))
+        months.add((series, day[:7]))
+
+    for series, month in sorted(months):
+        days = [
+            fields for day, fields in store['daily'][series].items()
+            if day.startswith(month)
+        ]
+        fields = {
+            name: MONTHLY_FIELDS[name](day[name] for day in days)
+            for name in days[0]
+        }
+        site = series.split(',site=', 1)[1].split(',', 1)[0]
+        result.append(
+            rollup_line(series, '_monthly', fields,
+                        local_midnight_to_unix(f'{month}-01',
+                                               SITE_TIMEZONES[site])))
+
+    # Forget the points of closed days and the results of days past the retention
+    keepFrom = (today - datetime.timedelta(days=ROLLUP_KEEP_DAYS)).isoformat()
+    for kind, since in (('open', openFrom), ('daily', keepFrom)):
+        for series in list(store[kind]):
+            days = store[kind][series]
+            for day in [day for day in days if day < since]:
+                del days[day]
+            if not days:
+                del store[kind][series]
+    save_rollup_days(set(touched), openFrom, keepFrom)
+    return result
+
+
+# ------------------------------ Panel stats -----------------------------------
+
+
+# Yield (Wh) of every row of a panels x timestamps matrix, a reading counts until the next
+# timestamp, at most the reading interval (see panel_day())
+def panel_yields(rows: list, timestamps: list):
+    gaps = [b - a for a, b in zip(timestamps, timestamps[1:])]
+    interval = min(gaps) if gaps else PANEL_READING_INTERVAL
+    weights = array.array('d', (min(gap, interval) / 3600 for gap in gaps))
+    weights.append(interval / 3600)
+    return [sum(map(operator.mul, row, weights)) for row in rows]
+
+
+# Percentile rank (0-100) of every value: the share of the values below it, ties count half
+def percentile_ranks(values: list):
+    ordered = sorted(values)
+    return [(bisect.bisect_left(ordered, value) + bisect.bisect_right(ordered, value)) *
+            50.0 / len(ordered) for value in values]
+
+
+# Returns the panel_stats lines of the sites and days (local time of the site) in the playback
+# lines, timestamped at the local midnight starting the day. Per panel: yield (wh), percentile
+# rank within the site (percentile), deviation from the site median in % (deviation) and
+# underperformer; per site: panels, median_wh, min_wh, max_wh, mismatch (coefficient of variation
+# of the yields in %) and underperformers.
+# A day fetched again (weekly playback after the daily) is recomputed and overwrites the points.
+# Panels of PANEL_IDS without readings that day (dead optimizers) count as yielding 0 Wh.
+@profiled('format')
+def panel_stats_lines(lines: list):
+    days = {}  # (site, day): {panel series: {unix time: w}}
+    for line in lines:
+        if not line.startswith('panel,'):
+            continue
+        series, field, timestamp = line.rsplit(' ', 2)
+        site = series.split(',site=', 1)[1].split(',', 1)[0]
+        unix = int(timestamp) // 1000000000
+        day = quarter_hour_to_local_date(unix // 900, SITE_TIMEZONES[site])
+        days.setdefault((site, day), {}).setdefault(series, {})[unix] = float(
+            field[field.index('=') + 1:])
+
+    result = []
+    for (site, day), panels in sorted(days.items()):
+        series = line_series('panel', (('site', site), ))
+        for panel in PANEL_IDS.get(site, ()):
+            panels.setdefault(f'{series},id={escape_key(panel)}', {})
+        if len(panels) < PANEL_STATS_MIN_PANELS:
+            continue
+        # Columnar: one row per panel, one column per timestamp, 0 when a panel did not report
+        timestamps = sorted({t for points in panels.values() for t in points})
+        columns = {t: i for i, t in enumerate(timestamps)}
+        names = sorted(panels)
+        rows = []
+        for name in names:
+            row = array.array('d', bytes(8 * len(timestamps)))
+            for t, w in panels[name].items():
+                row[columns[t]] = w
+            rows.append(row)
+
+        yields = panel_yields(rows, timestamps)
+        median = statistics.median(yields)
+        if median <= 0:
+            continue
+        ranks = percentile_ranks(yields)
+        deviations = [(wh - median) * 100 / median for wh in yields]
+        underperformers = [deviation < UNDERPERFORMER_DEVIATION for deviation in deviations]
+        timestamp = local_midnight_to_unix(day, SITE_TIMEZONES[site])
+        for name, wh, rank, deviation, flagged in zip(names, yields, ranks, deviations,
+                                                      underperformers):
+            result.append(
+                f"panel_stats{name[len('panel'):]} wh={wh},percentile={rank},"
+                f"deviation={deviation},underperformer={'true' if flagged else 'false'}"
+                f" {timestamp}000000000")
+        result.append(
+            f"{line_series('panel_stats', (('site', site), ))} panels={len(yields)}i,"
+            f"median_wh={median},min_wh={min(yields)},max_wh={max(yields)},"
+            f"mismatch={statistics.pstdev(yields) * 100 / statistics.fmean(yields)},"
+            f"underperformers={sum(underperformers)}i {timestamp}000000000")
+    return result
+
+
+# ------------------------------ State store -----------------------------------
+
+STATE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS sites (
+    site TEXT PRIMARY KEY, position INTEGER, timezone TEXT, has_optimizers INTEGER,
+    has_meters INTEGER);
+CREATE TABLE IF NOT EXISTS serials (
+    site TEXT, position INTEGER, serial TEXT, PRIMARY KEY (site, serial));
+-- Datetimes (naive, local time) are stored in ISO format, unix times as integers.
+-- Key is '' for per site watermarks, the panel (optimizer) or serial (serial) for finer ones.
+CREATE TABLE IF NOT EXISTS watermarks (
+    endpoint TEXT, site TEXT, key TEXT, value, PRIMARY KEY (endpoint, site, key));
+-- Since version 2, see deduplicate(). Used orders the series by their last delivery.
+CREATE TABLE IF NOT EXISTS delivered (
+    namespace TEXT, series TEXT, timestamp INTEGER, used INTEGER,
+    PRIMARY KEY (namespace, series));
+-- Since version 3, see archive_response(). One gzip member of a segment file per response, site
+-- holds all sites of a bulk response, the times are NULL for snapshots (playback, layout).
+CREATE TABLE IF NOT EXISTS archive (
+    segment INTEGER, offset INTEGER, length INTEGER, endpoint TEXT, site TEXT,
+    start_time TEXT, end_time TEXT, args TEXT, fetched INTEGER);
+CREATE INDEX IF NOT EXISTS archive_key ON archive (site, endpoint, start_time);
+-- Since version 4, see rollup_lines(). JSON, points are {unix time: value} of the open days (NULL
+-- once closed), fields the daily results.
+CREATE TABLE IF NOT EXISTS rollups (
+    series TEXT, day TEXT, points TEXT, fields TEXT, PRIMARY KEY (series, day));
+-- Since version 5, see quota_ledger(). A single row: the API calls used on the quota day and those
+-- reserved for the daily loop (NULL if none).
+CREATE TABLE IF NOT EXISTS quota (day TEXT, used INTEGER, reserve INTEGER);
+-- Since version 6, see scrape_full_history(). The completed history chunks.
+CREATE TABLE IF NOT EXISTS history_chunks (
+    site TEXT, endpoint TEXT, start TEXT, end TEXT, PRIMARY KEY (site, endpoint, start));
+'''
 
 
+# Should only be called once
+def initialize_state_store():
+    global STATE_DB
+
+    STATE_DB = sqlite3.connect(os.path.join(HOME_DIR, STATE_DB_FILE),
+                               timeout=60,
+                               check_same_thread=False)
+    with STATE_DB:
+        STATE_DB.executescript(STATE_SCHEMA)
+        row = STATE_DB.execute(
+            "SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+        if row is None:
+            STATE_DB.execute(
+                "INSERT INTO meta VALUES ('schema_version', ?)",
+                (STATE_SCHEMA_VERSION, ))
+        elif row[0] > STATE_SCHEMA_VERSION:
+            print_err(
+                f"SolarEdge Cloud: {STATE_DB_FILE} has schema version {row[0]}, only up to"
+                f" {STATE_SCHEMA_VERSION} is supported, exiting.")
+            flush_and_exit(1)
+        elif row[0] < STATE_SCHEMA_VERSION:
+            # The tables added since are created above
+            STATE_DB.execute(
+                "UPDATE meta SET value = ? WHERE key = 'schema_version'",
+                (STATE_SCHEMA_VERSION, ))
+    migrate_state_files()
+
+
+# Imports the files of older versions, which are renamed to *.migrated afterwards
+def migrate_state_files():
+    path = os.path.join(HOME_DIR, INSTALLATION_INFO_FILE)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            info = ast.literal_eval(f.read())
+        # Older caches do not know about meters, assume there are some
+        info.setdefault('HAS_METERS', {site: True for site in info['SITE_IDS']})
+        # Refresh on the next start to pick up equipment changes since
+        store_installation_info(info, datetime.datetime.min)
+        os.replace(path, path + '.migrated')
+
+    path = os.path.join(HOME_DIR, LAST_SUCCESSFUL_UPDATE_FILE)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            lastUpdates = parse_datetime_dict(f.read())
+        # Per site and panel, absent in files written by older versions
+        lastUpdates.setdefault('optimizer', {})
+        store_last_updated(lastUpdates)
+        os.replace(path, path + '.migrated')
+
+    path = os.path.join(HOME_DIR, QUOTA_LEDGER_FILE)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            content = f.read()
+        try:
+            ledger = json.loads(content)
+        except ValueError:
+            ledger = None
+        if not isinstance(ledger, dict) or not {'day', 'used'} <= ledger.keys():
+            # Torn write, the calls used are unknown
+            print_err(f"SolarEdge Cloud: {QUOTA_LEDGER_FILE} is damaged, assuming the API quota"
+                      f" of today is used up")
+            ledger = {'day': quota_day().isoformat(), 'used': API_DAILY_QUOTA}
+        with STATE_LOCK, STATE_DB:
+            store_quota_ledger(ledger)
+        os.replace(path, path + '.migrated')
+
+    path = os.path.join(HOME_DIR, HISTORY_JOURNAL_FILE)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            # A torn last line is left out, that chunk is fetched again
+            rows = [fields for fields in map(str.split, f) if len(fields) == 4]
+        with STATE_LOCK, STATE_DB:
+            STATE_DB.executemany(
+                'INSERT INTO history_chunks VALUES (?, ?, ?, ?) ON CONFLICT DO UPDATE'
+                ' SET end = MAX(end, excluded.end)', rows)
+        os.replace(path, path + '.migrated')
+
+    path = os.path.join(HOME_DIR, ROLLUP_STORE_FILE)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            store = json.load(f)
+        rows = {(series, day): [None, json.dumps(fields, separators=(',', ':'))]
+                for series, days in store['daily'].items() for day, fields in days.items()}
+        for series, days in store['open'].items():
+            for day, points in days.items():
+                if (series, day) in rows:
+                    rows[(series, day)][0] = json.dumps(points, separators=(',', ':'))
+        with STATE_LOCK, STATE_DB:
+            STATE_DB.executemany('INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?)',
+                                 [key + tuple(value) for key, value in rows.items()])
+        os.replace(path, path + '.migrated')
+
+
+# Returns the info as {'SITE_IDS', 'SERIALS', 'SITE_TIMEZONES', 'HAS_OPTIMIZERS', 'HAS_METERS'}
+# and when it was last refreshed, None if nothing is stored yet.
+def load_installation_info():
+    info = {
+        'SITE_IDS': [],
+        'SERIALS': {},
+        'SITE_TIMEZONES': {},
+        'HAS_OPTIMIZERS': {},
+        'HAS_METERS': {}
+    }
+    for site, timezone, optimizers, meters in STATE_DB.execute(
+            'SELECT site, timezone, has_optimizers, has_meters FROM sites ORDER BY position'
+    ):
+        info['SITE_IDS'].append(site)
+        info['SITE_TIMEZONES'][site] = timezone
+        info['HAS_OPTIMIZERS'][site] = bool(optimizers)
+        info['HAS_METERS'][site] = bool(meters)
+        info['SERIALS'][site] = []
+    for site, serial in STATE_DB.execute(
+            'SELECT site, serial FROM serials ORDER BY site, position'):
+        info['SERIALS'][site].append(serial)
+    refreshed = STATE_DB.execute(
+        "SELECT value FROM meta WHERE key = 'inventory_refreshed'").fetchone()
+    if refreshed is None:
+        return None, None
+    return info, datetime.datetime.fromisoformat(refreshed[0])
+
+
+def store_installation_info(info: dict, refreshed: datetime.datetime):
+    with STATE_LOCK, STATE_DB:
+        STATE_DB.execute('DELETE FROM sites')
+        STATE_DB.execute('DELETE FROM serials')
+        STATE_DB.executemany(
+            'INSERT INTO sites VALUES (?, ?, ?, ?, ?)',
+            [(site, position, info['SITE_TIMEZONES'][site],
+              info['HAS_OPTIMIZERS'][site], info['HAS_METERS'][site])
+             for position, site in enumerate(info['SITE_IDS'])])
+        STATE_DB.executemany(
+            'INSERT INTO serials VALUES (?, ?, ?)',
+            [(site, position, serial) for site in info['SITE_IDS']
+             for position, serial in enumerate(info['SERIALS'][site])])
+        STATE_DB.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('inventory_refreshed', ?)",
+            (refreshed.isoformat(), ))
+
+
+# {endpoint: {site: datetime}} for the per site watermarks,
+# {endpoint: {site: {key: datetime or unix time}}} for the finer ones
+def load_last_updated():
+    lastUpdates = {'optimizer': {}, 'serial': {}}
+    for endpoint, site, key, value in STATE_DB.execute(
+            'SELECT endpoint, site, key, value FROM watermarks'):
+        if isinstance(value, str):
+            value = datetime.datetime.fromisoformat(value)
+        if key == '':
+            lastUpdates.setdefault(endpoint, {})[site] = value
+        else:
+            lastUpdates.setdefault(endpoint, {}).setdefault(site, {})[key] = value
+    return lastUpdates
+
+
+def encode_watermark(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+# Replaces all watermarks in a single transaction
+def store_last_updated(lastUpdates: dict):
+    rows = []
+    for endpoint, sites in lastUpdates.items():
+        for site, value in sites.items():
+            if isinstance(value, dict):
+                rows += [(endpoint, site, key, encode_watermark(v))
+                         for key, v in value.items()]
+            else:
+                rows.append((endpoint, site, '', encode_watermark(value)))
+    with STATE_LOCK, STATE_DB:
+        STATE_DB.execute('DELETE FROM watermarks')
+        STATE_DB.executemany('INSERT INTO watermarks VALUES (?, ?, ?, ?)', rows)
+
+
+# Slot (scheduled time) of the last completed run of the job, None if it never ran
+def load_job_run(name: str):
+    row = STATE_DB.execute('SELECT value FROM meta WHERE key = ?',
+                           (f'last_run:{name}', )).fetchone()
+    return datetime.datetime.fromisoformat(row[0]) if row is not None else None
+
+
+def store_job_run(name: str, slot: datetime.datetime):
+    with STATE_LOCK, STATE_DB:
+        STATE_DB.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         (f'last_run:{name}', slot.isoformat()))
+
+
+# ------------------------------ Dedup index -----------------------------------
+
+
+def dedup_index(namespace: str):
+    if namespace not in DEDUP_INDEX:
+        index = collections.OrderedDict()
+        with STATE_LOCK:
+            rows = STATE_DB.execute(
+                'SELECT series, timestamp FROM delivered WHERE namespace = ? ORDER BY used',
+                (namespace, )).fetchall()
+        for series, timestamp in rows:
+            index[series] = timestamp
+        DEDUP_INDEX[namespace] = index
+    return DEDUP_INDEX[namespace]
+
+
+# Returns the lines not delivered yet: those past the last delivered timestamp of their series.
+# The highest timestamp per series is added to delivered, pass it to commit_delivered() once the
+# lines are delivered.
+# With a scope (the history chunk) the index is kept per series and scope: a chunk that failed
+# is not suppressed by the later chunks delivered before it is rerun.
+@profiled('format')
+def deduplicate(lines: list, namespace: str, delivered: dict, scope: str = ''):
+    prefix = f'{scope} ' if scope else ''
+    with DEDUP_LOCK:
+        index = dedup_index(namespace)
+        kept = []
+        for line in lines:
+            series, _, timestamp = line.rsplit(' ', 2)
+            series = prefix + series
+            timestamp = int(timestamp)
+            if timestamp <= index.get(series, 0):
+                continue
+            kept.append(line)
+            if timestamp > delivered.get(series, 0):
+                delivered[series] = timestamp
+    with STATS_LOCK:
+        DEDUP_SUPPRESSED[namespace] = DEDUP_SUPPRESSED.get(
+            namespace, 0) + len(lines) - len(kept)
+    return kept
+
+
+def commit_delivered(namespace: str, delivered: dict):
+    if not delivered:
+        return
+    used = time.time_ns()
+    with DEDUP_LOCK:
+        index = dedup_index(namespace)
+        for series, timestamp in delivered.items():
+            index[series] = max(timestamp, index.get(series, 0))
+            index.move_to_end(series)
+        evicted = []
+        while len(index) > DEDUP_MAX_SERIES:
+            evicted.append(index.popitem(last=False)[0])
+        rows = [(namespace, series, index[series], used)
+                for series in delivered if series in index]
+    with STATE_LOCK, STATE_DB:
+        STATE_DB.executemany(
+            'INSERT OR REPLACE INTO delivered VALUES (?, ?, ?, ?)', rows)
+        STATE_DB.executemany(
+            'DELETE FROM delivered WHERE namespace = ? AND series = ?',
+            [(namespace, series) for series in evicted])
+
+
+# Drops the index of a scope, once the chunk is complete it is not fetched again
+def forget_delivered(namespace: str, scope: str):
+    prefix = f'{scope} '
+    with DEDUP_LOCK:
+        index = dedup_index(namespace)
+        for series in [series for series in index if series.startswith(prefix)]:
+            del index[series]
+    with STATE_LOCK, STATE_DB:
+        STATE_DB.execute(
+            'DELETE FROM delivered WHERE namespace = ? AND substr(series, 1, ?) = ?',
+            (namespace, len(prefix), prefix))
+
+
+def reset_delivered(namespace: str):
+    with DEDUP_LOCK:
+        DEDUP_INDEX[namespace] = collections.OrderedDict()
+    with STATE_LOCK, STATE_DB:
+        STATE_DB.execute('DELETE FROM delivered WHERE namespace = ?',
+                         (namespace, ))
+
+
+# ------------------------------ Archive ---------------------------------------
+
+
+def archive_segment_path(segment: int):
+    return os.path.join(HOME_DIR, ARCHIVE_DIR, f'{segment:06}.gz')
+
+
+# Appends the raw response to the last segment and indexes it by endpoint, site and interval.
+# args holds whatever else the parser needs (serial, per site start of bulk responses).
+# A segment is a valid gzip file of all its responses, every response is its own member.
+def archive_response(endpoint: str, site: str, startTime, endTime, args: dict,
+                     body: bytes):
+    if not ARCHIVE_RESPONSES:
+        return
+    member = gzip.compress(body, compresslevel=6)
+    with ARCHIVE_LOCK:
+        segment = STATE_DB.execute('SELECT MAX(segment) FROM archive').fetchone()[0] or 1
+        path = archive_segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) >= ARCHIVE_SEGMENT_BYTES:
+            segment += 1
+            path = archive_segment_path(segment)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Other processes (history) might append as well
+        with open(path, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            offset = f.seek(0, os.SEEK_END)
+            f.write(member)
+            f.flush()
+        with STATE_LOCK, STATE_DB:
+            STATE_DB.execute(
+                'INSERT INTO archive VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (segment, offset, len(member), endpoint, site,
+                 startTime.isoformat() if startTime is not None else None,
+                 endTime.isoformat() if endTime is not None else None,
+                 json.dumps(args), int(time.time())))
+
+
+# Removes the segments (but the last) of which every response is older than ARCHIVE_KEEP_DAYS.
+# The newest response removed is kept as archive_pruned, see replay_archive().
+def prune_archive():
+    if not ARCHIVE_KEEP_DAYS:
+        return
+    cutoff = int(time.time()) - ARCHIVE_KEEP_DAYS * 24 * 3600
+    with ARCHIVE_LOCK:
+        last = STATE_DB.execute('SELECT MAX(segment) FROM archive').fetchone()[0]
+        if last is None:
+            return
+        segments = STATE_DB.execute(
+            'SELECT segment, MAX(fetched) FROM archive WHERE segment < ? GROUP BY segment'
+            ' HAVING MAX(fetched) < ?', (last, cutoff)).fetchall()
+        if not segments:
+            return
+        with STATE_LOCK, STATE_DB:
+            STATE_DB.executemany('DELETE FROM archive WHERE segment = ?',
+                                 [(segment, ) for segment, _ in segments])
+            pruned = max([fetched for _, fetched in segments] + [archive_pruned()])
+            STATE_DB.execute("INSERT OR REPLACE INTO meta VALUES ('archive_pruned', ?)",
+                             (pruned, ))
+        for segment, _ in segments:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(archive_segment_path(segment))
+
+
+# Unix time of the newest response removed from the archive, 0 if none
+def archive_pruned():
+    row = STATE_DB.execute(
+        "SELECT value FROM meta WHERE key = 'archive_pruned'").fetchone()
+    return row[0] if row is not None else 0
+
 
 # --------------------------- Main() helpers ------------------------------
 
@@ -167,324 +1623,873 @@ def initialize_home_dir():
     HOME_DIR = os.path.expanduser(
         '~' + getpass.getuser()
     )  # get the home of the telegraf user (same as the location of the script)
-
-
-# Should only be called once
-def initialize_installation_info():
-    global SITES, SERIALS, SITE_TIMEZONES, SITE_IDS, HAS_OPTIMIZERS
-
-    # Check if the info is already cached
-    if os.path.exists(os.path.join(HOME_DIR, INSTALLATION_INFO_FILE)):
-        with open(os.path.join(HOME_DIR, INSTALLATION_INFO_FILE), "r") as f:
-            data = ast.literal_eval(f.read())
-            SITE_IDS = data['SITE_IDS']
-            SITES = ','.join(SITE_IDS)
-            SERIALS = data['SERIALS']
-            SITE_TIMEZONES = data['SITE_TIMEZONES']
-            HAS_OPTIMIZERS = data['HAS_OPTIMIZERS']
-            # TODO TBD should check for equipment updates (there is an API available)
-            return True
+    if ACCOUNT_ENV in os.environ:
+        select_account(os.environ[ACCOUNT_ENV])
+
+
+# Worker of an account, see supervise_accounts()
+def select_account(name: str):
+    global SETTING_API_KEY, SETTING_SITE_USERNAME, SETTING_SITE_PW, HOME_DIR, API_SLOTS_DIR
+
+    account = next((a for a in ACCOUNTS if a['name'] == name), None)
+    if account is None:
+        print_err(f'Unknown account {name}, exiting.')
+        flush_and_exit(1)
+    SETTING_API_KEY = account['api_key']
+    SETTING_SITE_USERNAME = account['username']
+    SETTING_SITE_PW = account['password']
+    API_SLOTS_DIR = HOME_DIR
+    HOME_DIR = os.path.join(HOME_DIR, ACCOUNTS_DIR, name)
+    os.makedirs(HOME_DIR, exist_ok=True)
+
+
+def fetch_installation_info():
+    info = {
+        'SITE_IDS': [],
+        'SERIALS': {},
+        'SITE_TIMEZONES': {},
+        'HAS_OPTIMIZERS': {},
+        'HAS_METERS': {}
+    }
 
     # Get sites
-    r = requests.get(f"{BASE_API_URL}/sites/list.json",
-                     {'api_key': SETTING_API_KEY},
-                     timeout=REQUEST_TIMEOUT)
-    if r.status_code != 200:
-        print_err(f"SolarEdge Cloud: Sites: HTTP {r.status_code} : {r.url}")
-        return False
+    # Note: 1 call per SITE_LIST_PAGE_SIZE sites
+    while True:
+        r = api_get("/sites/list.json", {
+            'size': SITE_LIST_PAGE_SIZE,
+            'startIndex': len(info['SITE_IDS'])
+        })
+        if r.status_code != 200:
+            print_err(f"SolarEdge Cloud: Sites: HTTP {r.status_code} : {r.url}")
+            return None
 
-    # Parse response
-    for site in r.json()['sites']['site']:
-        site_id = str(site['id'])
-        SITE_IDS.append(site_id)
-        SITE_TIMEZONES[site_id] = site['location']['timeZone']
-        HAS_OPTIMIZERS[site_id] = site['type'].find("Optimizers") != -1
-    SITES = ','.join(SITE_IDS)
+        # Parse response
+        sites = r.json()['sites']
+        for site in sites['site']:
+            site_id = str(site['id'])
+            info['SITE_IDS'].append(site_id)
+            info['SITE_TIMEZONES'][site_id] = site['location']['timeZone']
+            info['HAS_OPTIMIZERS'][site_id] = site['type'].find("Optimizers") != -1
+        if not sites['site'] or len(info['SITE_IDS']) >= sites['count']:
+            break
 
     # Get serials
     # Note: 1 call per site
-    for site in SITE_IDS:
-        r = requests.get(f"{BASE_API_URL}/site/{site}/inventory",
-                         {'api_key': SETTING_API_KEY},
-                         timeout=REQUEST_TIMEOUT)
+    for site in info['SITE_IDS']:
+        r = api_get(f"/site/{site}/inventory")
         if r.status_code != 200:
             print_err(
                 f"SolarEdge Cloud: Inventory: HTTP {r.status_code} : {r.url}")
-            return False
+            return None
 
         # Parse response
+        inventory = r.json()['Inventory']
         serials = []
-        for inverter in r.json()['Inventory']['inverters']:
+        for inverter in inventory['inverters']:
             serials.append(inverter['SN'])
-        SERIALS[site] = serials
-
-    # Cache data
-    with open(os.path.join(HOME_DIR, INSTALLATION_INFO_FILE), "w") as f:
-        f.write(
-            repr({
-                'SITE_IDS': SITE_IDS,
-                'SERIALS': SERIALS,
-                'SITE_TIMEZONES': SITE_TIMEZONES,
-                'HAS_OPTIMIZERS': HAS_OPTIMIZERS
-            }))
+        info['SERIALS'][site] = serials
+        info['HAS_METERS'][site] = len(inventory.get('meters', [])) > 0
+
+    return info
 
+
+def installation_changes(old: dict, new: dict):
+    changes = [f"site {site} removed" for site in old['SITE_IDS'] if site not in new['SITE_IDS']]
+    for site in new['SITE_IDS']:
+        if site not in old['SITE_IDS']:
+            changes.append(f"site {site} added")
+            continue
+        added = set(new['SERIALS'][site]) - set(old['SERIALS'][site])
+        removed = set(old['SERIALS'][site]) - set(new['SERIALS'][site])
+        if added:
+            changes.append(f"site {site}: inverters {', '.join(sorted(added))} added")
+        if removed:
+            changes.append(f"site {site}: inverters {', '.join(sorted(removed))} removed")
+        for key, label in (('SITE_TIMEZONES', 'time zone'), ('HAS_OPTIMIZERS', 'optimizers'),
+                           ('HAS_METERS', 'meters')):
+            if old[key][site] != new[key][site]:
+                changes.append(f"site {site}: {label} {old[key][site]} -> {new[key][site]}")
+    return changes
+
+
+def apply_installation_info(info: dict):
+    global SITES, SERIALS, SITE_TIMEZONES, SITE_IDS, HAS_OPTIMIZERS, HAS_METERS
+
+    SITE_IDS = info['SITE_IDS']
+    SITES = ','.join(SITE_IDS)
+    SERIALS = info['SERIALS']
+    SITE_TIMEZONES = info['SITE_TIMEZONES']
+    HAS_OPTIMIZERS = info['HAS_OPTIMIZERS']
+    HAS_METERS = info['HAS_METERS']
+
+
+# Uses the stored installation info, it is fetched again (1 per 100 sites + 1 per site API calls) once it is
+# older than INVENTORY_REFRESH_DAYS. Returns False if there is no installation info.
+def refresh_installation_info():
+    info, refreshed = load_installation_info()
+    if info is not None and datetime.datetime.now() - refreshed < datetime.timedelta(
+            days=INVENTORY_REFRESH_DAYS):
+        apply_installation_info(info)
+        return True
+
+    try:
+        fetched = fetch_installation_info()
+    except requests.exceptions.RequestException as e:
+        print_err(f"SolarEdge Cloud: Inventory: request failed: {e}")
+        fetched = None
+    if fetched is None:
+        if info is None:
+            return False
+        # Try again at the next refresh
+        print_err("SolarEdge Cloud: Inventory: refresh failed, using the stored inventory")
+        apply_installation_info(info)
+        return True
+
+    if info is not None:
+        for change in installation_changes(info, fetched):
+            print_err(f"SolarEdge Cloud: Inventory: {change}")
+    store_installation_info(fetched, datetime.datetime.now())
+    apply_installation_info(fetched)
     return True
 
 
+# Should only be called once
+def initialize_installation_info():
+    initialize_state_store()
+    return refresh_installation_info()
+
+
+# Sites without watermarks (new installs and sites) start at the previous update
+# Note: will not auto scrape full history
+def add_missing_watermarks():
+    resetDate = datetime.datetime.now().replace(
+        hour=UPDATE_INTERVAL_HOUR, minute=UPDATE_INTERVAL_MIN,
+        second=0, microsecond=0) - datetime.timedelta(days=1)
+    for endpoint in ('power', 'energy', 'data', 'playback'):
+        for site in SITE_IDS:
+            LAST_UPDATES.setdefault(endpoint, {}).setdefault(site, resetDate)
+
+
 # Should only be called once
 def initialize_last_updated():
     global LAST_UPDATES
 
-    if os.path.exists(os.path.join(HOME_DIR, LAST_SUCCESSFUL_UPDATE_FILE)):
-        with open(os.path.join(HOME_DIR, LAST_SUCCESSFUL_UPDATE_FILE),
-                  "r") as f:
-            LAST_UPDATES = parse_datetime_dict(f.read())
-    else:
-        # Well it must be intialized at something
-        # Note: will not auto scrape full history
-        resetDate = datetime.datetime.now().replace(
-            hour=UPDATE_INTERVAL_HOUR, minute=UPDATE_INTERVAL_MIN,
-            second=0) - datetime.timedelta(days=1)
-        site_dict = {}
-        for site in SITE_IDS:
-            site_dict[site] = resetDate
-        LAST_UPDATES['power'] = site_dict.copy()
-        LAST_UPDATES['energy'] = site_dict.copy()
-        LAST_UPDATES['data'] = site_dict.copy()
-        LAST_UPDATES['playback'] = site_dict.copy()
+    LAST_UPDATES = load_last_updated()
+    add_missing_watermarks()
+
+
+# Should only be called once
+def initialize_sessions():
+    global API_SESSION, WEB_SESSION, WEB_LOGIN_GENERATION
 
+    API_SESSION = new_session()
+    WEB_SESSION = new_session()
 
-def ensure_logged_in(session: requests.Session, function):
+    # Reuse the cookies of the previous run, if they expired ensure_logged_in() will log in again
     if os.path.exists(os.path.join(HOME_DIR, SITE_COOKIE_FILE)):
         with open(os.path.join(HOME_DIR, SITE_COOKIE_FILE), 'r') as f:
-            session.cookies.update(
+            WEB_SESSION.cookies.update(
                 requests.utils.cookiejar_from_dict(json.load(f)))
-            response = function()
-            if response.status_code == 200:
-                return response
-
-    # Log in again
-    session.post(SITE_LOGIN_URL,
-                 headers={"Content-Type": "application/x-www-form-urlencoded"},
-                 data={
-                     "j_username": SETTING_SITE_USERNAME,
-                     "j_password": SETTING_SITE_PW
-                 })
-    with open(os.path.join(HOME_DIR, SITE_COOKIE_FILE), 'w') as f:
-        json.dump(requests.utils.dict_from_cookiejar(session.cookies), f)
-
-    return function()
-
+        WEB_LOGIN_GENERATION = 1
+
+
+# The login state is kept in memory, the cookie file is only written after a (re)login.
+def ensure_logged_in(function, endpoint: str):
+    global WEB_LOGIN_GENERATION
+
+    generation = WEB_LOGIN_GENERATION
+    if generation != 0:
+        response = send_with_retry(function, endpoint)
+        if response.status_code == 200:
+            return response
+
+    with WEB_LOGIN_LOCK:
+        # Another thread might have logged in while we were waiting
+        if WEB_LOGIN_GENERATION == generation:
+            send_with_retry(lambda: WEB_SESSION.post(
+                SITE_LOGIN_URL,
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+                data={
+                    "j_username": SETTING_SITE_USERNAME,
+                    "j_password": SETTING_SITE_PW
+                },
+                timeout=REQUEST_TIMEOUT), 'login')
+            with open(os.path.join(HOME_DIR, SITE_COOKIE_FILE), 'w') as f:
+                json.dump(
+                    requests.utils.dict_from_cookiejar(WEB_SESSION.cookies),
+                    f)
+            WEB_LOGIN_GENERATION = generation + 1
+
+    return send_with_retry(function, endpoint)
+
+
+# Runs all fetch jobs concurrently. Each job is (function, args) and the function
+# must accept a trailing list to which it appends its line protocol output.
+# Results are returned in job order as (success, lines).
+def run_fetch_jobs(jobs):
+    def run(function, args, lines):
+        try:
+            return run_instrumented(function, args, lines)
+        except requests.exceptions.RequestException as e:
+            print_err(f"SolarEdge Cloud: request failed: {e}")
+            return False
 
-def update_all_data(endTime: datetime.datetime):
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=FETCH_WORKERS) as pool:
+        futures = []
+        for function, args in jobs:
+            lines = []
+            futures.append((pool.submit(run, function, args, lines), lines))
+        return [(future.result(), lines) for future, lines in futures]
+
+
+# Sites whose power and energy can be fetched through the bulk endpoints
+def bulk_site_ids():
+    return [site for site in SITE_IDS if not HAS_METERS.get(site, True)]
+
+
+# Groups the sites per watermark, in chunks the bulk endpoints accept
+def bulk_site_batches(sites, timeStamps: dict):
+    batches = {}
+    for site in sites:
+        batches.setdefault(timeStamps[site], []).append(site)
+    return [
+        batch[i:i + API_BULK_MAX_SITES] for batch in batches.values()
+        for i in range(0, len(batch), API_BULK_MAX_SITES)
+    ]
+
+
+def update_all_data(endTime: datetime.datetime,
+                    playback: bool = True,
+                    optimizers: bool = False,
+                    apiSites: list = None):
+    # Every (endpoint, sites, key) group consists of one or more jobs, key is None for per site
+    # watermarks and the serial for the per inverter watermarks of the data.
+    # Per site jobs return whether they succeeded, bulk jobs return the list of sites that succeeded.
+    # A group is only written if all of its jobs succeeded and only the watermarks of the sites that
+    # succeeded are advanced. Output is written in a fixed order regardless of completion order.
+    # Points already delivered by a previous run (overlapping windows, weekly playback) are dropped.
+    started = time.monotonic()
+    groups = []
     playbackTimeStamps = LAST_UPDATES['playback']
     for site in SITE_IDS:
-        if HAS_OPTIMIZERS[site]:
-            nr_days = max((endTime - playbackTimeStamps[site]).days,
-                          7)  # API only supports up to 1 week history
+        if HAS_OPTIMIZERS[site] and playback:
+            # The daily data only covers today, older data needs the weekly data
+            nr_days = min(
+                (endTime.date() - playbackTimeStamps[site].date()).days,
+                7)  # API only supports up to 1 week history
             days = [0]
-            if nr_days != 1:
+            if nr_days > 0:
                 days = list(range(-nr_days, 0, 1))
-            if get_playback_data_site(days, site):
-                playbackTimeStamps[site] = endTime
-    powerTimeStamps = LAST_UPDATES['power']
+            groups.append(('playback', [site], None,
+                           [(get_playback_data_site, (days, site))]))
+    # Power, energy and data of all sites by default
+    if apiSites is None:
+        apiSites = SITE_IDS
+    bulk_sites = [site for site in bulk_site_ids() if site in apiSites]
+    for endpoint, function, bulk_function in (('power', get_power_api,
+                                                get_power_bulk_api),
+                                               ('energy', get_energy_api,
+                                                get_energy_bulk_api)):
+        timeStamps = LAST_UPDATES[endpoint]
+        for site in apiSites:
+            if site not in bulk_sites:
+                groups.append((endpoint, [site], None, [
+                    (function, (site, timeStamps[site], endTime))
+                ]))
+        for sites in bulk_site_batches(bulk_sites, timeStamps):
+            groups.append((endpoint, sites, None,
+                           [(bulk_function, (sites, timeStamps, endTime))]))
+    for site in apiSites:
+        for serial in SERIALS[site]:
+            groups.append(('serial', [site], serial, [
+                (get_data_serial_api,
+                 (site, serial, serial_watermark(site, serial), endTime))
+            ]))
     for site in SITE_IDS:
-        if get_power_api(site, powerTimeStamps[site], endTime):
-            powerTimeStamps[site] = endTime
-    energyTimeStamps = LAST_UPDATES['energy']
-    for site in SITE_IDS:
-        if get_energy_api(site, energyTimeStamps[site], endTime):
-            energyTimeStamps[site] = endTime
-    dataTimeStamps = LAST_UPDATES['data']
-    for site in SITE_IDS:
-        if get_data_api(site, dataTimeStamps[site], endTime):
-            dataTimeStamps[site] = endTime
-
+        if HAS_OPTIMIZERS[site] and optimizers:
+            groups.append(('optimizer', [site], None,
+                           [(get_optimizer_data_site, (site, ))]))
+
+    results = iter(run_fetch_jobs([job for _, _, _, jobs in groups for job in jobs]))
+    written = []
+    delivered = {}
+    for endpoint, sites, key, jobs in groups:
+        group_results = [next(results) for _ in jobs]
+        succeeded = sites
+        for success, _ in group_results:
+            if success is not True:
+                succeeded = [site for site in succeeded if success and site in success]
+        if succeeded:
+            for _, lines in group_results:
+                write_lines(deduplicate(lines, DEDUP_DAILY, delivered))
+                written += lines
+            # Optimizer watermarks are per panel, kept by get_optimizer_data_site()
+            for site in succeeded if endpoint != 'optimizer' else []:
+                if key is None:
+                    LAST_UPDATES[endpoint][site] = endTime
+                else:
+                    LAST_UPDATES[endpoint].setdefault(site, {})[key] = endTime
+    # The data of a site is as recent as that of its least recent inverter
+    for site in apiSites:
+        if SERIALS[site]:
+            LAST_UPDATES['data'][site] = min(
+                serial_watermark(site, serial) for serial in SERIALS[site])
+
+    # Rollups and panel stats are recomputed from all points, also those already delivered
+    if EMIT_ROLLUPS:
+        write_lines(rollup_lines(written))
+    if EMIT_PANEL_STATS:
+        write_lines(panel_stats_lines(written))
+    if EMIT_SCRAPER_STATS:
+        write_lines(stats_lines(time.monotonic() - started))
     flush()
+    commit_delivered(DEDUP_DAILY, delivered)
 
     # Persist last successful update
-    with open(os.path.join(HOME_DIR, LAST_SUCCESSFUL_UPDATE_FILE), "w") as f:
-        f.write(repr(LAST_UPDATES))
+    store_last_updated(LAST_UPDATES)
+
+
+# Inverters added since their site was last updated start at the data watermark of the site
+def serial_watermark(site: str, serial: str):
+    return LAST_UPDATES['serial'].get(site, {}).get(serial,
+                                                    LAST_UPDATES['data'][site])
+
+
+def floor_quarter_hour(date: datetime.datetime):
+    return date.replace(minute=date.minute - date.minute % 15,
+                        second=0,
+                        microsecond=0)
+
+
+# Number of seconds between polls such that POLL_QUOTA_SHARE of the quota is not exceeded,
+# a multiple of POLL_INTERVAL_MIN.
+def poll_interval():
+    cycles = max(1, int(API_DAILY_QUOTA * POLL_QUOTA_SHARE) //
+                 max(1, daily_api_calls()))
+    step = POLL_INTERVAL_MIN * 60
+    return -(-24 * 3600 // cycles // step) * step
+
+
+# ------------------------------ Scheduler -------------------------------------
+
+
+# The sites whose power, energy and data are fetched at the slot: the sites of the bulk endpoints
+# (one call for all of them) at the first run of the day, the others spread over the CLOUD_SLOTS
+# runs, and every site more than a day behind (missed runs, new sites).
+def cloud_slot_sites(slot: datetime.datetime):
+    minutes = job_minutes('cloud')
+    hour, minute = SCHEDULE['cloud'][1].split(':')
+    index = ((slot.hour - int(hour)) * 60 + slot.minute - int(minute)) % (24 * 60) // minutes
+    behind = slot - datetime.timedelta(days=1, minutes=minutes)
+    bulk = set(bulk_site_ids())
+    single = [site for site in SITE_IDS if site not in bulk]
+    due = {site for position, site in enumerate(single) if position % CLOUD_SLOTS == index}
+    if index == 0:
+        due |= bulk
+    return [
+        site for site in SITE_IDS if site in due or min(
+            LAST_UPDATES[endpoint][site] for endpoint in ('power', 'energy', 'data')) < behind
+    ]
+
+
+# Power, energy and data up to the slot, of the sites of the slot. In poll mode the window since
+# the watermarks of every site, together with the optimizer data.
+def cloud_job(slot: datetime.datetime):
+    if not POLL_MODE:
+        endTime = slot
+        if CLOUD_SLOTS > 1:
+            # Not all of the last quarters are uploaded yet during the day
+            endTime = floor_quarter_hour(slot - datetime.timedelta(minutes=POLL_DELAY_MIN))
+        update_all_data(endTime, playback=False, apiSites=cloud_slot_sites(slot))
+        return
+
+    # Reserve the calls needed for the remaining polls of the quota day
+    interval = poll_interval()
+    remaining_polls = int(seconds_until_quota_refill() // interval) + 1
+    reserve_api_calls(remaining_polls * daily_api_calls())
+
+    endTime = floor_quarter_hour(datetime.datetime.now() -
+                                 datetime.timedelta(minutes=POLL_DELAY_MIN))
+    update_all_data(endTime, playback=False, optimizers=True)
+
+
+def playback_job(slot: datetime.datetime):
+    if any(HAS_OPTIMIZERS[site] for site in SITE_IDS):
+        update_all_data(slot, apiSites=[])
+
+
+def inventory_job(slot: datetime.datetime):
+    refresh_installation_info()
+    add_missing_watermarks()
+    prune_archive()
+
+
+def backfill_job(slot: datetime.datetime):
+    if not INFLUXDB_WRITE_URL:
+        scrape_full_history(budgeted=True)
+        return
+    start_influxdb_writer()
+    try:
+        scrape_full_history(budgeted=True)
+    finally:
+        if not stop_influxdb_writer():
+            print_err("SolarEdge Cloud: Backfill: writing to InfluxDB failed, retrying at the"
+                      " next run")
+
+
+SCHEDULE_JOBS = {
+    'cloud': cloud_job,
+    'playback': playback_job,
+    'inventory': inventory_job,
+    'backfill': backfill_job
+}
+
+
+def job_minutes(name: str):
+    if name == 'cloud' and POLL_MODE:
+        return poll_interval() // 60
+    return SCHEDULE[name][0]
+
+
+# The most recent scheduled time at or before now (local time), the first run of the day and
+# every minutes after it
+def latest_slot(name: str, now: datetime.datetime):
+    minutes = job_minutes(name)
+    hour, minute = SCHEDULE[name][1].split(':')
+    first = now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+    if first > now:
+        first -= datetime.timedelta(days=1)
+    period = datetime.timedelta(minutes=minutes)
+    return first + (now - first) // period * period
+
+
+# Runs in a thread of the default executor, which is shared by all jobs
+def run_job_thread(name: str, slot: datetime.datetime):
+    QUOTA_CONTEXT.priority = SCHEDULE[name][2]
+    with account_slot('jobslot', ACCOUNT_WORKERS), profile_cycle(name, PROFILE_OPTIONS):
+        SCHEDULE_JOBS[name](slot)
+    flush()
+
+
+# Runs the job at every slot. The slot of the last completed run is kept in the state store: a
+# slot missed while the scraper was down (or still busy with the previous run) is run at once,
+# with the missed slot as end time. Jobs run one at a time as they share the watermarks.
+async def run_job(name: str, lock: asyncio.Lock):
+    last = load_job_run(name)
+    if last is None:
+        # New install or job, nothing was missed
+        last = latest_slot(name, datetime.datetime.now())
+    starting = True
+    while True:
+        now = datetime.datetime.now()
+        slot = latest_slot(name, now)
+        if slot <= last:
+            starting = False
+            minutes = job_minutes(name)
+            jitter = random.uniform(0, min(SCHEDULE_JITTER_MIN, minutes / 4) * 60)
+            nextRun = slot + datetime.timedelta(minutes=minutes, seconds=jitter)
+            await asyncio.sleep(max(1.0, (nextRun - now).total_seconds()))
+            continue
+
+        if starting:
+            print_err(f"SolarEdge Cloud: Scheduler: {name} missed its run at {slot}, catching up")
+        async with lock:
+            await asyncio.to_thread(run_job_thread, name, slot)
+        store_job_run(name, slot)
+        last = slot
+
+
+# Never returns. An exception in a job ends the scraper, the job is caught up after the restart.
+async def run_scheduler():
+    lock = asyncio.Lock()
+    await asyncio.gather(*(run_job(name, lock) for name in SCHEDULE
+                           if name != 'backfill' or SCHEDULE_BACKFILL))
 
 
 # --------------------------- Data gathering ----------------------------
 
 # API
+# Every get_*() function fetches, archives and hands the response to its parse_*() function,
+# which the replay mode calls with the archived response.
 
 
-def get_power_api(site: str, startTime: datetime, endTime: datetime):
-    r = requests.get(f"{BASE_API_URL}/site/{site}/powerDetails.json", {
+def get_power_api(site: str, startTime: datetime, endTime: datetime,
+                  lines: list):
+    r = api_get(f"/site/{site}/powerDetails.json", {
         'startTime': format_datetime_url(startTime),
-        'endTime': format_datetime_url(endTime),
-        'api_key': SETTING_API_KEY
-    },
-        timeout=REQUEST_TIMEOUT)
+        'endTime': format_datetime_url(endTime)
+    })
     if r.status_code != 200:
         print_err(f"SolarEdge Cloud: Power: HTTP {r.status_code} : {r.url}")
         return False
 
-    # Parse request
-    json = r.json()
+    archive_response('power', site, startTime, endTime, {}, r.content)
+    parse_power(r.json(), site, lines)
+    return True
+
+
+def parse_power(json: dict, site: str, lines: list):
     multiplier = wh_unit_to_multiplier(json['powerDetails']['unit'])
+    timezone = SITE_TIMEZONES[site]
     for meter in json['powerDetails']['meters']:
-        type = meter['type'].lower()
+        series = line_series('power', (('site', site),
+                                     ('type', meter['type'].lower())))
         for point in meter['values']:
-            if 'value' in point:
-                print(
-                    f'power,site={site},type={type} w={float(point["value"]) * multiplier} {to_unix_timestamp(point["date"])}',
-                    flush=False)
-    return True
+            if point.get('value') is not None:
+                lines.append(
+                    f'{series} w={float(point["value"]) * multiplier} {local_to_unix_timestamp(point["date"], timezone)}'
+                )
 
 
-def get_energy_api(site: str, startTime: datetime, endTime: datetime):
-    r = requests.get(f"{BASE_API_URL}/site/{site}/energyDetails.json", {
+def get_energy_api(site: str, startTime: datetime, endTime: datetime,
+                   lines: list):
+    r = api_get(f"/site/{site}/energyDetails.json", {
         'timeUnit': 'QUARTER_OF_AN_HOUR',
         'startTime': format_datetime_url(startTime),
-        'endTime': format_datetime_url(endTime),
-        'api_key': SETTING_API_KEY
-    },
-        timeout=REQUEST_TIMEOUT)
+        'endTime': format_datetime_url(endTime)
+    })
     if r.status_code != 200:
         print_err(f"SolarEdge Cloud: Energy: HTTP {r.status_code} : {r.url}")
         return False
 
-    # Parse request
-    json = r.json()
+    archive_response('energy', site, startTime, endTime, {}, r.content)
+    parse_energy(r.json(), site, lines)
+    return True
+
+
+def parse_energy(json: dict, site: str, lines: list):
     multiplier = wh_unit_to_multiplier(json['energyDetails']['unit'])
+    timezone = SITE_TIMEZONES[site]
     for meter in json['energyDetails']['meters']:
-        type = meter['type'].lower()
+        series = line_series('energy', (('site', site),
+                                     ('type', meter['type'].lower())))
         for point in meter['values']:
-            if 'value' in point:
-                print(
-                    f'energy,site={site},type={type} wh={float(point["value"]) * multiplier} {to_unix_timestamp(point["date"])}',
-                    flush=False)
-    return True
+            if point.get('value') is not None:
+                lines.append(
+                    f'{series} wh={float(point["value"]) * multiplier} {local_to_unix_timestamp(point["date"], timezone)}'
+                )
+
+
+# Multi-site variants of the above. The bulk endpoints only report the production, which for
+# sites without meters is all powerDetails/energyDetails report as well.
+# Fetches from the oldest watermark of the sites; points before a site's own watermark are dropped.
+# Returns the list of sites for which data was received.
+def get_power_bulk_api(sites: list, startTimes: dict, endTime: datetime,
+                       lines: list):
+    startTime = min(startTimes[site] for site in sites)
+    r = api_get(f"/sites/{','.join(sites)}/power.json", {
+        'startTime': format_datetime_url(startTime),
+        'endTime': format_datetime_url(endTime)
+    })
+    if r.status_code != 200:
+        print_err(f"SolarEdge Cloud: Power bulk: HTTP {r.status_code} : {r.url}")
+        return []
+
+    archive_response('power_bulk', ','.join(sites), startTime, endTime, {
+        'startTimes': {site: startTimes[site].isoformat() for site in sites}
+    }, r.content)
+    return parse_power_bulk(r.json(), sites, startTimes, r.url, lines)
+
+
+def parse_power_bulk(json: dict, sites: list, startTimes: dict, source: str,
+                     lines: list):
+    multiplier = wh_unit_to_multiplier(json['powerDateValuesList']['unit'])
+    values = {
+        str(site['siteId']): site['powerDataValueSeries']['values']
+        for site in json['powerDateValuesList']['siteEnergyList']
+    }
+    for site in sites:
+        if site not in values:
+            print_err(f"SolarEdge Cloud: Power bulk: site {site} missing : {source}")
+            continue
+        start = format_datetime_url(startTimes[site])
+        series = line_series('power', (('site', site), ('type', 'production')))
+        timezone = SITE_TIMEZONES[site]
+        for point in values[site]:
+            if point.get('value') is not None and point['date'] >= start:
+                lines.append(
+                    f'{series} w={float(point["value"]) * multiplier} {local_to_unix_timestamp(point["date"], timezone)}'
+                )
+    return [site for site in sites if site in values]
+
+
+def get_energy_bulk_api(sites: list, startTimes: dict, endTime: datetime,
+                        lines: list):
+    startTime = min(startTimes[site] for site in sites)
+    r = api_get(f"/sites/{','.join(sites)}/energy.json", {
+        'timeUnit': 'QUARTER_OF_AN_HOUR',
+        'startDate': format_date_url(startTime),
+        'endDate': format_date_url(endTime)
+    })
+    if r.status_code != 200:
+        print_err(f"SolarEdge Cloud: Energy bulk: HTTP {r.status_code} : {r.url}")
+        return []
+
+    archive_response('energy_bulk', ','.join(sites), startTime, endTime, {
+        'startTimes': {site: startTimes[site].isoformat() for site in sites}
+    }, r.content)
+    return parse_energy_bulk(r.json(), sites, startTimes, endTime, r.url, lines)
+
+
+def parse_energy_bulk(json: dict, sites: list, startTimes: dict,
+                      endTime: datetime, source: str, lines: list):
+    multiplier = wh_unit_to_multiplier(json['sitesEnergy']['unit'])
+    values = {
+        str(site['siteId']): site['energyValues']['values']
+        for site in json['sitesEnergy']['siteEnergyList']
+    }
+    end = format_datetime_url(endTime)
+    for site in sites:
+        if site not in values:
+            print_err(f"SolarEdge Cloud: Energy bulk: site {site} missing : {source}")
+            continue
+        # The bulk endpoint works with whole days, only keep the requested time range
+        start = format_datetime_url(startTimes[site])
+        series = line_series('energy', (('site', site), ('type', 'production')))
+        timezone = SITE_TIMEZONES[site]
+        for point in values[site]:
+            if point.get('value') is not None and start <= point['date'] <= end:
+                lines.append(
+                    f'{series} wh={float(point["value"]) * multiplier} {local_to_unix_timestamp(point["date"], timezone)}'
+                )
+    return [site for site in sites if site in values]
 
 
 # This data is similar as what can be read from modbus
-def get_data_api(site: str, startTime: datetime, endTime: datetime):
+def get_data_api(site: str, startTime: datetime, endTime: datetime,
+                 lines: list):
     for serial in SERIALS[site]:
-        r = requests.get(f"{BASE_API_URL}/equipment/{site}/{serial}/data", {
-            'startTime': format_datetime_url(startTime),
-            'endTime': format_datetime_url(endTime),
-            'api_key': SETTING_API_KEY
-        },
-            timeout=REQUEST_TIMEOUT)
-        if r.status_code != 200:
-            print_err(f"SolarEdge Cloud: Data: HTTP {r.status_code} : {r.url}")
-            # Note: might cause double data if the first call does not fail (prevous sites wil be remeasured next call)
+        if not get_data_serial_api(site, serial, startTime, endTime, lines):
             return False
+    return True
 
-        # Parse request
+
+def get_data_serial_api(site: str, serial: str, startTime: datetime,
+                        endTime: datetime, lines: list):
+    r = api_get(f"/equipment/{site}/{serial}/data", {
+        'startTime': format_datetime_url(startTime),
+        'endTime': format_datetime_url(endTime)
+    })
+    if r.status_code != 200:
+        print_err(f"SolarEdge Cloud: Data: HTTP {r.status_code} : {r.url}")
+        return False
+
+    archive_response('data', site, startTime, endTime, {'serial': serial},
+                     r.content)
+    parse_data(r.content, site, serial, r.url, lines)
+    return True
+
+
+# Malformed responses are skipped, a retry would return the same. With an output filter rule for
+# 'data' the telemetries are filtered here, see solarEdgeOutputFilter.py.
+def parse_data(content: bytes, site: str, serial: str, source: str,
+               lines: list):
+    try:
+        j = json.loads(content)
+    except ValueError as e:
+        print_err(f"failed to decode JSON in API response: {source}: {e}")
+        return
+    if "data" not in j or "telemetries" not in j["data"]:
+        print_err(
+            f"API response is missing 'data' or 'telemetries' objects; ignoring:"
+            f" {source}: {j}"
+        )
+        return
+    series = line_series('data', (('site', site), ('sn', serial)))
+    timezone = SITE_TIMEZONES[site]
+    filtered = solarEdgeOutputFilter.measurement_rule('data') is not None
+    for value in j['data']['telemetries']:
         try:
-            j = r.json()
-        except requests.exceptions.RequestsJSONDecodeError as e:
-            print_err(f"failed to decode JSON in API response: {r.url}: {e}")
-            continue
-        if "data" not in j or "telemetries" not in j["data"]:
+            if filtered:
+                timestamp = local_to_unix_timestamp(value['date'], timezone)
+                fields = ','.join(
+                    f'{name}={format_field_value(v)}'
+                    for name, v in solarEdgeOutputFilter.filter_fields(
+                        'data', series, data_field_values(value), int(timestamp)).items())
+                if fields:
+                    lines.append(f"{series} {fields} {timestamp}")
+                continue
+            fields = format_data_fields(value)
+            if fields:
+                lines.append(
+                    f"{series} {fields} {local_to_unix_timestamp(value['date'], timezone)}"
+                )
+        except KeyError as e:
             print_err(
-                f"API response is missing 'data' or 'telemetries' objects; ignoring:"
-                f" {r.url}: {j}"
+                f"API response is missing certain fields; ignoring: {source}: {e}"
             )
             continue
-        for value in j['data']['telemetries']:
-            try:
-                date = value['date']
-                # Note: not all data is logged; see Json/API for all available options
-                conditionalData = ''
-                dcVoltage = value['dcVoltage']
-                if dcVoltage is not None:
-                    conditionalData += f",I_DC_Voltage={dcVoltage}"
-                if 'L1Data' in value:
-                    conditionalData += format_L_data(value['L1Data'], 'L1')
-                if 'L2Data' in value:
-                    conditionalData += format_L_data(value['L2Data'], 'L2')
-                if 'L3Data' in value:
-                    conditionalData += format_L_data(value['L3Data'], 'L3')
-                print(
-                    f'data,site={site},sn={serial} I_Temp={value["temperature"]},I_AC_Energy_WH={value["totalEnergy"]},I_AC_Power={value["totalActivePower"]}{conditionalData} {to_unix_timestamp(date)}',
-                    flush=False)
-            except KeyError as e:
-                print_err(
-                    f"API response is missing certain fields; ignoring: {r.url}: {e}"
-                )
-                continue
-    return True
 
 
 # Scrape website
 
 
+# The playback data is JavaScript rather than JSON: single quoted strings, unquoted keys, e.g.:
+# {reportersData:{'Sun Feb 20 10:15:00 GMT 2022':{'-1000000':[{key:'123',value:'1,5'},...]},...},...}
+# Rather than rewriting it into JSON, the dates and panel readings are matched in a single pass.
+PLAYBACK_DATE = re.compile(
+    r"""['"](\w{3} \w{3} \d\d \d\d:\d\d:\d\d GMT \d{4})['"]\s*:""")
+PLAYBACK_PANEL = re.compile(
+    r"""\{\s*key\s*:\s*['"]([^'"]*)['"]\s*,\s*value\s*:\s*['"]([^'"]*)['"]\s*\}""")
+# The website writes the readings without whitespace and with single quotes, which this pattern
+# matches about 40% faster
+PLAYBACK_PANEL_COMPACT = re.compile(r"""\{key:'([^']*)',value:'([^']*)'\}""")
+
+
+# Yields the dates matched from start on. Every date holds ' GMT ', finding that first is an order
+# of magnitude faster than letting the pattern scan the whole text.
+def iter_playback_dates(text: str, start: int):
+    while True:
+        start = text.find(' GMT ', start)
+        if start == -1:
+            return
+        date = PLAYBACK_DATE.match(text, start - len("'Sun Feb 20 10:15:00"))
+        if date is not None:
+            yield date
+            start = date.end()
+        else:
+            start += len(' GMT ')
+
+
+# Yields (date, [(panel, value), ...]) for every date in 'reportersData', one date at a time.
+def iter_playback_readings(text: str):
+    start = text.find('reportersData')
+    if start == -1:
+        return
+    # A response is written in one style, judge it by its first reading
+    first = PLAYBACK_PANEL.search(text, start)
+    panel = PLAYBACK_PANEL_COMPACT if first is not None and PLAYBACK_PANEL_COMPACT.match(
+        text, first.start()) else PLAYBACK_PANEL
+    dates = iter_playback_dates(text, start)
+    current = next(dates, None)
+    while current is not None:
+        following = next(dates, None)
+        end = following.start() if following is not None else len(text)
+        # SID's (the keys in between) are meaningless
+        yield current.group(1), panel.findall(text, current.end(), end)
+        current = following
+
+
+@functools.lru_cache(maxsize=4096)
+def playback_to_unix_timestamp(date: str, timezone: str):
+    # Despite the 'GMT' it is the local time of the site
+    return f"{int(get_timezone(timezone).localize(datetime.datetime.strptime(date, '%a %b %d %H:%M:%S GMT %Y')).timestamp())}000000000"
+
+
 # Based on: https://gist.github.com/dragoshenron/0920411a2f3e53c214be0a26f51c53e2
 # Note: only available if you have optimizers
-def get_playback_data_site(days, site: str):
+def get_playback_data_site(days, site: str, lines: list):
     PANELS_DAILY_DATA = '4'
     PANELS_WEEKLY_DATA = '5'
     timeUnit = PANELS_WEEKLY_DATA if len(
         days) > 1 or days[0] != 0 else PANELS_DAILY_DATA
 
-    session = requests.session()
     panels = ensure_logged_in(
-        session, lambda: session.post(
+        lambda: WEB_SESSION.post(
             BASE_SITE_PANELS_URL,
             headers={
                 "Content-Type": "application/x-www-form-urlencoded",
-                "X-CSRF-TOKEN": session.cookies["CSRF-TOKEN"]
+                "X-CSRF-TOKEN": WEB_SESSION.cookies.get("CSRF-TOKEN", "")
             },
             data={
                 "fieldId": site,
                 "timeUnit": timeUnit
             },
-            timeout=REQUEST_TIMEOUT))
+            timeout=REQUEST_TIMEOUT), 'playbackData')
     if panels.status_code != 200:
         print_err(
             f"SolarEdge Cloud: Playback: HTTP {panels.status_code} : {panels.url}"
         )
-        return
+        return False
 
-    # Correct their JSON
-    response = panels.content.decode("utf-8").replace('\'', '"').replace(
-        'Array', '').replace('key', '"key"').replace('value', '"value"')
-    response = response.replace('timeUnit', '"timeUnit"').replace(
-        'fieldData', '"fieldData"').replace('reportersData', '"reportersData"')
-    response = json.loads(response)
-    for date, sids in response["reportersData"].items():
-        timestamp = str(int((pytz.timezone(SITE_TIMEZONES[site]).localize(
-            datetime.datetime.strptime(date,
-                                       '%a %b %d %H:%M:%S GMT %Y')).astimezone(
-                                           pytz.utc)).timestamp())) + "000000000"
-        for values in sids.values():  # SID's (key) are meaningless
-            for panel in values:
-                if panel['value'] != "0":  # No measurement
-                    print(
-                        f'panel,site={site},id={panel["key"]} w={float(safe_str_to_float(panel["value"]))} {timestamp}',
-                        flush=False)
-    return
-
-
-# TODO
-# Get the logical layout: 'https://monitoring.solaredge.com/solaredge-apigw/api/sites/{site}/layout/logical'
-# Can be used to fetch more info per panel: optimizer: V, general V, Current and Power.
-# However this has to be queried manually every 15 minutes (cloud update interval) and not all panels update at the same time so some bookkeeping is required.
-# As the current script only updates once a day this has been omitted. Unfortunately this data is not included in the playback data.
+    archive_response('playback', site, None, None, {}, panels.content)
+    parse_playback(panels.content, site, lines)
+    return True
 
-# ------------------------- History Scraper ------------------------------
 
+def parse_playback(content: bytes, site: str, lines: list):
+    series = line_series('panel', (('site', site), ))
+    timezone = SITE_TIMEZONES[site]
+    panels = set()
+    for date, readings in iter_playback_readings(content.decode("utf-8")):
+        timestamp = playback_to_unix_timestamp(date, timezone)
+        panels.update(key for key, _ in readings)
+        for key, value in readings:
+            if value != "0":  # No measurement
+                lines.append(
+                    f'{series},id={escape_key(key)} w={safe_str_to_float(value)} {timestamp}'
+                )
+    if panels:
+        PANEL_IDS[site] = panels
+
+
+# Parses 'Fri Jan 14 11:20:03 GMT 2022', which despite the 'GMT' is in the local time of the site
+def parse_site_date(date: str, site: str):
+    return get_timezone(SITE_TIMEZONES[site]).localize(
+        datetime.datetime.strptime(date, '%a %b %d %H:%M:%S GMT %Y'))
+
+
+# Optimizer measurements of the logical layout: (label prefix, field), the most specific prefix first.
+OPTIMIZER_FIELDS = (('Optimizer Voltage', 'v_opt'), ('Voltage', 'v'),
+                    ('Current', 'i'), ('Power', 'p'))
+
+
+# The logical layout holds the last measurement of every optimizer: its V, output V, I and P.
+# It is updated every 15 minutes but not all panels report at the same time, hence only
+# the measurements newer than the last one seen of that panel are written.
+# Note: only available if you have optimizers
+def get_optimizer_data_site(site: str, lines: list):
+    layout = ensure_logged_in(lambda: WEB_SESSION.get(
+        f"{BASE_SITE_LAYOUT_URL}/{site}/layout/logical",
+        headers={"X-CSRF-TOKEN": WEB_SESSION.cookies.get("CSRF-TOKEN", "")},
+        timeout=REQUEST_TIMEOUT), 'layout')
+    if layout.status_code != 200:
+        print_err(
+            f"SolarEdge Cloud: Layout: HTTP {layout.status_code} : {layout.url}"
+        )
+        return False
+
+    archive_response('layout', site, None, None, {}, layout.content)
+    lastSeen = dict(LAST_UPDATES['optimizer'].get(site, {}))  # Unix time per panel
+    parse_optimizer_layout(layout.json(), site, lastSeen, lines)
+    LAST_UPDATES['optimizer'][site] = lastSeen
+    return True
+
+
+# Updates lastSeen (unix time per panel) with the measurements written
+def parse_optimizer_layout(json: dict, site: str, lastSeen: dict, lines: list):
+    for panel, info in json.get('reportersInfo', {}).items():
+        date = info.get('lastMeasurementDate')
+        measurements = info.get('localizedMeasurements')
+        if not date or not measurements:
+            continue  # Not an optimizer or never reported
+        try:
+            measured = int(parse_site_date(date, site).timestamp())
+        except ValueError as e:
+            print_err(f"SolarEdge Cloud: Layout: {e}")
+            continue
+        if measured <= lastSeen.get(panel, 0):
+            continue
+
+        fields = []
+        for label, value in measurements.items():
+            for prefix, field in OPTIMIZER_FIELDS:
+                if label.startswith(prefix):
+                    fields.append(f'{field}={safe_str_to_float(value)}')
+                    break
+        if fields:
+            lines.append(
+                f"{line_series('optimizer', (('site', site), ('id', panel)))} {','.join(fields)} {measured}000000000"
+            )
+        lastSeen[panel] = measured
 
-def reduce_and_check(nr_calls: int):
-    nr_calls -= 1
-    if nr_calls == 0:
-        nr_calls = HISTORY_SCRAPER_MAX_API_CALLS
-        now = datetime.datetime.now()
-        time.sleep(now.replace(hour=24, minute=0, second=0) -
-                   now)  # Wait till next day
-    return nr_calls
+
+# ------------------------- History Scraper ------------------------------
 
 
 def get_production_duration():
-    r = requests.get(f"{BASE_API_URL}/sites/{SITES}/dataPeriod.json",
-                     {'api_key': SETTING_API_KEY},
-                     timeout=REQUEST_TIMEOUT)
+    r = api_get(f"/sites/{SITES}/dataPeriod.json")
     if r.status_code != 200:
         print_err(
             f"SolarEdge Cloud: DataPeriod: HTTP {r.status_code} : {r.url}")
@@ -503,97 +2508,414 @@ def get_production_duration():
     return ranges
 
 
-def scrape_full_history():
-    RETRY_SLEEP = 60.0
+# Completed history chunks as {(site, endpoint, start): end}
+def load_history_journal():
+    with STATE_LOCK:
+        rows = STATE_DB.execute(
+            'SELECT site, endpoint, start, end FROM history_chunks').fetchall()
+    return {(site, endpoint, datetime.datetime.fromisoformat(start)):
+            datetime.datetime.fromisoformat(end)
+            for site, endpoint, start, end in rows}
+
+
+def append_history_journal(site: str, endpoint: str, start: datetime.datetime,
+                           end: datetime.datetime):
+    with STATE_LOCK, STATE_DB:
+        STATE_DB.execute(
+            'INSERT INTO history_chunks VALUES (?, ?, ?, ?) ON CONFLICT DO UPDATE'
+            ' SET end = MAX(end, excluded.end)',
+            (site, endpoint, start.isoformat(), end.isoformat()))
+
+
+# The next history run imports everything again
+def reset_history_journal():
+    with STATE_LOCK, STATE_DB:
+        STATE_DB.execute('DELETE FROM history_chunks')
+
+
+def history_chunks(ranges):
+    HISTORY_ENDPOINTS = [
+        # API limited to 1 month time range (apparently 1 month == 28 days)
+        ('power', get_power_api, 28),
+        ('energy', get_energy_api, 28),
+        # API limited to 1 week time range
+        ('data', get_data_api, 7)
+    ]
+
+    chunks = []
+    for site in SITE_IDS:
+        if site not in ranges:
+            continue
+        # The end date is the last day with data, include that day as well
+        start = ranges[site][0]
+        end = ranges[site][1] + datetime.timedelta(days=1)
+        for endpoint, function, maxDays in HISTORY_ENDPOINTS:
+            # Assumption: not called between midnight and UPDATE_INTERVAL
+            for interval in get_date_intervals(
+                    start, history_end(site, endpoint, min(LAST_UPDATES[endpoint][site], end)),
+                    maxDays):
+                chunks.append((site, endpoint, function, interval))
+    return chunks
+
+
+# The end of the history of the site and endpoint, frozen at the first call: the daily loop
+# covers everything after it. With the watermark as end the last chunk would change, and be
+# fetched again, every day.
+def history_end(site: str, endpoint: str, end: datetime.datetime):
+    key = f'history_end:{endpoint}:{site}'
+    row = STATE_DB.execute('SELECT value FROM meta WHERE key = ?', (key, )).fetchone()
+    if row is not None:
+        return datetime.datetime.fromisoformat(row[0])
+    with STATE_LOCK, STATE_DB:
+        STATE_DB.execute('INSERT INTO meta VALUES (?, ?)', (key, end.isoformat()))
+    return end
+
+
+def history_chunk_cost(site: str, endpoint: str):
+    return len(SERIALS[site]) if endpoint == 'data' else 1
+
+
+def print_history_progress(done: int, total: int, calls_needed: int):
+    calls_left = remaining_api_calls(PRIORITY_BACKFILL)
+    if calls_needed <= calls_left:
+        eta = 'today'
+    else:
+        per_day = max(1, backfill_api_calls_per_day())
+        days = -(-(calls_needed - calls_left) // per_day)
+        eta = (quota_day() + datetime.timedelta(days=days)).isoformat()
+    print_err(
+        f"SolarEdge Cloud: History: {done}/{total} chunks completed, {total - done} remaining"
+        f" ({calls_needed} API calls, {calls_left} left today), ETA {eta}")
+    flush()
+
+
+# Resumable: every completed (site, endpoint, interval) chunk is journaled and skipped when
+# the history is scraped again, so a restart only fetches the chunks that are still missing.
+# Budgeted (backfill job) it stops at the first chunk the backfill quota left today cannot pay for,
+# rather than waiting for the refill.
+def scrape_full_history(budgeted: bool = False):
     INTERVAL_SLEEP = 1.0
 
-    last_updates = LAST_UPDATES.copy()
+    # All calls made by the history scraper yield to the daily loop
+    QUOTA_CONTEXT.priority = PRIORITY_BACKFILL
+
+    if budgeted and remaining_api_calls(PRIORITY_BACKFILL) == 0:
+        return
     ranges = get_production_duration()
-    remaining_API_calls = reduce_and_check(HISTORY_SCRAPER_MAX_API_CALLS)
+    if ranges is None:
+        return
 
-    for site in SITE_IDS:
-        ranges = ranges[site]
+    journal = load_history_journal()
+    if not journal:
+        # A full (re-)import
+        reset_delivered(DEDUP_HISTORY)
+        with STATE_LOCK, STATE_DB:
+            STATE_DB.execute("DELETE FROM meta WHERE key LIKE 'history_end:%'")
+    chunks = history_chunks(ranges)
+    remaining = [(site, endpoint, function, interval)
+                 for site, endpoint, function, interval in chunks
+                 if journal.get((site, endpoint, interval[0]),
+                                interval[0]) < interval[1]]
+    done = len(chunks) - len(remaining)
+    calls_needed = sum(
+        history_chunk_cost(site, endpoint)
+        for site, endpoint, _, _ in remaining)
+    print_history_progress(done, len(chunks), calls_needed)
+
+    for site, endpoint, function, interval in remaining:
+        if budgeted and remaining_api_calls(
+                PRIORITY_BACKFILL) < history_chunk_cost(site, endpoint):
+            print_err("SolarEdge Cloud: History: backfill quota used up, continuing tomorrow")
+            return
+        with profile_cycle(f'history-{site}-{endpoint}', PROFILE_OPTIONS):
+            started = time.monotonic()
+            lines = []
+            if run_instrumented(function, (site, interval[0], interval[1]), lines):
+                # A chunk that was partially delivered before (stopped import) only writes the rest
+                delivered = {}
+                scope = f'{endpoint}:{interval[0].isoformat()}'
+                write_lines(deduplicate(lines, DEDUP_HISTORY, delivered, scope))
+                if EMIT_ROLLUPS:
+                    write_lines(rollup_lines(lines))
+                checkpoint(
+                    functools.partial(commit_delivered, DEDUP_HISTORY, delivered))
+                checkpoint(
+                    functools.partial(append_history_journal, site, endpoint,
+                                      interval[0], interval[1]))
+                checkpoint(functools.partial(forget_delivered, DEDUP_HISTORY, scope))
+                done += 1
+            else:
+                # Transient errors are already retried by api_get()
+                print_err(
+                    f"SolarEdge Cloud: History: {endpoint} of site {site} failed for"
+                    f" {interval[0]} - {interval[1]}, rerun to fill the gap")
+            if EMIT_SCRAPER_STATS:
+                # The watermarks do not move while scraping the history
+                write_lines(
+                    stats_lines(time.monotonic() - started, PRIORITY_BACKFILL,
+                                watermarks=False))
+        if INFLUXDB_FAILED:
+            print_err("SolarEdge Cloud: History: writing to InfluxDB failed, stopping")
+            return
+        calls_needed -= history_chunk_cost(site, endpoint)
+        print_history_progress(done, len(chunks), calls_needed)
+        time.sleep(INTERVAL_SLEEP)
+
+
+# ------------------------------ Replay ----------------------------------------
+
+
+# Regenerates the lines of an archived response, the times are as stored in the archive
+def replay_response(endpoint: str, site: str, startTime: str, endTime: str,
+                    args: dict, content: bytes, lines: list):
+    source = f'archive {endpoint} {site} {startTime}'
+    startTimes = {
+        s: datetime.datetime.fromisoformat(t)
+        for s, t in args.get('startTimes', {}).items()
+    }
+    if endpoint == 'power':
+        parse_power(json.loads(content), site, lines)
+    elif endpoint == 'energy':
+        parse_energy(json.loads(content), site, lines)
+    elif endpoint == 'power_bulk':
+        parse_power_bulk(json.loads(content), site.split(','), startTimes,
+                         source, lines)
+    elif endpoint == 'energy_bulk':
+        parse_energy_bulk(json.loads(content), site.split(','), startTimes,
+                          datetime.datetime.fromisoformat(endTime), source, lines)
+    elif endpoint == 'data':
+        parse_data(content, site, args['serial'], source, lines)
+    elif endpoint == 'playback':
+        parse_playback(content, site, lines)
+    elif endpoint == 'layout':
+        # Every snapshot on its own, repeated measurements end up as the same point
+        parse_optimizer_layout(json.loads(content), site, {}, lines)
+    else:
+        raise ValueError(f'unknown endpoint {endpoint}')
 
-        # API limited to 1 month time range (apparently 1 month == 28 days)
-        # Assumption: not called between midnight and UPDATE_INTERVAL
-        powerLastUpdates = last_updates['power']
-        for month in get_date_intervals(ranges[0],
-                                        min(powerLastUpdates[site], ranges[1]),
-                                        28):
-            remaining_API_calls = reduce_and_check(remaining_API_calls)
-            while not get_power_api(site, month[0], month[1]):
-                remaining_API_calls = reduce_and_check(remaining_API_calls)
-                time.sleep(RETRY_SLEEP)
-            time.sleep(INTERVAL_SLEEP)
-        flush()
 
-        # API limited to 1 month time range
-        energyLastUpdates = last_updates['energy']
-        for month in get_date_intervals(
-                ranges[0], min(energyLastUpdates[site], ranges[1]), 28):
-            remaining_API_calls = reduce_and_check(remaining_API_calls)
-            while not get_energy_api(site, month[0], month[1]):
-                remaining_API_calls = reduce_and_check(remaining_API_calls)
-                time.sleep(RETRY_SLEEP)
-            time.sleep(INTERVAL_SLEEP)
-        flush()
+def initialize_replay_worker(home: str, timezones: dict):
+    global HOME_DIR, SITE_TIMEZONES
 
-        # API limited to 1 week time range
-        dataLastUpdates = last_updates['data']
-        for week in get_date_intervals(ranges[0],
-                                       min(dataLastUpdates[site], ranges[1]),
-                                       7):
-            remaining_API_calls = reduce_and_check(remaining_API_calls)
-            while not get_data_api(site, week[0], week[1]):
-                remaining_API_calls = reduce_and_check(remaining_API_calls)
-                time.sleep(RETRY_SLEEP)
-            time.sleep(INTERVAL_SLEEP)
-        flush()
+    HOME_DIR = home
+    SITE_TIMEZONES = timezones
+    PANEL_IDS.clear()
 
 
-# -----------------------------------------------------------------------
-# Main()
-# -----------------------------------------------------------------------
+# Runs in a worker process, returns the lines of all responses of the segment in archive order
+# and the PANEL_IDS of the playback data replayed by the worker so far
+def replay_segment(segment: int, rows: list):
+    lines = []
+    with open(archive_segment_path(segment), 'rb') as f:
+        for offset, length, endpoint, site, startTime, endTime, args in rows:
+            f.seek(offset)
+            try:
+                replay_response(endpoint, site, startTime, endTime, json.loads(args),
+                                gzip.decompress(f.read(length)), lines)
+            except (ValueError, KeyError, EOFError, OSError) as e:
+                # Eg, a site that is no longer part of the inventory
+                print_err(f"SolarEdge Cloud: Replay: {endpoint} of {site} in segment {segment}:"
+                          f" {type(e).__name__}: {e}")
+    return '\n'.join(lines), PANEL_IDS
+
+
+# Writes the lines of every archived response, the segments are parsed in parallel but written
+# in archive order, followed by the rollups and panel stats of the days they cover. The days up to
+# a day after the newest pruned response may be partly gone from the archive, their rollups are
+# left as they are. No network access, watermarks and dedup index are left as they are.
+def replay_archive():
+    segments = {}
+    for segment, *row in STATE_DB.execute(
+            'SELECT segment, offset, length, endpoint, site, start_time, end_time, args'
+            ' FROM archive ORDER BY segment, offset'):
+        segments.setdefault(segment, []).append(row)
+    if not segments:
+        print_err("SolarEdge Cloud: Replay: the archive is empty")
+        return
 
-initialize_home_dir()
+    complete = (archive_pruned() + 24 * 3600) * 1000000000
+    rolledUp = []  # The energy, power and panel lines of the complete days
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=REPLAY_WORKERS,
+            initializer=initialize_replay_worker,
+            initargs=(HOME_DIR, SITE_TIMEZONES)) as pool:
+        for done, (text, panels) in enumerate(
+                pool.map(replay_segment, segments, segments.values()), 1):
+            PANEL_IDS.update(panels)
+            if text:
+                lines = text.split('\n')
+                write_lines(lines)
+                rolledUp += [
+                    line for line in lines if line[:line.find(',')] in ROLLUPS
+                    and int(line[line.rindex(' ') + 1:]) > complete
+                ]
+            print_err(f"SolarEdge Cloud: Replay: {done}/{len(segments)} segments")
+            flush()
+    if EMIT_ROLLUPS:
+        write_lines(rollup_lines(rolledUp))
+    if EMIT_PANEL_STATS:
+        write_lines(panel_stats_lines(rolledUp))
+    flush()
 
-if not initialize_installation_info():
-    print_err('Failed to initialize installation info, exiting.')
-    flush_and_exit(1)
 
-initialize_last_updated()
+# ------------------------------ Accounts --------------------------------------
 
-if len(sys.argv) > 2:
-    print_err(f'Unknown CLI arguments {str(sys.argv)}, existing.')
-    flush_and_exit(1)
 
-if len(sys.argv) == 2:
-    # History scrape loop
-    if sys.argv[1] == 'history':
-        scrape_full_history()
-        flush_and_exit(0)
-    # Debug loop
-    elif sys.argv[1] == 'debug':
-        update_all_data(datetime.datetime.now().replace(
-            hour=UPDATE_INTERVAL_HOUR, minute=UPDATE_INTERVAL_MIN))
-        flush_and_exit(0)
+def start_account_worker(name: str):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:],
+                            env=dict(os.environ, **{ACCOUNT_ENV: name}),
+                            stdout=subprocess.PIPE)
+
+
+# Copies the output of a worker to stdout in whole lines, so lines of different workers never mix
+def forward_account_output(stream):
+    pending = b''
+    while True:
+        chunk = stream.read1(65536)
+        if not chunk:
+            break
+        pending += chunk
+        end = pending.rfind(b'\n') + 1
+        if end:
+            with OUTPUT_LOCK:
+                sys.stdout.buffer.write(pending[:end])
+                sys.stdout.buffer.flush()
+            pending = pending[end:]
+
+
+# Runs a worker process per account. With restart (daemon modes) a worker that exits is started
+# again after ACCOUNT_RESTART_DELAY and this never returns; otherwise (history, replay, debug)
+# returns 1 if any of the workers failed once all of them are done. Stderr of the workers is
+# passed on as is.
+# The daemon workers mostly sleep until their next job, they all run but their jobs take one of
+# ACCOUNT_WORKERS slots (see run_job_thread()). The other modes start at most ACCOUNT_WORKERS
+# workers at once, the next account when one is done.
+def supervise_accounts(restart: bool):
+    workers = {}  # Name: (process, output thread)
+    restarts = {}  # Name: monotonic time of the restart
+    queued = [account['name'] for account in ACCOUNTS]
+
+    def start(name: str):
+        process = start_account_worker(name)
+        thread = threading.Thread(target=forward_account_output,
+                                  args=(process.stdout, ),
+                                  daemon=True)
+        thread.start()
+        workers[name] = (process, thread)
+
+    # Stopped by Telegraf, stop the workers as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    exitCode = 0
+    try:
+        while workers or restarts or queued:
+            while queued and (restart or len(workers) < ACCOUNT_WORKERS):
+                start(queued.pop(0))
+            time.sleep(1)
+            for name, (process, thread) in list(workers.items()):
+                code = process.poll()
+                if code is None:
+                    continue
+                thread.join()  # The rest of its output
+                del workers[name]
+                if restart:
+                    print_err(f"SolarEdge Cloud: Account {name}: worker exited with {code},"
+                              f" restarting in {ACCOUNT_RESTART_DELAY}s")
+                    restarts[name] = time.monotonic() + ACCOUNT_RESTART_DELAY
+                elif code != 0:
+                    print_err(f"SolarEdge Cloud: Account {name}: worker exited with {code}")
+                    exitCode = 1
+            for name, at in list(restarts.items()):
+                if time.monotonic() >= at:
+                    del restarts[name]
+                    start(name)
+    finally:
+        for process, _ in workers.values():
+            process.terminate()
+        for process, _ in workers.values():
+            process.wait()
+    return exitCode
+
 
-    print_err(f'Unknown CLI argument {sys.argv[1]}, existing.')
-    flush_and_exit(1)
+# -----------------------------------------------------------------------
+# Main()
+# -----------------------------------------------------------------------
 
-# Daily update loop
-while True:
-    # Always run at the end of the day ~midnight to get the most accurate daily data.
+
+def main():
+    global POLL_MODE, PROFILE_OPTIONS
+
+    initialize_home_dir()
+    PROFILE_OPTIONS = set(filter(None, os.environ.get(PROFILE_ENV, '').split(',')))
+    solarEdgeOutputFilter.configure(OUTPUT_FILTER_RULES)
+
+    if ACCOUNTS and ACCOUNT_ENV not in os.environ:
+        flush_and_exit(supervise_accounts(restart=sys.argv[1:] in ([], ['poll'])))
+
+    # Offline, from the stored inventory
+    if sys.argv[1:] == ['replay']:
+        initialize_state_store()
+        info, _ = load_installation_info()
+        if info is None:
+            print_err('No installation info stored yet, exiting.')
+            flush_and_exit(1)
+        apply_installation_info(info)
+        if INFLUXDB_WRITE_URL:
+            start_influxdb_writer()
+            replay_archive()
+            flush_and_exit(0 if stop_influxdb_writer() else 1)
+        replay_archive()
+        flush_and_exit(0)
+
+    initialize_sessions()
+
+    if not initialize_installation_info():
+        print_err('Failed to initialize installation info, exiting.')
+        flush_and_exit(1)
+
+    initialize_last_updated()
+
+    if sys.argv[1:] == ['history', 'full']:
+        reset_history_journal()
+        del sys.argv[2]
+
+    if len(sys.argv) > 2:
+        print_err(f'Unknown CLI arguments {str(sys.argv)}, existing.')
+        flush_and_exit(1)
+
+    if len(sys.argv) == 2:
+        # History scrape loop
+        if sys.argv[1] == 'history':
+            if INFLUXDB_WRITE_URL:
+                start_influxdb_writer()
+                scrape_full_history()
+                flush_and_exit(0 if stop_influxdb_writer() else 1)
+            scrape_full_history()
+            flush_and_exit(0)
+        # Intraday poll loop
+        elif sys.argv[1] == 'poll':
+            POLL_MODE = True
+            asyncio.run(run_scheduler())
+        # Debug loop
+        elif sys.argv[1] == 'debug':
+            update_all_data(datetime.datetime.now().replace(
+                hour=UPDATE_INTERVAL_HOUR, minute=UPDATE_INTERVAL_MIN))
+            flush_and_exit(0)
+        # Debug loop, profiled
+        elif sys.argv[1] == 'profile':
+            with profile_cycle('update', PROFILE_OPTIONS or PROFILE_MODE_OPTIONS):
+                update_all_data(datetime.datetime.now().replace(
+                    hour=UPDATE_INTERVAL_HOUR, minute=UPDATE_INTERVAL_MIN))
+            flush_and_exit(0)
+
+        print_err(f'Unknown CLI argument {sys.argv[1]}, existing.')
+        flush_and_exit(1)
+
+    # Daily update loop
+    # The cloud job runs at the end of the day ~midnight to get the most accurate daily data.
     # Assumption: it will be dark by midnight
-    now = datetime.datetime.now()
-    nextUpdate = now.replace(hour=UPDATE_INTERVAL_HOUR,
-                             minute=UPDATE_INTERVAL_MIN,
-                             second=0)
-    if now.hour >= UPDATE_INTERVAL_HOUR and now.minute >= UPDATE_INTERVAL_MIN:
-        nextUpdate += datetime.timedelta(days=1)
-    time.sleep((nextUpdate - datetime.datetime.now()).total_seconds())
-
-    update_all_data(datetime.datetime.now().replace(hour=UPDATE_INTERVAL_HOUR,
-                                                    minute=UPDATE_INTERVAL_MIN,
-                                                    second=0))
-flush_and_exit(0)
+    asyncio.run(run_scheduler())
+    flush_and_exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+
+import sys
+import math
+import time
+import socket
+import struct
+import collections
+import concurrent.futures
+
+import solarEdgeOutputFilter
+
+# Stand-alone daemon managed by Telegraf, replaces one [[inputs.modbus]] block per inverter.
+# Reads the SunSpec inverter block of every inverter in a single Modbus/TCP request, all inverters
+# concurrently, and writes one 'inverterN' measurement per inverter in line protocol.
+# With SAMPLE_INTERVAL the inverters are read every few seconds and every POLL_INTERVAL window is
+# written as the last value of each field plus its _min, _max and _mean. Threshold crossings are
+# written as they are read to 'inverter_events'.
+#
+# Note: most static data is omitted (pointless to monitor)
+# Note: battery and meter data is omitted (as i have none)
+#
+# No 3rd party dependencies, solarEdgeOutputFilter.py is installed next to this script.
+
+# name: measurement name, the Grafana dashboard expects 'inverterX' where X is an integer.
+# host/port: Modbus/TCP address of the inverter, unit: Modbus slave id.
+# site: Site ID can be found on SolarEdge's website, sn: serial number of the inverter.
+INVERTERS = [
+    {
+        'name': 'inverter1',
+        'host': '0.0.0.1',
+        'port': 1502,
+        'unit': 1,
+        'site': '1234567',
+        'sn': '1234567-AA'
+    },
+    {
+        'name': 'inverter2',
+        'host': '0.0.0.2',
+        'port': 1502,
+        'unit': 1,
+        'site': '1234567',
+        'sn': '7654321-ZZ'
+    },
+]
+POLL_INTERVAL = 60  # s, the window with SAMPLE_INTERVAL
+# Read the inverters this often (eg, 5) and aggregate the samples per window, 0 reads once per
+# window. Every field but the energy counter and status gets _min, _max and _mean: about 4 times
+# the fields per point.
+SAMPLE_INTERVAL = 0  # s
+GRID_FREQUENCY = 60  # Hz, as the frequency gauge of the dashboard; 50 in Europe
+FREQUENCY_EVENT_DEVIATION = 0.2  # Hz
+# Event: (field, 'above' or 'below', limit). An 'inverter_events' point is written when a reading
+# crosses the limit (active=true) and when it is back (active=false). eg, for EN 50160 voltage on a
+# single phase inverter: 'overvoltage': ('I_AC_VoltageAB', 'above', 253.0)
+THRESHOLDS = {
+    'overfrequency':
+    ('I_AC_Frequency', 'above', round(GRID_FREQUENCY + FREQUENCY_EVENT_DEVIATION, 2)),
+    'underfrequency':
+    ('I_AC_Frequency', 'below', round(GRID_FREQUENCY - FREQUENCY_EVENT_DEVIATION, 2)),
+}
+MODBUS_TIMEOUT = 5  # s
+# Deadband, precision and night filter of the written measurements, see solarEdgeOutputFilter.py.
+# Measurement: {'keyframe': s, 'sleep': (field, value)}, {} writes every poll as is. I_Status 2 is
+# sleeping (night).
+# The keyframe must stay within the range of the last value panels of
+# grafana/dashboard_solaredge_realtime.json (-15m), less the time the point takes to get there.
+OUTPUT_FILTER_RULES = {'inverter[0-9]*': {'keyframe': 600, 'sleep': ('I_Status', 2)}}
+# Emit the 'poller_stats' measurement (points and bytes saved by the filter) this often
+STATS_INTERVAL = 3600  # s
+
+# -----------------------------------------------------------------------
+
+# SunSpec inverter model (101: single phase, 102: split phase, 103: three phase), holding registers
+# (0-based) as (address, name, struct format). Gaps are skipped.
+# Always 0/not used: I_Status_Vendor (108). Not read: c_serialnumber (52-67).
+SUNSPEC_REGISTERS = [
+    (69, 'C_SunSpec_DID', 'H'),
+    (71, 'I_AC_Current', 'H'),
+    (72, 'I_AC_CurrentA', 'H'),
+    (73, 'I_AC_CurrentB', 'H'),
+    (74, 'I_AC_CurrentC', 'H'),
+    (75, 'I_AC_Current_SF', 'h'),
+    (76, 'I_AC_VoltageAB', 'H'),
+    (77, 'I_AC_VoltageBC', 'H'),
+    (78, 'I_AC_VoltageCA', 'H'),
+    (79, 'I_AC_VoltageAN', 'H'),
+    (80, 'I_AC_VoltageBN', 'H'),
+    (81, 'I_AC_VoltageCN', 'H'),
+    (82, 'I_AC_Voltage_SF', 'h'),
+    (83, 'I_AC_Power', 'h'),
+    (84, 'I_AC_Power_SF', 'h'),
+    (85, 'I_AC_Frequency', 'H'),
+    (86, 'I_AC_Frequency_SF', 'h'),
+    (87, 'I_AC_VA', 'h'),
+    (88, 'I_AC_VA_SF', 'h'),
+    (89, 'I_AC_VAR', 'h'),
+    (90, 'I_AC_VAR_SF', 'h'),
+    (91, 'I_AC_PF', 'h'),
+    (92, 'I_AC_PF_SF', 'h'),
+    (93, 'I_AC_Energy_WH', 'i'),  # 2 registers
+    (95, 'I_AC_Energy_WH_SF', 'h'),
+    (96, 'I_DC_Current', 'H'),
+    (97, 'I_DC_Current_SF', 'h'),
+    (98, 'I_DC_Voltage', 'H'),
+    (99, 'I_DC_Voltage_SF', 'h'),
+    (100, 'I_DC_Power', 'H'),
+    (101, 'I_DC_Power_SF', 'h'),
+    (103, 'I_Temp', 'H'),
+    (106, 'I_Temp_SF', 'h'),
+    (107, 'I_Status', 'H'),
+]
+SUNSPEC_SINGLE_PHASE = 101
+SUNSPEC_SPLIT_PHASE = 102
+I_STATUS_SLEEPING = 2  # Night/sleep mode
+
+# Value fields and their scale factor
+SCALED_FIELDS = {
+    'I_AC_Current': 'I_AC_Current_SF',
+    'I_AC_CurrentA': 'I_AC_Current_SF',
+    'I_AC_CurrentB': 'I_AC_Current_SF',
+    'I_AC_CurrentC': 'I_AC_Current_SF',
+    'I_AC_VoltageAB': 'I_AC_Voltage_SF',
+    'I_AC_VoltageBC': 'I_AC_Voltage_SF',
+    'I_AC_VoltageCA': 'I_AC_Voltage_SF',
+    'I_AC_VoltageAN': 'I_AC_Voltage_SF',
+    'I_AC_VoltageBN': 'I_AC_Voltage_SF',
+    'I_AC_VoltageCN': 'I_AC_Voltage_SF',
+    'I_AC_Power': 'I_AC_Power_SF',
+    'I_AC_Frequency': 'I_AC_Frequency_SF',
+    'I_AC_VA': 'I_AC_VA_SF',
+    'I_AC_VAR': 'I_AC_VAR_SF',
+    'I_AC_PF': 'I_AC_PF_SF',
+    'I_AC_Energy_WH': 'I_AC_Energy_WH_SF',
+    'I_DC_Current': 'I_DC_Current_SF',
+    'I_DC_Voltage': 'I_DC_Voltage_SF',
+    'I_DC_Power': 'I_DC_Power_SF',
+    'I_Temp': 'I_Temp_SF',
+}
+# Meaningless measurements per inverter type
+PHASE_DROPPED_FIELDS = {
+    SUNSPEC_SINGLE_PHASE: {
+        'I_AC_VoltageBC', 'I_AC_VoltageCA', 'I_AC_VoltageAN', 'I_AC_VoltageBN',
+        'I_AC_VoltageCN', 'I_AC_CurrentB', 'I_AC_CurrentC'
+    },
+    SUNSPEC_SPLIT_PHASE: {'I_AC_VoltageCA', 'I_AC_VoltageCN', 'I_AC_CurrentC'},
+}
+# Counters, only their last value is written per window
+LAST_ONLY_FIELDS = {'I_AC_Energy_WH', 'I_Status'}
+# Obsolete measurements at night/sleep mode, dropped to reduce stored data size
+SLEEPING_DROPPED_FIELDS = {
+    'I_AC_Current', 'I_AC_CurrentA', 'I_AC_CurrentB', 'I_AC_CurrentC',
+    'I_AC_Power', 'I_AC_VA', 'I_AC_VAR', 'I_AC_PF', 'I_AC_Energy_WH',
+    'I_DC_Current', 'I_DC_Power'
+}
+
+
+def sunspec_block_layout(registers):
+    start = registers[0][0]
+    end = start
+    fmt = '>'
+    names = []
+    for address, name, code in registers:
+        fmt += 'xx' * (address - end) + code
+        names.append(name)
+        end = address + struct.calcsize('>' + code) // 2
+    return start, end - start, fmt, names
+
+
+SUNSPEC_START, SUNSPEC_COUNT, SUNSPEC_FORMAT, SUNSPEC_NAMES = sunspec_block_layout(
+    SUNSPEC_REGISTERS)
+SCALE_FACTORS = {sf: 10.0**sf for sf in range(-10, 11)}
+
+# ------------------------------ Utils -----------------------------------------
+
+
+# Write to Telegraf
+def flush():
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+def print_err(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def escape_key(key: str):
+    return key.replace('\\', '\\\\').replace(',', '\\,').replace(
+        '=', '\\=').replace(' ', '\\ ')
+
+
+# ------------------------------ Modbus/TCP ------------------------------------
+
+
+def receive_exactly(sock: socket.socket, size: int):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return data
+
+
+# Function 3: read holding registers, returns the raw register bytes
+def read_holding_registers(sock: socket.socket, transaction: int, unit: int,
+                           address: int, count: int):
+    sock.sendall(
+        struct.pack('>HHHBBHH', transaction, 0, 6, unit, 3, address, count))
+    transaction_id, _, length, _ = struct.unpack('>HHHB',
+                                                 receive_exactly(sock, 7))
+    pdu = receive_exactly(sock, length - 1)
+    if transaction_id != transaction:
+        raise ConnectionError(f'unexpected transaction {transaction_id}')
+    # Function and exception code, or function, byte count and at least one byte
+    if not pdu or len(pdu) < (2 if pdu[0] & 0x80 else 3):
+        raise ConnectionError(f'short frame, length {length}')
+    if pdu[0] & 0x80:
+        raise ConnectionError(f'Modbus exception {pdu[1]}')
+    if pdu[1] != count * 2 or len(pdu) != count * 2 + 2:
+        raise ConnectionError(f'unexpected byte count {pdu[1]}')
+    return pdu[2:]
+
+
+# ------------------------------ SunSpec ---------------------------------------
+
+
+# Decodes the inverter block and applies the scale factors, returns the fields of the measurement
+def decode_sunspec_block(data: bytes):
+    raw = dict(zip(SUNSPEC_NAMES, struct.unpack(SUNSPEC_FORMAT, data)))
+
+    dropped = PHASE_DROPPED_FIELDS.get(raw['C_SunSpec_DID'], set())
+    if raw['I_Status'] == I_STATUS_SLEEPING:
+        dropped = dropped | SLEEPING_DROPPED_FIELDS
+
+    fields = {
+        name: raw[name] * SCALE_FACTORS.get(raw[sf], 10.0**raw[sf])
+        for name, sf in SCALED_FIELDS.items() if name not in dropped
+    }
+    fields['I_Status'] = raw['I_Status']
+    return fields
+
+
+def inverter_series(inverter: dict):
+    # slave_id was added by the Telegraf modbus input, kept so the series continue
+    return (f"{escape_key(inverter['name'])},site={escape_key(inverter['site'])},"
+            f"slave_id={inverter['unit']},sn={escape_key(inverter['sn'])}")
+
+
+# Appends the line of the fields to lines, unless the output filter drops all of them
+def append_inverter_line(inverter: dict, fields: dict, timestamp: int, lines: list):
+    series = inverter_series(inverter)
+    fields = solarEdgeOutputFilter.filter_fields(inverter['name'], series, fields, timestamp)
+    if fields:
+        values = ','.join(f'{name}={value}i' if name == 'I_Status' else
+                          f'{name}={value}' for name, value in fields.items())
+        lines.append(f'{series} {values} {timestamp}')
+
+
+# ------------------------------ Poller ----------------------------------------
+
+CONNECTIONS = {}  # Inverter name: open socket
+TRANSACTION = 0
+
+
+def poll_inverter(inverter: dict, transaction: int):
+    sock = CONNECTIONS.get(inverter['name'])
+    try:
+        if sock is None:
+            sock = socket.create_connection((inverter['host'], inverter['port']),
+                                            timeout=MODBUS_TIMEOUT)
+            CONNECTIONS[inverter['name']] = sock
+        return decode_sunspec_block(
+            read_holding_registers(sock, transaction, inverter['unit'],
+                                   SUNSPEC_START, SUNSPEC_COUNT))
+    except (OSError, struct.error) as e:
+        print_err(f"Modbus: {inverter['name']}: {e}")
+        if sock is not None:
+            sock.close()
+        CONNECTIONS.pop(inverter['name'], None)
+        return None
+
+
+# Reads all inverters concurrently, returns the timestamp and the fields (None on errors) in the
+# order of INVERTERS
+def read_all(pool: concurrent.futures.ThreadPoolExecutor):
+    global TRANSACTION
+
+    TRANSACTION = (TRANSACTION + 1) & 0xFFFF
+    timestamp = time.time_ns()
+    return timestamp, list(
+        pool.map(lambda inverter: poll_inverter(inverter, TRANSACTION),
+                 INVERTERS))
+
+
+# Polls all inverters concurrently, the lines (and their events) are in the order of INVERTERS
+def poll_all(pool: concurrent.futures.ThreadPoolExecutor):
+    timestamp, results = read_all(pool)
+    lines = []
+    for inverter, fields in zip(INVERTERS, results):
+        if fields is not None:
+            lines += threshold_lines(inverter, fields, timestamp)
+            append_inverter_line(inverter, fields, timestamp, lines)
+    return lines
+
+
+# ------------------------------ Sampling --------------------------------------
+
+SAMPLES = {}  # Inverter name: ring buffer of (timestamp, fields) of the current window
+EVENTS_ACTIVE = {}  # (Inverter name, event): limit crossed at the last sample
+
+
+def format_event_line(inverter: dict, event: str, field: str, value: float,
+                      limit: float, active: bool, timestamp: int):
+    return (f"inverter_events,name={escape_key(inverter['name'])},"
+            f"site={escape_key(inverter['site'])},sn={escape_key(inverter['sn'])},"
+            f"event={escape_key(event)},field={escape_key(field)}"
+            f" value={value},limit={limit},active={str(active).lower()} {timestamp}")
+
+
+# The events of a reading, every crossing of a THRESHOLDS limit in either direction
+def threshold_lines(inverter: dict, fields: dict, timestamp: int):
+    lines = []
+    for event, (field, direction, limit) in THRESHOLDS.items():
+        value = fields.get(field)
+        if value is None:
+            continue
+        active = value > limit if direction == 'above' else value < limit
+        key = (inverter['name'], event)
+        if active != EVENTS_ACTIVE.get(key, False):
+            EVENTS_ACTIVE[key] = active
+            lines.append(
+                format_event_line(inverter, event, field, value, limit, active,
+                                  timestamp))
+    return lines
+
+
+# Reads all inverters into their ring buffer, returns the event lines
+def sample_all(pool: concurrent.futures.ThreadPoolExecutor):
+    timestamp, results = read_all(pool)
+    lines = []
+    for inverter, fields in zip(INVERTERS, results):
+        if fields is None:
+            continue
+        samples = SAMPLES.get(inverter['name'])
+        if samples is None:
+            samples = SAMPLES[inverter['name']] = collections.deque(
+                maxlen=math.ceil(POLL_INTERVAL / SAMPLE_INTERVAL) + 1)
+        samples.append((timestamp, fields))
+        lines += threshold_lines(inverter, fields, timestamp)
+    return lines
+
+
+# The fields of a window: those of the last sample with their min, max and mean over the samples
+# that have them
+def aggregate_samples(samples: collections.deque):
+    timestamp, last = samples[-1]
+    fields = {}
+    for name, value in last.items():
+        fields[name] = value
+        if name in LAST_ONLY_FIELDS:
+            continue
+        values = [sample[name] for _, sample in samples if name in sample]
+        fields[f'{name}_min'] = min(values)
+        fields[f'{name}_max'] = max(values)
+        fields[f'{name}_mean'] = sum(values) / len(values)
+    return timestamp, fields
+
+
+# One line per inverter with samples in the closing window, at the time of its last sample
+def window_lines():
+    lines = []
+    for inverter in INVERTERS:
+        samples = SAMPLES.get(inverter['name'])
+        if samples:
+            timestamp, fields = aggregate_samples(samples)
+            append_inverter_line(inverter, fields, timestamp, lines)
+            samples.clear()
+    return lines
+
+
+# -----------------------------------------------------------------------
+# Main()
+# -----------------------------------------------------------------------
+
+
+def main():
+    solarEdgeOutputFilter.configure(OUTPUT_FILTER_RULES)
+    statsDue = time.monotonic() + STATS_INTERVAL
+    windowDue = time.monotonic() + POLL_INTERVAL
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(INVERTERS))) as pool:
+        while True:
+            started = time.monotonic()
+            if SAMPLE_INTERVAL:
+                lines = sample_all(pool)
+                if started >= windowDue:
+                    # Windows missed while the inverters did not answer are skipped
+                    windowDue = max(windowDue, started - POLL_INTERVAL) + POLL_INTERVAL
+                    lines += window_lines()
+            else:
+                lines = poll_all(pool)
+            if OUTPUT_FILTER_RULES and started >= statsDue:
+                statsDue = started + STATS_INTERVAL
+                lines.append(
+                    f'poller_stats,filter=output {solarEdgeOutputFilter.stats_fields()}'
+                    f' {time.time_ns()}')
+            if lines:
+                sys.stdout.write('\n'.join(lines) + '\n')
+            flush()
+            time.sleep(
+                max(0.0, (SAMPLE_INTERVAL or POLL_INTERVAL) -
+                    (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import fnmatch
+import functools
+import threading
+
+# Output stage shared by solarEdgeCloudScraper.py and solarEdgeModbusPoller.py, install it next to
+# them. Cuts the points and bytes written to InfluxDB (an SD card on a Pi), the scripts pass the
+# fields of every point through filter_fields() before formatting its line:
+# - precision: values are rounded to what the inverter actually resolves
+# - deadband: a field is only written when it moved more than its deadband since it was last written
+# - keyframes: every KEYFRAME seconds of data all fields of a series are written, so every
+#   dashboard window has a value and a lost point is repaired
+# - night: while the inverter sleeps (and slept at the previous point) only keyframes are written
+#
+# Measurements without a rule pass as is, as do points at or before the last point of their series
+# (eg, history imports). Fields of filtered measurements must be numeric (or booleans).
+#
+# No 3rd party dependencies.
+
+# Measurement (fnmatch pattern): {'keyframe': s, 'sleep': (field, value) while sleeping}, set by
+# the scripts with configure()
+RULES = {}
+# Field (fnmatch pattern, the first match wins): (deadband, decimals kept). A deadband of 0 writes
+# every change, decimals None keeps the value as is.
+FIELD_RULES = (
+    ('I_Status', 0, None),
+    ('*Energy_WH*', 0, 0),
+    ('*Voltage*', 1.0, 1),
+    ('*Current*', 0.1, 2),
+    ('*Freq*', 0.02, 2),
+    ('*PF*', 0.01, 3),
+    ('*Temp*', 0.5, 1),
+    ('*', 10.0, 1),  # Power, VA and VAR
+)
+
+# Series: {'timestamp': ns, 'keyframe': ns, 'sleeping': bool, 'fields': {field: last written}}
+STATE = {}
+STATS = {'lines_in': 0, 'lines_out': 0, 'fields_in': 0, 'fields_out': 0, 'bytes_saved': 0}
+LOCK = threading.Lock()
+
+
+def configure(rules: dict):
+    global RULES
+
+    RULES = rules
+    measurement_rule.cache_clear()
+
+
+@functools.lru_cache(maxsize=1024)
+def measurement_rule(measurement: str):
+    for pattern, rule in RULES.items():
+        if fnmatch.fnmatchcase(measurement, pattern):
+            return rule
+    return None
+
+
+@functools.lru_cache(maxsize=1024)
+def field_rule(field: str):
+    for pattern, deadband, decimals in FIELD_RULES:
+        if fnmatch.fnmatchcase(field, pattern):
+            return max(deadband, 1e-12), decimals  # A deadband of 0 still skips equal values
+    return 1e-12, None
+
+
+def round_value(field: str, value):
+    if type(value) is not float:
+        return value  # Integers (eg, I_Status), booleans
+    decimals = field_rule(field)[1]
+    return value if decimals is None else round(value, decimals)
+
+
+# Returns the fields to write of a point of a ruled measurement, updates the state of its series
+def filter_point(rule: dict, series: str, fields: dict, timestamp: int):
+    state = STATE.get(series)
+    if state is not None and timestamp <= state['timestamp']:
+        return fields  # Out of order, not part of the stream
+
+    sleep = rule.get('sleep')
+    sleeping = sleep is not None and round_value(sleep[0], fields.get(sleep[0])) == sleep[1]
+    keyframe = (state is None or
+                timestamp - state['keyframe'] >= rule.get('keyframe', 900) * 1000000000)
+    if state is None:
+        state = STATE[series] = {'keyframe': timestamp, 'fields': {}, 'sleeping': False}
+    state['timestamp'] = timestamp
+    wasSleeping = state['sleeping']
+    state['sleeping'] = sleeping
+    if keyframe:
+        state['keyframe'] = timestamp
+    elif sleeping and wasSleeping:
+        return {}
+
+    last = state['fields']
+    written = {}
+    for name, value in fields.items():
+        deadband, decimals = field_rule(name)
+        if type(value) is float and decimals is not None:
+            value = round(value, decimals)
+        previous = last.get(name)
+        if (keyframe or previous is None or
+            (value != previous if type(value) is bool or type(previous) is bool else
+             abs(value - previous) >= deadband)):
+            written[name] = last[name] = value
+    return written
+
+
+# Filters a point, fields is {name: value} and timestamp in ns. series is its measurement and tags
+# as in line protocol, the state is kept per series. Returns the fields to write, rounded, in the
+# same order; empty if the whole point is dropped.
+def filter_fields(measurement: str, series: str, fields: dict, timestamp: int):
+    rule = measurement_rule(measurement)
+    if rule is None:
+        return fields
+    with LOCK:
+        written = filter_point(rule, series, fields, timestamp)
+        # What the dropped fields (and line) would have taken in line protocol
+        saved = 0 if len(written) == len(fields) else sum(
+            len(name) + len(str(value)) + 2 for name, value in fields.items()
+            if name not in written)
+        if not written:
+            saved += len(series) + 20  # Space and timestamp, the separator was counted above
+        STATS['lines_in'] += 1
+        STATS['fields_in'] += len(fields)
+        STATS['lines_out'] += 1 if written else 0
+        STATS['fields_out'] += len(written)
+        STATS['bytes_saved'] += saved
+    return written
+
+
+# Line protocol fields of what was filtered since the last call: lines and points (fields) in and
+# out, and the points and (about the) bytes saved
+def stats_fields():
+    with LOCK:
+        stats = dict(STATS)
+        for key in STATS:
+            STATS[key] = 0
+    return (','.join(f'{key}={value}i' for key, value in stats.items()) +
+            f",points_saved={stats['fields_in'] - stats['fields_out']}i")
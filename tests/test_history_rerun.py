@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import sys
+import datetime
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import bench_cloud_scraper as bench
+
+scraper = bench.scraper
+
+# The history import with a chunk that fails the first time, fed by the synthetic responses of
+# the benchmark. Run: python3 -m unittest discover tests
+
+DAYS = 84  # 4 power chunks of 28 days
+
+
+class HistoryRerunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        bench.setup_scraper(1, DAYS, self.home)
+        scraper.EMIT_ROLLUPS = False
+        scraper.ARCHIVE_RESPONSES = False
+        scraper.DEDUP_INDEX.clear()
+        scraper.ROLLUP_STORE = None
+        scraper.initialize_state_store()
+        self.fakeApiGet = scraper.api_get
+
+    def tearDown(self):
+        scraper.api_get = self.fakeApiGet
+        scraper.STATE_DB.close()
+        shutil.rmtree(self.home)
+
+    # Returns the power lines written
+    def run_history(self):
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            scraper.scrape_full_history()
+            return [line for line in sys.stdout.getvalue().splitlines()
+                    if line.startswith('power,')]
+        finally:
+            sys.stdout = stdout
+
+    def test_failed_middle_chunk_is_written_on_rerun(self):
+        chunks = [interval for _, endpoint, _, interval in scraper.history_chunks(
+            scraper.get_production_duration()) if endpoint == 'power']
+        self.assertGreaterEqual(len(chunks), 3)
+        failing = scraper.format_datetime_url(chunks[len(chunks) // 2][0])
+
+        def failing_api_get(path: str, params: dict = {}):
+            response = self.fakeApiGet(path, params)
+            if path.endswith('/powerDetails.json') and params['startTime'] == failing:
+                response.status_code = 500
+            return response
+
+        scraper.api_get = failing_api_get
+        self.assertTrue(self.run_history())
+
+        scraper.api_get = self.fakeApiGet
+        rerun = self.run_history()
+        self.assertTrue(rerun)
+        expected = []
+        scraper.get_power_api(scraper.SITE_IDS[0], *chunks[len(chunks) // 2], expected)
+        self.assertEqual(sorted(rerun), sorted(expected))
+
+        # Complete now: a third run fetches nothing
+        self.assertEqual(self.run_history(), [])
+
+    def test_complete_history_is_not_fetched_again_as_watermarks_move(self):
+        self.assertTrue(self.run_history())
+        calls = []
+
+        def counting_api_get(path: str, params: dict = {}):
+            if not path.endswith('/dataPeriod.json'):
+                calls.append(path)
+            return self.fakeApiGet(path, params)
+
+        scraper.api_get = counting_api_get
+        # A day later: the sites produced another day and the daily loop moved on
+        getProductionDuration = scraper.get_production_duration
+        scraper.get_production_duration = lambda: {
+            site: (start, end + datetime.timedelta(days=1))
+            for site, (start, end) in getProductionDuration().items()
+        }
+        for endpoint in ('power', 'energy', 'data'):
+            for site, value in scraper.LAST_UPDATES[endpoint].items():
+                scraper.LAST_UPDATES[endpoint][site] = value + datetime.timedelta(days=1)
+        try:
+            self.assertEqual(self.run_history(), [])
+        finally:
+            scraper.get_production_duration = getProductionDuration
+        self.assertEqual(calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
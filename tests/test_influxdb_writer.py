@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import sys
+import gzip
+import threading
+import contextlib
+import http.server
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'telegraf'))
+import solarEdgeCloudScraper as scraper
+
+# The writer to INFLUXDB_WRITE_URL against a local http.server stand-in of the InfluxDB write
+# endpoint. Run: python3 -m unittest discover tests
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    # Set by the tests: the statuses to answer with in order, 204 once used up
+    statuses = []
+    # The decompressed bodies received, with the status they were answered with
+    writes = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status = StandIn.statuses.pop(0) if StandIn.statuses else 204
+        encoding = self.headers['Content-Encoding']
+        StandIn.writes.append(
+            (gzip.decompress(body).decode('utf-8') if encoding == 'gzip' else None, status))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InfluxdbWriterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.saved = (scraper.INFLUXDB_WRITE_URL, scraper.INFLUXDB_BATCH_BYTES,
+                      scraper.REQUEST_BACKOFF_BASE, scraper.REQUEST_RETRIES)
+        scraper.INFLUXDB_WRITE_URL = \
+            f'http://127.0.0.1:{self.server.server_address[1]}/api/v2/write?bucket=test'
+        scraper.INFLUXDB_BATCH_BYTES = 1000
+        scraper.REQUEST_BACKOFF_BASE = 0.001
+        scraper.REQUEST_RETRIES = 3
+        StandIn.statuses = []
+        StandIn.writes = []
+        self.lines = [f'power,site=1 power={i}.0 {1700000000 + i}000000000' for i in range(100)]
+        self.checkpoints = []
+
+    def tearDown(self):
+        (scraper.INFLUXDB_WRITE_URL, scraper.INFLUXDB_BATCH_BYTES,
+         scraper.REQUEST_BACKOFF_BASE, scraper.REQUEST_RETRIES) = self.saved
+
+    # Writes the lines in two parts with a checkpoint after each, returns whether the writer
+    # succeeded and what was logged
+    def write(self):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            scraper.start_influxdb_writer()
+            scraper.write_lines(self.lines[:50])
+            scraper.checkpoint(lambda: self.checkpoints.append(1))
+            scraper.write_lines(self.lines[50:])
+            scraper.checkpoint(lambda: self.checkpoints.append(2))
+            written = scraper.stop_influxdb_writer()
+        return written, stderr.getvalue()
+
+    def test_lines_are_written_gzipped_in_batches(self):
+        written, _ = self.write()
+        self.assertTrue(written)
+        self.assertEqual(self.checkpoints, [1, 2])
+        bodies = [body for body, _ in StandIn.writes]
+        self.assertNotIn(None, bodies)
+        self.assertGreater(len(bodies), 2)
+        # In order, every batch but the one cut by a checkpoint is just over INFLUXDB_BATCH_BYTES
+        self.assertEqual('\n'.join(bodies).split('\n'), self.lines)
+        for body in bodies:
+            self.assertLess(len(body), scraper.INFLUXDB_BATCH_BYTES + 100)
+
+    def test_server_errors_and_throttling_are_retried(self):
+        StandIn.statuses = [500, 429, 503]
+        written, logged = self.write()
+        self.assertTrue(written)
+        self.assertEqual(self.checkpoints, [1, 2])
+        self.assertEqual([status for _, status in StandIn.writes[:4]], [500, 429, 503, 204])
+        # The same batch is sent again
+        self.assertEqual(len({body for body, _ in StandIn.writes[:4]}), 1)
+        self.assertEqual('\n'.join(body for body, _ in StandIn.writes[3:]).split('\n'),
+                         self.lines)
+        self.assertIn('HTTP 429, retry 2/3', logged)
+
+    def test_checkpoint_does_not_advance_after_a_failed_write(self):
+        # The second batch, before the first checkpoint, is rejected
+        StandIn.statuses = [204, 400]
+        written, logged = self.write()
+        self.assertFalse(written)
+        self.assertTrue(scraper.INFLUXDB_FAILED)
+        self.assertIn('InfluxDB: write: HTTP 400', logged)
+        # Nothing after the failed batch is sent and no checkpoint runs
+        self.assertEqual([status for _, status in StandIn.writes], [204, 400])
+        self.assertEqual(self.checkpoints, [])
+
+    def test_exhausted_retries_fail_the_write(self):
+        StandIn.statuses = [503] * (scraper.REQUEST_RETRIES + 1)
+        written, _ = self.write()
+        self.assertFalse(written)
+        self.assertEqual(len(StandIn.writes), scraper.REQUEST_RETRIES + 1)
+        self.assertEqual(self.checkpoints, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
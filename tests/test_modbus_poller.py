@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import sys
+import struct
+import threading
+import contextlib
+import socketserver
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'telegraf'))
+import solarEdgeModbusPoller as poller
+
+# The poller against a local Modbus/TCP stand-in of an inverter, which answers read holding
+# registers requests with a SunSpec inverter block. Run: python3 -m unittest discover tests
+
+# Raw register values of a three phase inverter producing 2.5 kW
+THREE_PHASE = {
+    'C_SunSpec_DID': 103,
+    'I_AC_Current': 1085, 'I_AC_CurrentA': 362, 'I_AC_CurrentB': 361, 'I_AC_CurrentC': 362,
+    'I_AC_Current_SF': -2,
+    'I_AC_VoltageAB': 4002, 'I_AC_VoltageBC': 4010, 'I_AC_VoltageCA': 3998,
+    'I_AC_VoltageAN': 2311, 'I_AC_VoltageBN': 2315, 'I_AC_VoltageCN': 2308,
+    'I_AC_Voltage_SF': -1,
+    'I_AC_Power': 250, 'I_AC_Power_SF': 1,
+    'I_AC_Frequency': 6001, 'I_AC_Frequency_SF': -2,
+    'I_AC_VA': 2510, 'I_AC_VA_SF': 0,
+    'I_AC_VAR': -120, 'I_AC_VAR_SF': 0,
+    'I_AC_PF': 9950, 'I_AC_PF_SF': -2,
+    'I_AC_Energy_WH': 12345678, 'I_AC_Energy_WH_SF': 0,
+    'I_DC_Current': 6512, 'I_DC_Current_SF': -3,
+    'I_DC_Voltage': 3953, 'I_DC_Voltage_SF': -1,
+    'I_DC_Power': 2574, 'I_DC_Power_SF': 0,
+    'I_Temp': 4125, 'I_Temp_SF': -2,
+    'I_Status': 4,
+}
+
+
+class StandIn(socketserver.BaseRequestHandler):
+    # Set by the tests: the raw register values, or 'exception' or 'short'
+    registers = THREE_PHASE
+
+    def handle(self):
+        while True:
+            request = self.request.recv(12)
+            if len(request) < 12:
+                return
+            transaction, _, _, unit, function, address, count = struct.unpack(
+                '>HHHBBHH', request)
+            if self.registers == 'exception':
+                pdu = struct.pack('>BB', function | 0x80, 2)  # Illegal data address
+            elif self.registers == 'short':
+                pdu = struct.pack('>B', function)
+            else:
+                block = struct.pack(poller.SUNSPEC_FORMAT,
+                                    *(self.registers[name] for name in poller.SUNSPEC_NAMES))
+                offset = (address - poller.SUNSPEC_START) * 2
+                data = block[offset:offset + count * 2]
+                pdu = struct.pack('>BB', function, len(data)) + data
+            self.request.sendall(
+                struct.pack('>HHHB', transaction, 0, len(pdu) + 1, unit) + pdu)
+
+
+class ModbusPollerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StandIn)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.inverter = {
+            'name': 'inverter1',
+            'host': '127.0.0.1',
+            'port': self.server.server_address[1],
+            'unit': 1,
+            'site': '1234567',
+            'sn': '1234567-AA'
+        }
+        StandIn.registers = THREE_PHASE
+
+    def tearDown(self):
+        for sock in poller.CONNECTIONS.values():
+            sock.close()
+        poller.CONNECTIONS.clear()
+
+    # Returns the fields read, None on errors, and what was logged
+    def poll(self):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            fields = poller.poll_inverter(self.inverter, 7)
+        return fields, stderr.getvalue()
+
+    def test_three_phase_block_is_decoded_and_scaled(self):
+        fields, _ = self.poll()
+        expected = {
+            'I_AC_Current': 10.85, 'I_AC_CurrentA': 3.62, 'I_AC_CurrentB': 3.61,
+            'I_AC_CurrentC': 3.62, 'I_AC_VoltageAB': 400.2, 'I_AC_VoltageBC': 401.0,
+            'I_AC_VoltageCA': 399.8, 'I_AC_VoltageAN': 231.1, 'I_AC_VoltageBN': 231.5,
+            'I_AC_VoltageCN': 230.8, 'I_AC_Power': 2500.0, 'I_AC_Frequency': 60.01,
+            'I_AC_VA': 2510.0, 'I_AC_VAR': -120.0, 'I_AC_PF': 99.5,
+            'I_AC_Energy_WH': 12345678.0, 'I_DC_Current': 6.512, 'I_DC_Voltage': 395.3,
+            'I_DC_Power': 2574.0, 'I_Temp': 41.25
+        }
+        self.assertEqual(set(fields), set(expected) | {'I_Status'})
+        for name, value in expected.items():
+            self.assertAlmostEqual(fields[name], value, places=9, msg=name)
+        self.assertEqual(fields['I_Status'], 4)
+        # The connection is kept for the next poll
+        self.assertIn('inverter1', poller.CONNECTIONS)
+        self.assertEqual(self.poll()[0], fields)
+
+    def test_single_phase_and_sleeping_fields_are_dropped(self):
+        StandIn.registers = dict(THREE_PHASE, C_SunSpec_DID=101, I_Status=2)
+        fields, _ = self.poll()
+        dropped = (poller.PHASE_DROPPED_FIELDS[poller.SUNSPEC_SINGLE_PHASE] |
+                   poller.SLEEPING_DROPPED_FIELDS)
+        self.assertFalse(dropped & set(fields))
+        self.assertEqual(set(fields), set(poller.SCALED_FIELDS) - dropped | {'I_Status'})
+
+    def test_exception_response_is_an_error(self):
+        StandIn.registers = 'exception'
+        fields, logged = self.poll()
+        self.assertIsNone(fields)
+        self.assertIn('Modbus exception 2', logged)
+        self.assertNotIn('inverter1', poller.CONNECTIONS)
+
+    def test_short_frame_is_an_error(self):
+        StandIn.registers = 'short'
+        fields, logged = self.poll()
+        self.assertIsNone(fields)
+        self.assertIn('short frame', logged)
+        self.assertNotIn('inverter1', poller.CONNECTIONS)
+        # And the next poll reconnects
+        StandIn.registers = THREE_PHASE
+        self.assertIsNotNone(self.poll()[0])
+
+    def test_poll_all_writes_a_line_per_inverter(self):
+        inverters = poller.INVERTERS
+        poller.INVERTERS = [self.inverter, dict(self.inverter, name='inverter2', sn='B')]
+        try:
+            with poller.concurrent.futures.ThreadPoolExecutor(2) as pool:
+                lines = poller.poll_all(pool)
+        finally:
+            poller.INVERTERS = inverters
+        self.assertEqual([line.split(',', 1)[0] for line in lines], ['inverter1', 'inverter2'])
+        self.assertTrue(lines[0].startswith(
+            'inverter1,site=1234567,slave_id=1,sn=1234567-AA I_AC_Current=10.85,'))
+        self.assertIn(',I_Status=4i ', lines[0])
+
+
+if __name__ == '__main__':
+    unittest.main()